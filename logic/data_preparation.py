@@ -1,17 +1,201 @@
 import numpy
+import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
+from pandas.api.types import union_categoricals
 from sklearn.preprocessing import (OneHotEncoder, StandardScaler, LabelEncoder)
+from sklearn.neighbors import BallTree
 
-def gather_customers_with_n_purchase(data, n):
+from utils import stage
+
+def load_raw_data(data_path, files, schema, date_columns, date_format,
+                  workers=4, key_categories=None):
+    # Reads the raw files concurrently, each with only the columns in its
+    # schema and with compact types. Returns a dict of tables by input name.
+    # 'key_categories' optionally gives the categories of some key columns,
+    # e.g. the products and sellers a shard of the orders is joined with,
+    # instead of the ones of the files read. Other IDs become missing.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(read_raw_table, data_path + file,
+                                         schema[name], date_columns,
+                                         date_format)
+                   for name, file in files.items()}
+        tables = {name: future.result() for name, future in futures.items()}
+
+    _share_key_categories(tables, schema, key_categories)
+    return tables
+
+def read_raw_table(path, schema, date_columns, date_format):
+    # Keys are read as categories here, they get their shared categories
+    # once all files are read
+    dtypes = {column: 'category' if dtype == 'key' else dtype
+              for column, dtype in schema.items()}
+    data = pd.read_csv(path, dtype=dtypes,
+                       usecols=lambda column: column in schema or \
+                                              column in date_columns)
+
+    for column in data.columns.intersection(date_columns):
+        data[column] = pd.to_datetime(data[column], format=date_format)
+
+    return data
+
+def _share_key_categories(tables, schema, key_categories=None):
+    # Gives each key column the same sorted categories in every table
+    key_categories = key_categories or {}
+    key_tables = {}
+    for name, table_schema in schema.items():
+        for column, dtype in table_schema.items():
+            if dtype == 'key' and name in tables:
+                key_tables.setdefault(column, []).append(name)
+
+    # The codes are set with set_categories, astype keeps the categories of
+    # a column that already has the same ones in another order
+    for column, names in key_tables.items():
+        if column in key_categories:
+            categories = key_categories[column]
+        else:
+            categories = union_categoricals([tables[name][column]
+                                             for name in names],
+                                            ignore_order=True).categories
+            categories = categories.sort_values()
+        for name in names:
+            tables[name][column] = \
+                tables[name][column].cat.set_categories(categories)
+
+# Raw inputs split into shards by partition_raw_data, in the order they are
+# read: customers go by customer_unique_id, orders follow their customer and
+# the other inputs follow their order
+PARTITIONED_INPUTS = ['customers', 'orders', 'order_items', 'order_payments',
+                      'order_reviews']
+
+def partition_raw_data(data_path, files, shards_path, partitions, schema,
+                       date_columns, chunksize=200000, level=0):
+    # Hash partitions the raw files of PARTITIONED_INPUTS by
+    # customer_unique_id into 'partitions' shard directories, with the same
+    # file names, so all the purchases of a customer end up in one shard.
+    # Orders of unknown customers and rows of unknown orders go to the first
+    # shard. Files are streamed in chunks of 'chunksize' rows and only the
+    # columns in the schema are written, as they were read.
+    # A shard can be partitioned again in the same way, with a higher 'level'
+    # so the customers are hashed differently than when it was cut.
+    shard_paths = [get_shard_path(shards_path, shard)
+                   for shard in range(partitions)]
+    for path in shard_paths:
+        os.makedirs(path, exist_ok=True)
+
+    # Shard of each customer id and order id, to route the rows referring
+    # to them. The ids are kept as hashes, which take less memory.
+    routes = {}
+    for name in PARTITIONED_INPUTS:
+        usecols = lambda column: column in schema[name] or \
+                                 column in date_columns
+        ids = []
+        for chunk_number, chunk in enumerate(
+                pd.read_csv(data_path + files[name], dtype=str,
+                            usecols=usecols, chunksize=chunksize)):
+            shards = _route_rows(name, chunk, routes, partitions, level)
+            if chunk_number == 0:
+                for path in shard_paths:
+                    chunk.iloc[:0].to_csv(path + files[name], index=False)
+            for shard, rows in chunk.groupby(shards):
+                rows.to_csv(shard_paths[shard] + files[name], mode='a',
+                            header=False, index=False)
+            if name in ['customers', 'orders']:
+                id_column = name[:-1] + '_id'
+                ids.append(pd.Series(shards.astype('int16'),
+                                     index=_hash_ids(chunk[id_column])))
+        if ids:
+            ids = pd.concat(ids)
+            routes[name[:-1] + '_id'] = ids[~ids.index.duplicated()]
+
+def _route_rows(name, chunk, routes, partitions, level):
+    # Shard of each row of a chunk of one of PARTITIONED_INPUTS
+    if name == 'customers':
+        return (_hash_ids(chunk['customer_unique_id'], level) % partitions)\
+               .astype('int64')
+
+    route_column = 'customer_id' if name == 'orders' else 'order_id'
+    return pd.Series(_hash_ids(chunk[route_column]))\
+             .map(routes.get(route_column, {}))\
+             .fillna(0).astype('int64').values
+
+def _hash_ids(ids, level=0):
+    # Each level of partitioning hashes with its own key
+    return pd.util.hash_array(ids.fillna('').to_numpy(dtype=object),
+                              hash_key=f'{level:016d}')
+
+def get_shard_path(shards_path, shard):
+    return os.path.join(shards_path, f'shard-{shard:05d}', '')
+
+def concatenate_partitions(parts):
+    # Concatenates the parts of a table prepared shard by shard
+    # Categorical columns stay categorical, with the sorted union of the
+    # parts' categories where they differ. Empty parts may have lost the
+    # categorical type when saved.
+    parts = list(parts)
+    for column in parts[0].columns:
+        # Categorical types are equal when their categories are in another
+        # order too, so the categories are compared
+        categories = [part[column].cat.categories
+                      if isinstance(part[column].dtype, pd.CategoricalDtype)
+                      else None for part in parts]
+        if all(part_categories is None for part_categories in categories) or \
+                all(part_categories is not None and
+                    part_categories.equals(categories[0])
+                    for part_categories in categories):
+            continue
+        parts = [part.astype({column: 'category'}) for part in parts]
+        categories = union_categoricals([part[column] for part in parts],
+                                        ignore_order=True).categories
+        for part in parts:
+            part[column] = \
+                part[column].cat.set_categories(categories.sort_values())
+
+    return pd.concat(parts, ignore_index=True)
+
+def build_customer_index(data):
+    # Sorts the purchases by customer and purchase time, and records where
+    # each customer's rows start, so the rows of any customers can be sliced
+    # out without filtering the whole table.
+    # The rows of customers[i] are data.iloc[offsets[i]:offsets[i + 1]].
+    data = data.sort_values(by=['customer_unique_id',
+                                'order_purchase_timestamp'],
+                            kind='mergesort', ignore_index=True)
+    codes = pd.factorize(data['customer_unique_id'])[0]
+    starts = np.flatnonzero(np.diff(codes, prepend=-2) != 0)
+    customers = np.asarray(data['customer_unique_id'].values[starts],
+                           dtype=object)
+
+    customer_index = {'data': data,
+                      'customers': pd.Index(customers),
+                      'offsets': np.append(starts, len(data))}
+    return customer_index
+
+def get_customer_purchases(customer_index, customers):
+    # Returns the rows of the given customers, in the order of the index
+    # Unknown customers are skipped
+    positions = customer_index['customers'].get_indexer(customers)
+    positions = np.unique(positions[positions >= 0])
+    offsets = customer_index['offsets']
+    rows = _concatenate_ranges(offsets[positions], offsets[positions + 1])
+    return customer_index['data'].iloc[rows]
+
+def _concatenate_ranges(starts, ends):
+    # np.concatenate([np.arange(start, end) for start, end in ...])
+    lengths = ends - starts
+    shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shifts + np.arange(lengths.sum())
+
+def gather_customers_with_n_purchase(customer_index, n):
     # Returns list of customers with exactly 'n' purchase
-    data = data.groupby('customer_unique_id').agg('count')
-    data = data[data['customer_id']==n]
+    purchase_count = np.diff(customer_index['offsets'])
 
-    return data.index.values
+    return customer_index['customers'].values[purchase_count == n]
 
-def filter_complete_data_by_customer(customers, data, n):
-    data = data[data['customer_unique_id'].isin(customers)]
+def filter_purchases_by_customer(customers, customer_index, n):
+    data = get_customer_purchases(customer_index, customers)
 
     # Filter out cases where the customer bought the same product
     # multiple times in the same order
@@ -20,35 +204,40 @@ def filter_complete_data_by_customer(customers, data, n):
                                         'product_id'])
 
     # Now filter once again people with less than 'n' purchase
-    # Then sort by timestamp
-    customers = gather_customers_with_n_purchase(data, n=n)
-    data = data[data['customer_unique_id'].isin(customers)]
-    data = data.sort_values(by=['customer_unique_id',
-                                'order_purchase_timestamp'])
-    return data
+    # The rows stay sorted by customer and timestamp
+    customer_index = build_customer_index(data)
+    customers = gather_customers_with_n_purchase(customer_index, n=n)
+    return get_customer_purchases(customer_index, customers)
+
+def build_predictor_table(data, columns):
+    # Expects data sorted by customer and purchase time, as returned by
+    # filter_purchases_by_customer.
+    # Every purchase that is followed by another purchase of the same customer
+    # becomes one row: its columns are the predictors and the category of the
+    # following purchase is the target. With exactly two purchases per
+    # customer this is one row per customer (first -> second purchase).
+    customers = data['customer_unique_id'].values
+    has_next = np.zeros(len(data), dtype=bool)
+    has_next[:-1] = customers[:-1] == customers[1:]
+    next_category = data['product_category_name'].values[1:][has_next[:-1]]
+
+    # The customer is kept with each row so rows can be replaced when the
+    # customer's purchases change
+    predictor_dict = {'customer_unique_id':
+                      data['customer_unique_id'].values[has_next]}
+    for column in columns:
+        if column == 'next_product_category':
+            predictor_dict[column] = next_category
+        else:
+            predictor_dict[column] = data[column].values[has_next]
 
-def build_predictor_table(data, columns):   
-    customers = data['customer_unique_id'].unique()
-
-    predictor_dict = {column: [] for column in columns}
-    for customer in customers:
-        customer_data = data[data['customer_unique_id']==customer]
-
-        for column in columns:
-            # Note: for the target category we take the next purchase in time
-            # e.g. customer_data.iloc[1] as the data is sorted by time
-            if column == 'next_product_category':
-                predictor_dict[column]\
-                    .append(customer_data.iloc[1]['product_category_name'])
-            else:
-                predictor_dict[column].append(customer_data.iloc[0][column])
-        
     predictor_table = pd.DataFrame(predictor_dict)
     return predictor_table
 
 def prepare_modelling_data(data, columns_dict):
     # Encode and normalize categorical variables
     # Encode target labels
+    # Returns a CSR matrix of the features with the targets as last column
     scaler = StandardScaler()
     standardized_data = \
         scaler.fit_transform(data[columns_dict['numerical']].values)
@@ -59,59 +248,757 @@ def prepare_modelling_data(data, columns_dict):
     label_encoder = LabelEncoder()
     targets = label_encoder.fit_transform(data[columns_dict['target']].values)
 
-    data = np.concatenate((standardized_data,
-                           oh_data.todense(),
-                           targets.reshape(-1, 1)), axis=1)
+    data = sp.hstack((standardized_data, oh_data, targets.reshape(-1, 1)),
+                     format='csr')
     return data, scaler, oh_encoder, label_encoder
 
+def prepare_labeled_data(data, columns_dict, encoders):
+    # Runs labeled data through already fitted encoders
+    # Rows with a target unknown to the label encoder are left out, the
+    # returned mask tells which rows were kept
+    # The codes are looked up rather than transformed, labels added by
+    # add_labels come after the sorted ones
+    label_encoder = encoders['label_encoder']
+    targets = pd.Index(label_encoder.classes_)\
+                .get_indexer(data[columns_dict['target'][0]])
+    known_targets = targets >= 0
+    data = data[known_targets]
+
+    features = prepare_unlabeled_data(data, columns_dict, encoders)
+    targets = targets[known_targets]
+
+    data = sp.hstack((features, targets.reshape(-1, 1)), format='csr')
+    return data, known_targets
+
+def add_labels(label_encoder, targets):
+    # Appends the targets unknown to the label encoder to its classes, and
+    # returns them. The known labels keep their codes, so models trained on
+    # them stay valid.
+    # A missing category is a label too, as when the encoder was fitted
+    targets = pd.Index(pd.Series(targets).astype(object).unique())
+    new_labels = targets.difference(label_encoder.classes_, sort=False)\
+                        .values
+    label_encoder.classes_ = np.concatenate((label_encoder.classes_,
+                                             new_labels))
+    return new_labels
+
 def prepare_unlabeled_data(data, columns_dict, encoders):
     # Encode and normalize categorical variables
-    # Encode target labels
+    # The one hot columns stay sparse, the features are returned as CSR
     scaler = encoders['standard_scaler']
     oh_encoder = encoders['one_hot_encoder']
 
     standardized_data = scaler.transform(data[columns_dict['numerical']].values)
     oh_data = oh_encoder.transform(data[columns_dict['categorical']].values)
 
-    data = np.asarray(np.concatenate((standardized_data,
-                                      oh_data.todense()), axis=1))
+    data = sp.hstack((standardized_data, oh_data), format='csr')
     return data
 
-def join_coords(data, geolocation):
-    data = _join_coordinates(data, geolocation, new_column_prefix='customer',
-                             left_on='customer_zip_code_prefix')
-    data = _join_coordinates(data, geolocation, new_column_prefix='seller',
-                            left_on='seller_zip_code_prefix')
-    
-    return data
+def build_star_schema(customers, orders, order_items, order_payments,
+                      order_reviews, products, sellers, first_keys=None):
+    # Normalizes the raw tables into dimension tables (customers, products,
+    # sellers) and fact tables (orders, order_items, order_payments,
+    # order_reviews) linked by integer surrogate keys.
+    # ID columns are categoricals with categories shared by all tables (see
+    # load_raw_data), so their codes are used as the keys. Each ID is only
+    # kept in the table it identifies.
+    # 'first_keys' optionally gives the first key of some keys, e.g.
+    # {'order_key': 1000}, for tables built in parts with their own
+    # categories. Missing IDs keep the key -1.
+    first_keys = first_keys or {}
+
+    def keys(ids, key):
+        codes = ids.cat.codes.astype('int32')
+        return codes.where(codes < 0, codes + first_keys.get(key, 0))
+
+    customers = customers.assign(
+        customer_key=keys(customers['customer_id'], 'customer_key'))
+    products = products.assign(
+        product_key=keys(products['product_id'], 'product_key'))
+    sellers = sellers.assign(
+        seller_key=keys(sellers['seller_id'], 'seller_key'))
+
+    orders = orders.assign(order_key=keys(orders['order_id'], 'order_key'),
+                           customer_key=keys(orders['customer_id'],
+                                             'customer_key'))\
+                   .drop(columns=['customer_id'])
+    order_items = order_items.assign(
+        order_key=keys(order_items['order_id'], 'order_key'),
+        product_key=keys(order_items['product_id'], 'product_key'),
+        seller_key=keys(order_items['seller_id'], 'seller_key'))\
+        .drop(columns=['order_id', 'product_id', 'seller_id'])
+    order_payments = order_payments.assign(
+        order_key=keys(order_payments['order_id'], 'order_key'))\
+        .drop(columns=['order_id'])
+    order_reviews = order_reviews.assign(
+        order_key=keys(order_reviews['order_id'], 'order_key'))\
+        .drop(columns=['order_id'])
+
+    # An order can have several reviews, its score is their average
+    review_score = order_reviews.groupby('order_key')['review_score'].mean()
+    orders['review_score'] = orders['order_key'].map(review_score)
+
+    tables = {'customers': customers, 'products': products,
+              'sellers': sellers, 'orders': orders,
+              'order_items': order_items, 'order_payments': order_payments,
+              'order_reviews': order_reviews}
+    return tables
+
+def join_purchases(tables, columns, items=None):
+    # Returns one row per order item with the requested columns, joining
+    # only the tables that hold them
+    # 'items' optionally selects the order items, e.g. a boolean mask
+    order_items = tables['order_items']
+    if items is not None:
+        order_items = order_items[items]
+
+    purchases = order_items[['order_key', 'product_key', 'seller_key']]
+    item_columns = [column for column in columns
+                    if column in order_items.columns and
+                    column not in purchases.columns]
+    purchases = purchases.join(order_items[item_columns])
+
+    # Customers are joined through their orders
+    customer_columns = _table_columns(tables['customers'], columns,
+                                      purchases.columns)
+    order_columns = _table_columns(tables['orders'], columns,
+                                   purchases.columns)
+    if customer_columns:
+        order_columns.append('customer_key')
+    purchases = _join_table(purchases, tables['orders'], 'order_key',
+                            order_columns)
+    purchases = _join_table(purchases, tables['customers'], 'customer_key',
+                            customer_columns)
+
+    for name, key in [('products', 'product_key'), ('sellers', 'seller_key')]:
+        purchases = _join_table(purchases, tables[name], key,
+                                _table_columns(tables[name], columns,
+                                               purchases.columns))
+
+    return purchases[columns]
+
+def _table_columns(table, columns, joined_columns):
+    return [column for column in columns
+            if column in table.columns and column not in joined_columns]
+
+def _join_table(data, table, key, columns):
+    if not columns:
+        return data
+    return data.merge(table[[key] + columns], on=key, how='left')
+
+def append_to_star_schema(tables, customers=None, orders=None,
+                          order_items=None, order_payments=None,
+                          order_reviews=None, products=None, sellers=None):
+    # Appends a batch of new raw rows to the tables from build_star_schema.
+    # Known IDs keep their surrogate keys, new ones get the next free keys.
+    # Returns the updated tables and the keys of the orders the batch touched.
+    tables = dict(tables)
+    for name, id_column, key, rows in [
+            ('customers', 'customer_id', 'customer_key', customers),
+            ('products', 'product_id', 'product_key', products),
+            ('sellers', 'seller_id', 'seller_key', sellers)]:
+        if rows is not None:
+            tables[name] = _append_dimension(tables[name], rows, id_column,
+                                             key, _next_key(tables, key))
+
+    affected_orders = []
+    if orders is not None:
+        orders = orders.assign(
+            customer_key=_lookup_keys(tables['customers'], 'customer_id',
+                                      'customer_key', orders['customer_id']))
+        orders = orders.drop(columns=['customer_id'])
+        tables['orders'] = _append_dimension(tables['orders'], orders,
+                                             'order_id', 'order_key',
+                                             _next_key(tables, 'order_key'))
+        affected_orders.append(
+            _lookup_keys(tables['orders'], 'order_id', 'order_key',
+                         orders['order_id']))
+
+    for name, rows in [('order_items', order_items),
+                       ('order_payments', order_payments),
+                       ('order_reviews', order_reviews)]:
+        if rows is None:
+            continue
+        rows = rows.assign(order_key=_lookup_keys(tables['orders'],
+                                                  'order_id', 'order_key',
+                                                  rows['order_id']))
+        if name == 'order_items':
+            rows = rows.assign(
+                product_key=_lookup_keys(tables['products'], 'product_id',
+                                         'product_key', rows['product_id']),
+                seller_key=_lookup_keys(tables['sellers'], 'seller_id',
+                                        'seller_key', rows['seller_id']))
+            rows = rows.drop(columns=['product_id', 'seller_id'])
+        rows = rows.drop(columns=['order_id'])
+        tables[name] = _append_rows(tables[name], rows)
+        affected_orders.append(rows['order_key'].values)
+
+    affected_orders = np.unique(np.concatenate(affected_orders)) \
+                      if affected_orders else np.array([], dtype='int32')
+
+    # Review scores of the touched orders are averaged again
+    orders = tables['orders']
+    reviews = tables['order_reviews']
+    review_score = reviews[reviews['order_key'].isin(affected_orders)]\
+                       .groupby('order_key')['review_score'].mean()
+    touched = orders['order_key'].isin(affected_orders)
+    orders.loc[touched, 'review_score'] = \
+        orders.loc[touched, 'order_key'].map(review_score).values
+
+    return tables, affected_orders
+
+def get_affected_keys(tables, order_keys):
+    # Returns what a change to the given orders affects: the products in
+    # those orders, the customers (unique ids) who placed them and all the
+    # orders of these customers
+    orders = tables['orders']
+    customers = tables['customers']
+    items = tables['order_items']
+
+    product_keys = \
+        items.loc[items['order_key'].isin(order_keys), 'product_key'].unique()
+    customer_keys = \
+        orders.loc[orders['order_key'].isin(order_keys), 'customer_key']
+    unique_customers = \
+        customers.loc[customers['customer_key'].isin(customer_keys),
+                      'customer_unique_id'].unique()
+    # A customer can have several customer ids, one per order
+    customer_keys = \
+        customers.loc[customers['customer_unique_id'].isin(unique_customers),
+                      'customer_key']
+    customer_orders = \
+        orders.loc[orders['customer_key'].isin(customer_keys), 'order_key']\
+              .values
+
+    return product_keys, np.asarray(unique_customers), customer_orders
+
+def _next_key(tables, key):
+    # Rows of IDs missing from their dimension table keep the keys they were
+    # given, so new keys start above the keys of every table
+    keys = [table[key].max() for table in tables.values()
+            if key in table.columns and len(table)]
+    return max(max(keys) + 1, 0) if keys else 0
+
+def _append_dimension(table, rows, id_column, key, first_key):
+    rows = rows[~rows[id_column].isin(table[id_column])]\
+               .drop_duplicates(subset=[id_column])
+    rows = rows.assign(**{key: np.arange(first_key, first_key + len(rows),
+                                         dtype='int32')})
+    return _append_rows(table, rows)
+
+def _lookup_keys(table, id_column, key, ids):
+    # Maps IDs to their surrogate keys, -1 for unknown IDs
+    keys = pd.Series(table[key].values,
+                     index=table[id_column].astype(object).values)
+    return ids.astype(object).map(keys).fillna(-1).astype('int32').values
 
-def _join_coordinates(data, geolocation, left_on, new_column_prefix,
-                      right_on='geolocation_zip_code_prefix'):
-    geolocation = geolocation[[right_on, 'geolocation_lat', 'geolocation_lng']]
-    data = data.merge(geolocation, left_on=left_on, right_on=right_on, 
-                      how='left')
-    
-    for column in ['geolocation_lat', 'geolocation_lng']:
-        data.rename(columns={column: new_column_prefix + '_' + column},
-                    inplace=True)
+def _append_rows(table, rows):
+    # Appends rows with the table's columns, extending categorical columns
+    # with new categories after the existing ones so their codes stay valid
+    rows = rows.reindex(columns=table.columns)
+    table = table.copy()
+    for column in table.columns:
+        if isinstance(table[column].dtype, pd.CategoricalDtype):
+            categories = union_categoricals(
+                [table[column], rows[column].astype('category')],
+                ignore_order=True).categories
+            dtype = pd.CategoricalDtype(categories)
+            table[column] = table[column].astype(dtype)
+            rows[column] = rows[column].astype(dtype)
+        else:
+            rows[column] = rows[column].astype(table[column].dtype,
+                                               errors='ignore')
+    return pd.concat([table, rows], ignore_index=True)
+
+def aggregate_geolocation(path, schema, chunksize=200000):
+    # Averages the coordinates of each zip code, streaming the file in chunks
+    # Only running sums and counts per zip code are kept, so memory is bound
+    # by the number of zip codes instead of the rows of the file
+    zip_code = 'geolocation_zip_code_prefix'
+    coordinates = ['geolocation_lat', 'geolocation_lng']
+    sums = pd.DataFrame(columns=coordinates, dtype='float64')
+    counts = pd.Series(dtype='int64')
+    for chunk in pd.read_csv(path, dtype=schema, usecols=list(schema),
+                             chunksize=chunksize):
+        grouped = chunk.astype({column: 'float64' for column in coordinates})\
+                       .groupby(zip_code)
+        sums = sums.add(grouped[coordinates].sum(), fill_value=0)
+        counts = counts.add(grouped.size(), fill_value=0)
+
+    geolocation = sums.div(counts, axis=0)\
+                      .astype({column: schema[column] for column in coordinates})
+    geolocation.index = geolocation.index.astype(schema[zip_code])
+    geolocation.index.name = zip_code
+    return geolocation
+
+# Columns of the zip code lookup, joined as '<prefix>_<column>'
+ZIP_CODE_LOOKUP_COLUMNS = ['geolocation_lat', 'geolocation_lng',
+                           'location_cluster']
+
+def build_zip_code_lookup(geolocation):
+    # Zip code prefixes are small integers, so the geolocation is laid out as
+    # an array with one row per prefix (lat, lng, cluster). Prefixes without
+    # geolocation are NaN.
+    zip_codes = geolocation['geolocation_zip_code_prefix'].values
+    lookup = np.full((zip_codes.max() + 1, len(ZIP_CODE_LOOKUP_COLUMNS)),
+                     np.nan)
+    lookup[zip_codes] = geolocation[ZIP_CODE_LOOKUP_COLUMNS].values
+    return lookup
+
+def join_geolocation(data, zip_code_lookup):
+    # Joins coordinates and location cluster for the customer and/or seller
+    # zip codes in the data, with one gather from the lookup per side
+    data = data.copy()
+    for prefix in ['customer', 'seller']:
+        zip_code = prefix + '_zip_code_prefix'
+        if zip_code not in data.columns:
+            continue
+
+        zip_codes = data[zip_code].values
+        known = (zip_codes >= 0) & (zip_codes < len(zip_code_lookup))
+        rows = zip_code_lookup[np.where(known, zip_codes, 0)]
+        rows[~known] = np.nan
+
+        data[prefix + '_geolocation_lat'] = rows[:, 0].astype('float32')
+        data[prefix + '_geolocation_lng'] = rows[:, 1].astype('float32')
+        data[prefix + '_location_cluster'] = rows[:, 2]
 
     return data
 
 def prepare_product_recommendation_tables(data):
     # Runs processing for different averages/counts for product recommendation
     # then saves the result.
-    avg_score = prepare_avg_score_per_product(data)
+    with stage('avg_score_per_product'):
+        avg_score = prepare_avg_score_per_product(data)
+    with stage('category_product_index'):
+        category_top_products, category_cluster_top_products = \
+            prepare_category_product_index(data, avg_score)
+    with stage('customer_location_index'):
+        customer_location_index = prepare_customer_location_index(data)
+    with stage('product_statistics'):
+        buyer_statistics, product_statistics, product_cluster_statistics = \
+            prepare_product_statistics(data)
 
-    product_recommendation_data_dict = {'avg_score_per_product': avg_score}
+    product_recommendation_data_dict = \
+        {'avg_score_per_product': avg_score,
+         'category_top_products': category_top_products,
+         'category_cluster_top_products': category_cluster_top_products,
+         'customer_location_index': customer_location_index,
+         'product_buyer_statistics': buyer_statistics,
+         'product_statistics': product_statistics,
+         'product_cluster_statistics': product_cluster_statistics}
 
     return product_recommendation_data_dict
 
+def update_product_recommendation_tables(rec_tables, data):
+    # Recomputes the recommendation tables for the products in 'data', which
+    # has to hold all the purchases of these products, and replaces their
+    # entries. Other products are left untouched.
+    new_tables = prepare_product_recommendation_tables(data)
+    products = data['product_id'].dropna().astype(object).unique()
+    rec_tables = dict(rec_tables)
+
+    for name in ['avg_score_per_product', 'product_statistics',
+                 'product_buyer_statistics', 'product_cluster_statistics']:
+        table = rec_tables[name]
+        kept = ~table.index.get_level_values(0).isin(products)
+        rec_tables[name] = pd.concat([table[kept], new_tables[name]])
+    for name in ['product_buyer_statistics', 'product_cluster_statistics']:
+        rec_tables[name] = rec_tables[name].sort_index()
+
+    for name in ['category_top_products', 'category_cluster_top_products']:
+        rankings = dict(rec_tables[name])
+        for key, ranking in new_tables[name].items():
+            if key in rankings:
+                existing = rankings[key]
+                existing = existing[~existing['product_id'].isin(products)]
+                ranking = pd.concat([existing, ranking])\
+                            .sort_values(by='review_score', ascending=False,
+                                         kind='mergesort')\
+                            .reset_index(drop=True)
+            rankings[key] = ranking
+        rec_tables[name] = rankings
+
+    rec_tables['customer_location_index'] = \
+        update_customer_location_index(rec_tables['customer_location_index'],
+                                       new_tables['customer_location_index'])
+
+    return rec_tables
+
+def update_customer_location_index(location_index, new_index):
+    # Products in 'new_index' replace their entries in 'location_index'
+    # The buyers of the other products are compacted to the front of the
+    # arrays and the new buyers appended after them, so the index holds only
+    # live slices, as if it was built again from scratch
+    kept = [(product, offset) for product, offset
+            in location_index['offsets'].items()
+            if product not in new_index['offsets']]
+    starts = np.array([start for _, (start, _, _) in kept], dtype=np.int64)
+    ends = np.array([end for _, (_, _, end) in kept], dtype=np.int64)
+    rows = _concatenate_ranges(starts, ends)
+    new_starts = np.cumsum(ends - starts) - (ends - starts)
+
+    offsets = {}
+    for (product, (start, located_end, end)), new_start in zip(kept,
+                                                               new_starts):
+        offsets[product] = (new_start, new_start + located_end - start,
+                            new_start + end - start)
+    shift = len(rows)
+    for product, (start, located_end, end) in new_index['offsets'].items():
+        offsets[product] = (start + shift, located_end + shift, end + shift)
+
+    trees = {product: tree for product, tree
+             in location_index['trees'].items()
+             if product not in new_index['offsets']}
+    trees.update(new_index['trees'])
+
+    customers = location_index['customers'][rows]
+    coordinates = location_index['coordinates'][rows]
+    location_index = {'customers': np.concatenate((customers,
+                                                   new_index['customers'])),
+                      'coordinates': np.concatenate((coordinates,
+                                                     new_index['coordinates'])),
+                      'offsets': offsets, 'trees': trees}
+    return location_index
+
+# Columns of the serving buyer statistics, see prepare_serving_product_tables
+BUYER_STATISTICS = ['price_sum', 'price_count', 'freight_value_sum',
+                    'freight_value_count', 'delivery_days_sum',
+                    'delivery_days_count']
+
+def prepare_serving_product_tables(rec_tables):
+    # The customer location index and the product statistics as numeric
+    # arrays, which the serving bundle stores as .npy files that predictors
+    # memory-map. Products and customers are integer codes into the sorted
+    # 'product_ids' and 'customer_ids'.
+    # The buyers of a product are the rows start:end of the buyer arrays in
+    # its 'product_buyer_offsets' (start, located_end, end), as in the
+    # location index, and each buyer row holds its BUYER_STATISTICS.
+    # Product cluster averages are found by their key, cluster times the
+    # number of products plus product code. The ball trees stay pickled, by
+    # product code.
+    location_index = rec_tables['customer_location_index']
+    product_statistics = rec_tables['product_statistics']
+    cluster_statistics = rec_tables['product_cluster_statistics']
+    product_ids = np.union1d(
+        np.asarray(list(location_index['offsets']), dtype=str),
+        product_statistics.index.to_numpy(dtype=str))
+
+    # Buyers are gathered in product order, products without any get an
+    # empty range
+    offsets = np.array([location_index['offsets'].get(product, (0, 0, 0))
+                        for product in product_ids],
+                       dtype=np.int64).reshape(-1, 3)
+    lengths = offsets[:, 2] - offsets[:, 0]
+    rows = _concatenate_ranges(offsets[:, 0], offsets[:, 2])
+    new_starts = np.cumsum(lengths) - lengths
+    offsets = offsets - offsets[:, [0]] + new_starts[:, None]
+
+    customers = location_index['customers'][rows]
+    buyer_customers, customer_ids = pd.factorize(customers, sort=True)
+    buyer_index = pd.MultiIndex.from_arrays([np.repeat(product_ids.astype(object),
+                                                       lengths),
+                                             customers])
+    buyer_statistics = rec_tables['product_buyer_statistics']\
+                           .reindex(buyer_index)[BUYER_STATISTICS]
+
+    cluster_products = np.searchsorted(
+        product_ids,
+        cluster_statistics.index.get_level_values(0).to_numpy(dtype=str))
+    # Location clusters are whole numbers
+    cluster_keys = cluster_statistics.index.get_level_values(1)\
+                                           .to_numpy(dtype=np.int64) * \
+                   len(product_ids) + cluster_products
+    cluster_order = np.argsort(cluster_keys, kind='mergesort')
+
+    trees = {int(np.searchsorted(product_ids, product)): tree
+             for product, tree in location_index['trees'].items()}
+
+    serving_tables = \
+        {'product_ids': product_ids,
+         'product_buyer_offsets': offsets,
+         'product_buyer_trees': trees,
+         'product_statistics': product_statistics.reindex(product_ids)\
+                                   [PRODUCT_VALUES].to_numpy(dtype=float),
+         'product_cluster_keys': cluster_keys[cluster_order],
+         'product_cluster_statistics':
+             cluster_statistics[PRODUCT_VALUES].to_numpy(dtype=float)\
+                 [cluster_order],
+         'customer_ids': np.asarray(customer_ids, dtype=str),
+         'buyer_customers': buyer_customers.astype(np.int64),
+         'buyer_coordinates': location_index['coordinates'][rows],
+         'buyer_statistics': buyer_statistics.to_numpy(dtype=float)}
+    return serving_tables
+
 def prepare_avg_score_per_product(data):
     # Calculate the average review score for each product id
-    avg_score = data.groupby('product_id').agg('mean')[['review_score']]
+    avg_score = data.groupby('product_id', observed=True)[['review_score']]\
+                    .mean()
+    avg_score.index = avg_score.index.astype(object)
     avg_score['product_id'] = avg_score.index
     return avg_score
 
+def prepare_category_product_index(data, avg_score):
+    # Ranks the products of each category by average review score, once over
+    # all customers and once per customer location cluster (products bought
+    # by customers in that cluster).
+    # Each ranking also holds the product's only buyer, if it has exactly
+    # one, so that customer's own purchase can be left out at lookup time.
+    return rank_category_products(_count_product_buyers(data),
+                                  _get_cluster_products(data), avg_score)
+
+def _count_product_buyers(data):
+    # One row per product with its category, number of distinct buyers and
+    # first buyer
+    columns = ['product_category_name', 'product_id', 'customer_unique_id']
+    products = data.loc[data['product_id'].notna(), columns].drop_duplicates()
+    # Every product belongs to one category, so after dropping duplicates
+    # there is one row per distinct buyer of a product
+    buyer_count = products.groupby('product_id', observed=True)['product_id']\
+                          .transform('size')
+    return products.assign(buyer_count=buyer_count.values)\
+                   .drop_duplicates(subset=['product_id'])
+
+def _get_cluster_products(data):
+    # Distinct products bought in each customer location cluster
+    return data.loc[data['product_id'].notna(),
+                    ['customer_location_cluster', 'product_id']]\
+               .dropna()\
+               .drop_duplicates()
+
+def rank_category_products(products, cluster_products, avg_score):
+    # Rankings of prepare_category_product_index, from the buyer counts of
+    # the products and the products bought in each location cluster
+    sole_buyer = \
+        products['customer_unique_id'].where(products['buyer_count'] == 1)
+    products = products[['product_category_name', 'product_id']].copy()
+    # Lookups are done with plain strings, not categories
+    products['product_id'] = products['product_id'].astype(object)
+    products['sole_buyer'] = sole_buyer.astype(object)
+
+    scores = avg_score.reset_index(drop=True)
+    ranked = products.merge(scores, on='product_id')\
+                     .sort_values(by='review_score', ascending=False,
+                                  kind='mergesort')
+    ranked_columns = ['product_id', 'review_score', 'sole_buyer']
+    category_top_products = \
+        {category: products[ranked_columns].reset_index(drop=True)
+         for category, products in ranked.groupby('product_category_name',
+                                                  observed=True, sort=False)}
+
+    cluster_products = \
+        cluster_products.merge(ranked, on='product_id')\
+                        .sort_values(by='review_score', ascending=False,
+                                     kind='mergesort')
+    category_cluster_top_products = \
+        {key: products[ranked_columns].reset_index(drop=True)
+         for key, products in cluster_products.groupby(
+             ['product_category_name', 'customer_location_cluster'],
+             observed=True, sort=False)}
+
+    return category_top_products, category_cluster_top_products
+
+def prepare_product_statistics(data):
+    # Price, freight and delivery time (in days) statistics for estimating the
+    # expected values of a recommended product.
+    # Per product and buyer, sums and counts are kept so the estimate for any
+    # group of buyers (e.g. the closest customers) can be added up from them.
+    # Per product and per product and customer location cluster, the means
+    # are kept directly.
+    data = _get_product_values(data)
+    buyer_statistics = \
+        _sum_product_values(data, ['product_id', 'customer_unique_id'])
+
+    product_statistics = data.groupby('product_id')[PRODUCT_VALUES].mean()
+    product_cluster_statistics = \
+        data.groupby(['product_id', 'customer_location_cluster'])\
+            [PRODUCT_VALUES].mean()
+
+    return buyer_statistics, product_statistics, product_cluster_statistics
+
+# Values estimated for a recommended product
+PRODUCT_VALUES = ['price', 'freight_value', 'delivery_days']
+
+def _get_product_values(data):
+    # Dates are parsed when the raw data is loaded
+    purchase_time = 'order_purchase_timestamp'
+    delivery_time = 'order_delivered_customer_date'
+
+    data = data.loc[data['product_id'].notna(),
+                    ['product_id', 'customer_unique_id',
+                     'customer_location_cluster', 'price', 'freight_value',
+                     purchase_time, delivery_time]]
+    # Lookups are done with plain strings, not categories
+    data['product_id'] = data['product_id'].astype(object)
+    data['customer_unique_id'] = data['customer_unique_id'].astype(object)
+    data['delivery_days'] = \
+        (data[delivery_time] - data[purchase_time]) / pd.Timedelta(days=1)
+    return data
+
+def _sum_product_values(data, by):
+    # Sums and counts of the product values per group, as '<value>_sum' and
+    # '<value>_count' columns
+    statistics = data.groupby(by)[PRODUCT_VALUES].agg(['sum', 'count'])
+    statistics.columns = [value + '_' + statistic for value, statistic
+                          in statistics.columns]
+    return statistics
+
+def _average_product_values(statistics):
+    # Means of the product values from their sums and counts, in the type of
+    # the values
+    means = {}
+    for value in PRODUCT_VALUES:
+        sums = statistics[value + '_sum']
+        means[value] = (sums / statistics[value + '_count']).astype(sums.dtype)
+    return pd.DataFrame(means)
+
+def summarize_product_purchases(data):
+    # Partial product recommendation tables of one shard of the purchases,
+    # as sums and counts per product that merge_product_summaries adds up
+    # over shards. The rows per product and buyer are kept apart, see
+    # summarize_product_buyers.
+    product_values = _get_product_values(data)
+    reviews = data.loc[data['product_id'].notna(),
+                       ['product_id', 'review_score']]
+    # The first buyer is kept as a plain string, not with the categories of
+    # all the shard's customers
+    product_buyers = _count_product_buyers(data)\
+                         .astype({'customer_unique_id': object})
+    summary = {'review_sums':
+                   reviews.groupby('product_id', observed=True)\
+                          ['review_score'].agg(['sum', 'count']),
+               'product_buyers': product_buyers,
+               'cluster_products': _get_cluster_products(data),
+               'product_sums':
+                   _sum_product_values(product_values, ['product_id']),
+               'cluster_sums':
+                   _sum_product_values(product_values,
+                                       ['product_id',
+                                        'customer_location_cluster'])}
+    summary['review_sums'].index = summary['review_sums'].index.astype(object)
+    return summary
+
+def merge_product_summaries(summaries):
+    # Merges the summaries of several shards into one of the same form, so
+    # the shards can be added one at a time
+    review_sums = pd.concat([summary['review_sums'] for summary in summaries])\
+                    .groupby(level=0).sum()
+
+    products = concatenate_partitions(summary['product_buyers']
+                                      for summary in summaries)
+    buyer_count = products.groupby('product_id', observed=True)['buyer_count']\
+                          .transform('sum')
+    products = products.assign(buyer_count=buyer_count.values)\
+                       .drop_duplicates(subset=['product_id'])
+    cluster_products = \
+        concatenate_partitions(summary['cluster_products']
+                               for summary in summaries).drop_duplicates()
+    product_sums = pd.concat([summary['product_sums']
+                              for summary in summaries])\
+                     .groupby(level=0).sum()
+    cluster_sums = pd.concat([summary['cluster_sums']
+                              for summary in summaries])\
+                     .groupby(level=[0, 1]).sum()
+
+    summary = {'review_sums': review_sums, 'product_buyers': products,
+               'cluster_products': cluster_products,
+               'product_sums': product_sums, 'cluster_sums': cluster_sums}
+    return summary
+
+def summarize_product_buyers(data):
+    # Rows per product and buyer of one shard of the purchases: the buyers'
+    # locations and the sums and counts of their product values, as tables
+    # with an ID column for each. Shards hold disjoint customers, so these
+    # rows are only concatenated over shards.
+    lat_lng = ['customer_geolocation_lat', 'customer_geolocation_lng']
+    buyer_locations = \
+        data.loc[data['product_id'].notna() &
+                 data['customer_unique_id'].notna(),
+                 ['product_id', 'customer_unique_id'] + lat_lng]\
+            .drop_duplicates(subset=['product_id', 'customer_unique_id'])
+    buyer_statistics = \
+        _sum_product_values(_get_product_values(data),
+                            ['product_id', 'customer_unique_id'])
+    buyer_tables = {'buyer_locations': buyer_locations,
+                    'buyer_statistics': buyer_statistics.reset_index()}
+    return buyer_tables
+
+def combine_product_summaries(summary, buyer_locations, buyer_statistics):
+    # Product recommendation tables, as from
+    # prepare_product_recommendation_tables, from the merged summary and the
+    # buyer tables of all shards of the purchases
+    review_sums = summary['review_sums']
+    avg_score = (review_sums['sum'] / review_sums['count'])\
+                    .to_frame('review_score')
+    avg_score.index.name = 'product_id'
+    avg_score['product_id'] = avg_score.index
+
+    category_top_products, category_cluster_top_products = \
+        rank_category_products(summary['product_buyers'],
+                               summary['cluster_products'], avg_score)
+
+    customer_location_index = prepare_customer_location_index(buyer_locations)
+
+    # Lookups are done with plain strings, not categories
+    ids = ['product_id', 'customer_unique_id']
+    buyer_statistics = buyer_statistics.astype({column: object
+                                                for column in ids})\
+                                       .set_index(ids).sort_index()
+    product_statistics = _average_product_values(summary['product_sums'])
+    product_cluster_statistics = \
+        _average_product_values(summary['cluster_sums'])
+
+    product_recommendation_data_dict = \
+        {'avg_score_per_product': avg_score,
+         'category_top_products': category_top_products,
+         'category_cluster_top_products': category_cluster_top_products,
+         'customer_location_index': customer_location_index,
+         'product_buyer_statistics': buyer_statistics,
+         'product_statistics': product_statistics,
+         'product_cluster_statistics': product_cluster_statistics}
+
+    return product_recommendation_data_dict
+
+def prepare_customer_location_index(data, leaf_size=40):
+    # Spatial index of the buyers of each product, used to find the closest
+    # customers who bought a product.
+    # Buyers are stored sorted by product, with the ones that have coordinates
+    # first. Coordinates are kept in radians for haversine distances.
+    # Products with more than 'leaf_size' located buyers get their own
+    # ball tree, smaller ones are searched directly.
+    lat_lng = ['customer_geolocation_lat', 'customer_geolocation_lng']
+    buyers = data.loc[data['product_id'].notna() &
+                      data['customer_unique_id'].notna(),
+                      ['product_id', 'customer_unique_id'] + lat_lng]\
+                 .drop_duplicates(subset=['product_id', 'customer_unique_id'])
+    buyers['unlocated'] = buyers[lat_lng].isna().any(axis=1)
+    buyers = buyers.sort_values(by=['product_id', 'unlocated'],
+                                kind='mergesort')
+
+    products = buyers['product_id'].to_numpy(dtype=object)
+    customers = buyers['customer_unique_id'].to_numpy(dtype=object)
+    coordinates = np.radians(buyers[lat_lng].values.astype(float))
+    located_count = np.cumsum(~buyers['unlocated'].values)
+    located_count = np.concatenate(([0], located_count))
+
+    starts = np.flatnonzero(np.concatenate(([True],
+                                            products[1:] != products[:-1])))
+    ends = np.append(starts[1:], len(products))
+
+    offsets = {}
+    trees = {}
+    for product, start, end in zip(products[starts], starts, ends):
+        located_end = start + located_count[end] - located_count[start]
+        offsets[product] = (start, located_end, end)
+        if located_end - start > leaf_size:
+            trees[product] = BallTree(coordinates[start:located_end],
+                                      leaf_size=leaf_size,
+                                      metric='haversine')
+
+    location_index = {'customers': customers, 'coordinates': coordinates,
+                      'offsets': offsets, 'trees': trees}
+    return location_index
+
 def prepare_orders_by_sellers(data):
     # Get number of orders per seller
     count_order_by_seller = data.groupby('seller_id').agg('count')['order_id']
@@ -1,25 +1,37 @@
+import numpy as np
+from joblib import Parallel, delayed
 from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import (cross_val_score, RepeatedStratifiedKFold)
-from sklearn.cluster import KMeans
+from sklearn.model_selection import RepeatedStratifiedKFold
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
 def evaluate_model_with_cv(X, y, config):
+    # Cross-validates the regularization path of the model
+    # Every fold is a job in one worker pool. A fold fits the penalties from
+    # the strongest regularization to the weakest, each fit warm-started from
+    # the coefficients of the previous one, and stops its path once a penalty
+    # scores more than 'early_stopping_tolerance' below its best one.
+    # The data is memory-mapped to the workers rather than copied to each,
+    # only the fold indices are sent per job.
     config = config['control']
-    models = {}
-    for penalty in config['regularization_penalties']:
-        models[penalty] = \
-            LogisticRegression(multi_class='multinomial', solver='lbfgs',
-                               penalty='l2', C=penalty)
+    penalties = sorted(config['regularization_penalties'])
 
     cross_validation = \
         RepeatedStratifiedKFold(n_splits=config['cv_folds'],
                                 n_repeats=config['cv_repeats'],
                                 random_state=config['random_state'])
     
-    cv_scores = {}
     print(f'{" Running cross-validation ":#^100}')
-    for penalty, model in models.items():
-        cv_score = cross_val_score(model, X, y, scoring='accuracy', 
-                                   cv=cross_validation, n_jobs=-1)
+    fold_scores = \
+        Parallel(n_jobs=config['cv_jobs'])(
+            delayed(_score_regularization_path)(
+                X, y, train, test, penalties,
+                config['early_stopping_tolerance'])
+            for train, test in cross_validation.split(X, y))
+
+    cv_scores = {}
+    for penalty in penalties:
+        cv_score = np.array([scores[penalty] for scores in fold_scores
+                             if penalty in scores])
         print(f'CV Score for model with l2 penalty = {penalty}\n'
               f'{cv_score}')
 
@@ -27,14 +39,182 @@ def evaluate_model_with_cv(X, y, config):
 
     return cv_scores
 
-def train_model(X, y):
+def _score_regularization_path(X, y, train, test, penalties, tolerance):
+    # Accuracy on the test fold for each penalty on the path until it stops
+    model = LogisticRegression(multi_class='multinomial', solver='lbfgs',
+                               penalty='l2', warm_start=True)
+    X_train, y_train = X[train], y[train]
+    X_test, y_test = X[test], y[test]
+
+    scores = {}
+    best_score = -np.inf
+    for penalty in penalties:
+        model.set_params(C=penalty)
+        model.fit(X_train, y_train)
+        scores[penalty] = model.score(X_test, y_test)
+
+        best_score = max(best_score, scores[penalty])
+        if scores[penalty] < best_score - tolerance:
+            break
+
+    return scores
+
+def select_penalty(cv_scores):
+    # Returns the penalty with the best mean score, out of the ones that were
+    # scored on every fold
+    folds = max(len(cv_score) for cv_score in cv_scores.values())
+    mean_scores = {penalty: cv_score.mean()
+                   for penalty, cv_score in cv_scores.items()
+                   if len(cv_score) == folds}
+
+    return max(mean_scores, key=mean_scores.get)
+
+def train_model(X, y, penalty=1.0):
     model = LogisticRegression(multi_class='multinomial',
-                               solver='lbfgs')
+                               solver='lbfgs', C=penalty)
     model.fit(X, y)
 
     return model
 
+class IncrementalLogisticRegression():
+    # Multinomial logistic regression trained with mini-batch SGD, so a
+    # trained model can be updated with new rows only (partial_fit).
+    # Labels not seen before get a new class with zero coefficients.
+    # It has the coef_, intercept_ and classes_ of the sklearn model, and
+    # starts from a trained one with to_incremental_model.
+    def __init__(self, learning_rate=0.05, epochs=5, batch_size=64,
+                 alpha=1e-3, random_state=None):
+        # 'alpha' is the l2 penalty per row
+        self.learning_rate = learning_rate
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.alpha = alpha
+        self.random_generator = np.random.default_rng(random_state)
+        self.coef_ = None
+        self.intercept_ = None
+        self.classes_ = None
+
+    def partial_fit(self, X, y):
+        if self.coef_ is None:
+            self.coef_ = np.zeros((0, X.shape[1]))
+            self.intercept_ = np.zeros(0)
+            self.classes_ = np.zeros(0)
+        self._add_classes(y)
+        class_order = np.argsort(self.classes_)
+        targets = class_order[np.searchsorted(self.classes_, y,
+                                              sorter=class_order)]
+
+        for _ in range(self.epochs):
+            rows = self.random_generator.permutation(X.shape[0])
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                self._step(X[batch], targets[batch])
+        return self
+
+    def _add_classes(self, y):
+        new_classes = np.setdiff1d(np.unique(y), self.classes_)
+        if len(new_classes) == 0:
+            return
+        self.classes_ = np.concatenate((self.classes_, new_classes))
+        self.coef_ = np.vstack((self.coef_,
+                                np.zeros((len(new_classes),
+                                          self.coef_.shape[1]))))
+        self.intercept_ = np.concatenate((self.intercept_,
+                                          np.zeros(len(new_classes))))
+
+    def _step(self, X, targets):
+        # Gradient of the mean cross-entropy plus the l2 penalty
+        errors = self.predict_proba(X)
+        errors[np.arange(len(targets)), targets] -= 1
+        gradient = np.asarray(X.T @ errors).T / len(targets)
+        self.coef_ -= self.learning_rate * (gradient + self.alpha * self.coef_)
+        self.intercept_ -= self.learning_rate * errors.mean(axis=0)
+
+    def decision_function(self, X):
+        return np.asarray(X @ self.coef_.T) + self.intercept_
+
+    def predict_proba(self, X):
+        scores = self.decision_function(X)
+        probabilities = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, X):
+        return self.classes_[self.decision_function(X).argmax(axis=1)]
+
+    def score(self, X, y):
+        return np.mean(self.predict(X) == y)
+
+def to_incremental_model(model, **settings):
+    # An IncrementalLogisticRegression with the coefficients of a trained
+    # multinomial LogisticRegression (or incremental model), which are the
+    # same softmax parameters. 'settings' are its training settings.
+    incremental_model = IncrementalLogisticRegression(**settings)
+    coefficients, intercept = model.coef_, model.intercept_
+    if len(coefficients) == 1 and len(model.classes_) == 2:
+        # A binary model scores the second class against zero
+        coefficients = np.vstack((np.zeros_like(coefficients), coefficients))
+        intercept = np.concatenate(([0.0], intercept))
+
+    incremental_model.coef_ = coefficients.copy()
+    incremental_model.intercept_ = intercept.copy()
+    incremental_model.classes_ = model.classes_.copy()
+    return incremental_model
+
+def export_scorer(model, encoders, columns_dict):
+    # Reduces the classifier and its encoders to a compiled scorer, see
+    # logic/scoring.py. The standard scaling is folded into the numerical
+    # coefficients and the intercept, each one hot category becomes the index
+    # of its coefficient row.
+    scaler = encoders['standard_scaler']
+    one_hot_encoder = encoders['one_hot_encoder']
+    label_encoder = encoders['label_encoder']
+
+    coefficients = model.coef_.T
+    intercept = model.intercept_
+    if coefficients.shape[1] == 1:
+        # A binary model scores the second class only, it wins above zero
+        coefficients = np.hstack((np.zeros_like(coefficients), coefficients))
+        intercept = np.concatenate(([0.0], intercept))
+
+    numerical_number = len(columns_dict['numerical'])
+    numerical_coefficients = coefficients[:numerical_number]
+    numerical_weights = numerical_coefficients / scaler.scale_[:, None]
+    intercept = intercept - \
+                (scaler.mean_ / scaler.scale_) @ numerical_coefficients
+
+    # One row of zeros is appended for categories unseen in training
+    category_weights = np.vstack((coefficients[numerical_number:],
+                                  np.zeros((1, coefficients.shape[1]))))
+    category_rows = []
+    row = 0
+    for categories in one_hot_encoder.categories_:
+        rows = {}
+        for category in categories:
+            rows[None if category != category else category] = row
+            row += 1
+        category_rows.append(rows)
+
+    scorer = {'numerical': list(columns_dict['numerical']),
+              'categorical': list(columns_dict['categorical']),
+              'numerical_weights': numerical_weights,
+              'intercept': intercept,
+              'category_weights': category_weights,
+              'category_rows': category_rows,
+              'classes': np.asarray(label_encoder.classes_[
+                                        model.classes_.astype(int)],
+                                    dtype=object)}
+    return scorer
+
+def train_location_clusters(data, cluster_number=5, batch_size=1024,
+                            random_state=None):
+    # Mini-batch KMeans, seeded so the clusters are the same between runs
+    # The fitted model can assign new locations to the clusters later
+    kmeans = MiniBatchKMeans(n_clusters=cluster_number, batch_size=batch_size,
+                             random_state=random_state)
+    kmeans.fit(data)
+    return kmeans
+
 def train_kmeans(data, cluster_number=5):
     kmeans = KMeans(cluster_number)
     clusters = kmeans.fit_predict(data)
-    return clusters
\ No newline at end of file
+    return clusters
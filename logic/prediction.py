@@ -1,75 +1,154 @@
+import numpy as np
 import pandas as pd
+from sklearn.metrics.pairwise import haversine_distances
+
+from logic.data_preparation import (get_customer_purchases, PRODUCT_VALUES,
+                                    BUYER_STATISTICS)
+from utils import stage
 pd.options.mode.chained_assignment = None #TODO: Fix class with 1 sample
 
 def get_recommended_product(prediction_row, 
-                            complete_data,
                             rec_tables,
                             product_number,
-                            estimation_n):
+                            estimation_n,
+                            use_location_cluster=True,
+                            cache=None):
     # Returns recommended products and other data for one customer at a time,
     # Based on their next predicted product category
-    # Filter out the customer from the data
-    complete_data = \
-        complete_data[complete_data['customer_unique_id']!= \
-                      prediction_row['customer_unique_id']]
-    avg_score_per_product = rec_tables['avg_score_per_product']
+    # 'cache' (utils.LRUCache) keeps the parts shared by customers with the
+    # same predicted category and location cluster
+    with stage('recommendation'):
+        return _get_recommended_product(prediction_row, rec_tables,
+                                        product_number, estimation_n,
+                                        use_location_cluster, cache)
 
+def _get_recommended_product(prediction_row, rec_tables, product_number,
+                             estimation_n, use_location_cluster, cache):
     predicted_category = prediction_row['predicted_category']
+    location_cluster = prediction_row['customer_location_cluster'] \
+                       if use_location_cluster else None
+    cache_key = (predicted_category, _cluster_key(location_cluster),
+                 estimation_n)
 
-    # Get all products in category
-    # TODO: change this part to select products based on location cluster as well
-    category_products = get_products_in_category(predicted_category,
-                                                 complete_data)
+    # Get products in category, ranked by average review score
+    # Products bought by customers in the same location cluster are preferred
+    with stage('category_products'):
+        category_products = \
+            _cached(cache, ('category_products',) + cache_key,
+                    lambda: get_products_in_category(predicted_category,
+                                                     rec_tables,
+                                                     location_cluster,
+                                                     min_products=estimation_n))
     # Get best product from top n by average review score
-    top_n_products = get_top_n_products_by_score(category_products,
-                                                 avg_score_per_product,
-                                                 product_number,
-                                                 estimation_n)
+    # The customer's own purchases are left out
+    with stage('top_products'):
+        top_products = \
+            _cached(cache, ('top_products',) + cache_key,
+                    lambda: get_top_ranked_products(category_products,
+                                                    estimation_n))
+        top_n_products = get_top_n_products_by_score(category_products,
+                                                     prediction_row['customer_unique_id'],
+                                                     product_number,
+                                                     estimation_n,
+                                                     top_products=top_products)
     
     product_scores = top_n_products['review_score']
     products = top_n_products['product_id']
 
-    expected_values = get_expected_values(prediction_row, 
-                                          complete_data, 
-                                          products, n=estimation_n)
+    with stage('expected_values'):
+        expected_values = get_expected_values(prediction_row, rec_tables,
+                                              products, n=estimation_n,
+                                              cache=cache)
     
     recommendation = {'product_scores': product_scores, 'products': products,
                       'expected_values': expected_values}
 
     return recommendation
 
-def get_products_in_category(category, complete_data):
-    products = \
-        complete_data[complete_data['product_category_name']==category]
-    
-    return products.product_id.unique()
+def get_empty_recommendation():
+    # Recommendation of a customer without a predicted category
+    return {'product_scores': pd.Series(dtype=float),
+            'products': pd.Series(dtype=object), 'expected_values': {}}
+
+def get_products_in_category(category, rec_tables, location_cluster=None,
+                             min_products=0):
+    # Returns the products of a category ranked by average review score
+    # The ranking for the location cluster is used if it has at least
+    # 'min_products' products, otherwise the one for the whole category
+    if location_cluster is not None and not pd.isna(location_cluster):
+        products = rec_tables['category_cluster_top_products']\
+                       .get((category, location_cluster))
+        if products is not None and len(products) >= min_products:
+            return products
+
+    products = rec_tables['category_top_products'].get(category)
+    if products is None:
+        products = pd.DataFrame(columns=['product_id', 'review_score',
+                                         'sole_buyer'])
+    return products
+
+def get_top_ranked_products(category_products, estimation_n):
+    # The top 'estimation_n' of the ranked products, indexed by product
+    top_products = category_products.iloc[:estimation_n]
+    top_products.index = top_products['product_id'].values
+    return top_products
 
-def get_top_n_products_by_score(category_products, avg_score_per_product,
-                                product_number, estimation_n):
-    top_n_products = \
-        avg_score_per_product[avg_score_per_product['product_id']\
-                             .isin(category_products)]\
-                             .sort_values(by='review_score', ascending=False)\
-                             .iloc[:estimation_n]
+def get_top_n_products_by_score(category_products, customer,
+                                product_number, estimation_n,
+                                top_products=None):
+    # Takes the top 'estimation_n' of the ranked products that were not bought
+    # only by the customer, then samples 'product_number' of them.
+    # Only as much of the ranking is read as needed to find them.
+    # 'top_products' from get_top_ranked_products is used as is when the
+    # customer is not the sole buyer of any of them.
+    if top_products is None or (top_products['sole_buyer'] == customer).any():
+        limit = estimation_n
+        while True:
+            top_products = category_products.iloc[:limit]
+            top_products = \
+                top_products[top_products['sole_buyer'] != customer]
+            if len(top_products) >= estimation_n or \
+               limit >= len(category_products):
+                break
+            limit = 2 * limit + 1
+        top_products = get_top_ranked_products(top_products, estimation_n)
 
-    top_n_products = top_n_products.sample(n=product_number)
+    # Categories with fewer products give all of them
+    top_n_products = top_products.drop(columns=['sole_buyer'])\
+                                 .sample(n=min(product_number,
+                                               len(top_products)))
     
     return top_n_products
 
-def get_expected_values(prediction_row, complete_data, products, n=5):
+def get_expected_values(prediction_row, rec_tables, products, n=5,
+                        cache=None):
     # Calculates closest customers who bought the same product
     # Then gets estimated price, shipping cost and delivery time
-    data = \
-        get_customers_with_same_purchase(complete_data, products)
-    customers_dict = get_closest_customers(prediction_row, data, products, n=n)
+    # The fallback averages per product and location cluster are cached
+    buyers_dict = get_closest_buyers(prediction_row, rec_tables, products,
+                                     n=n)
 
     expected_values = {}
 
-    for product, customers in customers_dict.items():
-        product_data = complete_data[complete_data['product_id']==product]
-        price, shipping = estimate_price(customers, product_data)
+    for product, buyers in buyers_dict.items():
+        price, shipping = estimate_price(buyers, rec_tables)
 
-        shipping_time = estimate_shipping(customers, product_data)
+        shipping_time = estimate_shipping(buyers, rec_tables)
+
+        # Fall back on the product's averages when the closest customers
+        # have no usable data
+        if np.isnan([price, shipping, shipping_time]).any():
+            location_cluster = prediction_row['customer_location_cluster']
+            average_price, average_shipping, average_shipping_time = \
+                _cached(cache,
+                        ('averages', product, _cluster_key(location_cluster)),
+                        lambda: estimate_from_averages(product,
+                                                       location_cluster,
+                                                       rec_tables))
+            price = average_price if np.isnan(price) else price
+            shipping = average_shipping if np.isnan(shipping) else shipping
+            shipping_time = average_shipping_time if np.isnan(shipping_time)\
+                            else shipping_time
 
         expected_values_product = {'estimated_price': price,
                                    'shipping_price': shipping,
@@ -78,60 +157,308 @@ def get_expected_values(prediction_row, complete_data, products, n=5):
         expected_values[product] = expected_values_product
     return expected_values
 
-def get_closest_customers(prediction_row, data, products, n=5):
-    # Get the 'n' closest customers who bought the same product
+def get_closest_buyers(prediction_row, rec_tables, products, n=5):
+    # Get the buyer rows of the 'n' closest customers who bought the same
+    # product, see query_closest_buyers
     customer_location = prediction_row[['customer_geolocation_lat',
-                                        'customer_geolocation_lng']]
+                                        'customer_geolocation_lng']].values
     
-    customers_dict = {}
+    buyers_dict = {}
 
     for product in products:
-        current_data = data[data['product_id']==product]
-
-        location_data = current_data[['customer_unique_id',
-                            'customer_geolocation_lat',
-                            'customer_geolocation_lng']]
-        
-        location_data[['customer_geolocation_lat',
-                       'customer_geolocation_lng']] = \
-            (location_data[['customer_geolocation_lat',
-                            'customer_geolocation_lng']] - customer_location).abs()
-
-        location_data['absolute_diff'] = \
-            location_data['customer_geolocation_lat'] + \
-            location_data['customer_geolocation_lng']
-        
-        customers = location_data.sort_values(by='absolute_diff',
-                                            ascending=True)\
-                                 .iloc[:n]\
-                                 .customer_unique_id.values
-        customers_dict[product] = customers
+        buyers = \
+            query_closest_buyers(rec_tables, product, [customer_location],
+                                 n=n,
+                                 exclude=[prediction_row['customer_unique_id']])
+        buyers_dict[product] = buyers[0]
     
-    return customers_dict
+    return buyers_dict
+
+def query_closest_buyers(rec_tables, product, locations, n=5, exclude=None):
+    # Returns the 'n' closest buyers of a product for each location
+    # (latitude, longitude in degrees), by haversine distance, as their rows
+    # in the buyer arrays of the serving tables (see
+    # prepare_serving_product_tables).
+    # 'exclude' holds a customer per location to leave out of its result,
+    # e.g. the customer the recommendation is for.
+    locations = np.radians(np.asarray(locations, dtype=float).reshape(-1, 2))
+    if exclude is None:
+        excluded = np.full(len(locations), -1)
+    else:
+        excluded = get_codes(rec_tables['customer_ids'], exclude)
 
-def get_customers_with_same_purchase(complete_data, products):
-    data = complete_data[complete_data['product_id']\
-                .isin(products)]
-    return data
+    code = get_codes(rec_tables['product_ids'], [product])[0]
+    if code < 0:
+        return [np.array([], dtype=np.int64) for _ in range(len(locations))]
 
-def estimate_price(customers, complete_data):
-    # Gets the mean price and freight for a subset of customers' purchases
-    data = complete_data[complete_data['customer_unique_id'].isin(customers)]
+    start, located_end, end = rec_tables['product_buyer_offsets'][code]
+    customers = rec_tables['buyer_customers'][start:end]
+    located_number = located_end - start
+    unlocated = np.arange(located_number, end - start)
+    # One extra neighbour in case the excluded customer is among them
+    k = min(n + 1, located_number)
+    trees = rec_tables['product_buyer_trees']
 
-    mean_price = data.price.mean()
-    mean_freight = data.freight_value.mean()
+    if k == 0:
+        order = np.empty((len(locations), 0), dtype=int)
+    elif code in trees:
+        order = np.zeros((len(locations), k), dtype=int)
+        has_location = ~np.isnan(locations).any(axis=1)
+        if has_location.any():
+            _, order[has_location] = trees[code].query(locations[has_location],
+                                                       k=k)
+    else:
+        distances = \
+            haversine_distances(np.nan_to_num(locations),
+                                rec_tables['buyer_coordinates']\
+                                          [start:located_end])
+        order = np.argsort(distances, axis=1, kind='mergesort')[:, :k]
+
+    closest_buyers = []
+    for location, location_order, excluded_code in zip(locations, order,
+                                                       excluded):
+        if np.isnan(location).any():
+            # Without a location every buyer is equally close
+            location_order = np.arange(end - start)
+        else:
+            location_order = np.concatenate((location_order, unlocated))
+        location_order = \
+            location_order[customers[location_order] != excluded_code][:n]
+        closest_buyers.append(start + location_order)
+
+    return closest_buyers
+
+def get_codes(ids, values):
+    # Positions of 'values' in the sorted array 'ids', -1 for values not in it
+    values = np.asarray(values, dtype=str)
+    if len(ids) == 0:
+        return np.full(len(values), -1)
+    codes = np.minimum(np.searchsorted(ids, values), len(ids) - 1)
+    return np.where(ids[codes] == values, codes, -1)
+
+def estimate_price(buyers, rec_tables):
+    # Gets the mean price and freight for a subset of buyers of one product,
+    # from their rows of the buyer statistics
+    data = _get_buyer_statistics(buyers, rec_tables)
+
+    mean_price = _mean_from_sums(data['price_sum'], data['price_count'])
+    mean_freight = _mean_from_sums(data['freight_value_sum'],
+                                   data['freight_value_count'])
 
     return mean_price, mean_freight
 
-def estimate_shipping(customers, complete_data):
-    data = complete_data[complete_data['customer_unique_id'].isin(customers)]
-    purchase_time = 'order_purchase_timestamp'
-    delivery_time = 'order_delivered_customer_date'
-    date_format = '%Y-%m-%d %H:%M:%S'
+def estimate_shipping(buyers, rec_tables):
+    # Gets the mean delivery time in whole days for a subset of buyers of one
+    # product
+    data = _get_buyer_statistics(buyers, rec_tables)
+    days_avg = _mean_from_sums(data['delivery_days_sum'],
+                               data['delivery_days_count'])
+
+    return days_avg if np.isnan(days_avg) else int(np.floor(days_avg))
+
+def _get_buyer_statistics(buyers, rec_tables):
+    return pd.DataFrame(rec_tables['buyer_statistics'][buyers],
+                        columns=BUYER_STATISTICS)
+
+def estimate_from_averages(product, location_cluster, rec_tables):
+    # Gets the mean price, freight and delivery time of a product for customers
+    # in the same location cluster, or for all its customers if there are none
+    averages = get_product_averages(rec_tables, [product],
+                                    [location_cluster])[0]
+    price, freight, shipping_time = averages
+    if not np.isnan(shipping_time):
+        shipping_time = int(np.floor(shipping_time))
+
+    return price, freight, shipping_time
+
+def get_product_averages(rec_tables, products, location_clusters):
+    # Mean price, freight and delivery time of each product for customers in
+    # its location cluster, or for all its customers if there are none there.
+    # One row per product, NaN for unknown products.
+    product_ids = rec_tables['product_ids']
+    codes = get_codes(product_ids, products)
+    averages = np.full((len(codes), len(PRODUCT_VALUES)), np.nan)
+    known = codes >= 0
+    averages[known] = rec_tables['product_statistics'][codes[known]]
+
+    cluster_keys = rec_tables['product_cluster_keys']
+    location_clusters = np.asarray(location_clusters, dtype=float)
+    has_cluster = known & ~np.isnan(location_clusters)
+    if has_cluster.any() and len(cluster_keys) > 0:
+        keys = location_clusters[has_cluster].astype(np.int64) * \
+               len(product_ids) + codes[has_cluster]
+        positions = np.minimum(np.searchsorted(cluster_keys, keys),
+                               len(cluster_keys) - 1)
+        found = cluster_keys[positions] == keys
+        rows = np.flatnonzero(has_cluster)[found]
+        averages[rows] = \
+            rec_tables['product_cluster_statistics'][positions[found]]
+
+    return averages
+
+def _cached(cache, key, compute):
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(key, compute)
+
+def _cluster_key(location_cluster):
+    # Missing clusters share one key, NaN never equals itself
+    if location_cluster is None or pd.isna(location_cluster):
+        return None
+    return float(location_cluster)
+
+def _mean_from_sums(sums, counts):
+    count = counts.sum()
+    if count == 0:
+        return np.nan
+    return sums.sum() / count
+
+def get_latest_purchases(customer_index, customers, feature_columns):
+    # Returns the latest purchase of each customer that has all model features
+    # present, one row per customer
+    # 'customer_index' is the purchases indexed by build_customer_index, so
+    # only the rows of the given customers are read
+    # The rows are sorted by customer and time, so the latest purchase is
+    # the last row before the customer changes
+    data = get_customer_purchases(customer_index, customers)
+    data = data.dropna(subset=feature_columns)
+    codes = pd.factorize(data['customer_unique_id'])[0]
+
+    return data[np.diff(codes, append=-2) != 0]
+
+def get_recommended_products_batch(predictions,
+                                   rec_tables,
+                                   product_number,
+                                   estimation_n,
+                                   use_location_cluster=True,
+                                   random_state=None,
+                                   cache=None):
+    # Batch version of get_recommended_product
+    # Expects one row per customer with the predicted category and the
+    # customer's coordinates. Returns one row per recommended product with its
+    # review score and expected values.
+    candidates = get_top_n_products_by_category(predictions, rec_tables,
+                                                estimation_n,
+                                                use_location_cluster,
+                                                cache=cache)
+
+    # Pick 'product_number' random products from each customer's candidates
+    recommended = candidates.sample(frac=1, random_state=random_state)\
+                            .groupby('customer_unique_id', observed=True)\
+                            .head(product_number)\
+                            .sort_values(by=['customer_unique_id',
+                                             'review_score'],
+                                         ascending=[True, False])
+
+    expected_values = \
+        get_expected_values_batch(recommended, rec_tables, n=estimation_n)
+    recommended = recommended.merge(expected_values,
+                                    on=['customer_unique_id', 'product_id'],
+                                    how='left')
+
+    return recommended.reset_index(drop=True)
+
+def get_top_n_products_by_category(predictions, rec_tables, estimation_n,
+                                   use_location_cluster=True, cache=None):
+    # Returns the top 'estimation_n' products by average review score in each
+    # customer's predicted category, as one row per customer and product.
+    # Customers with the same category and location cluster share one lookup.
+    # Products bought only by the customer themselves are left out.
+    predictions = predictions[['customer_unique_id', 'predicted_category',
+                               'customer_location_cluster',
+                               'customer_geolocation_lat',
+                               'customer_geolocation_lng']]
+
+    candidates = []
+    for (category, location_cluster), customers in \
+            predictions.groupby(['predicted_category',
+                                 'customer_location_cluster'],
+                                dropna=False, observed=True, sort=False):
+        if not use_location_cluster:
+            location_cluster = None
+        products = \
+            _cached(cache, ('category_products', category,
+                            _cluster_key(location_cluster), estimation_n),
+                    lambda: get_products_in_category(category, rec_tables,
+                                                     location_cluster,
+                                                     min_products=estimation_n))
+
+        # Keep enough products to still have 'estimation_n' left after
+        # removing any customer's own products
+        own_products = products.loc[products['sole_buyer']\
+                                        .isin(customers['customer_unique_id']),
+                                    'sole_buyer']
+        max_own_products = own_products.value_counts().max() \
+                           if len(own_products) else 0
+        products = products.iloc[:estimation_n + max_own_products]
+
+        customer_products = customers.merge(products, how='cross')
+        customer_products = customer_products[
+            customer_products['sole_buyer'] != \
+            customer_products['customer_unique_id']]
+        candidates.append(customer_products.groupby('customer_unique_id',
+                                                    observed=True)\
+                                           .head(estimation_n))
+
+    if not candidates:
+        return predictions.assign(product_id=[], review_score=[])
+    candidates = pd.concat(candidates, ignore_index=True)
+
+    return candidates.drop(columns=['sole_buyer'])
+
+def get_expected_values_batch(recommended, rec_tables, n=5):
+    # Batch version of get_expected_values
+    # For every customer and recommended product, takes the 'n' closest other
+    # customers who bought the product, then estimates price, shipping cost
+    # and delivery time from their purchases
+    pair_columns = ['customer_unique_id', 'product_id']
+    estimates = [('estimated_price', 'price'),
+                 ('shipping_price', 'freight_value'),
+                 ('estimated_delivery_time', 'delivery_days')]
+
+    # Closest buyers, queried per product for all customers at once
+    closest = {'customer_unique_id': [], 'product_id': [], 'buyer': []}
+    for product, pairs in recommended.groupby('product_id', observed=True):
+        targets = pairs['customer_unique_id'].values
+        neighbours = \
+            query_closest_buyers(rec_tables, product,
+                                 pairs[['customer_geolocation_lat',
+                                        'customer_geolocation_lng']].values,
+                                 n=n, exclude=targets)
+        lengths = [len(buyers) for buyers in neighbours]
+        closest['customer_unique_id'].append(np.repeat(targets, lengths))
+        closest['product_id'].append(np.repeat(product, sum(lengths)))
+        closest['buyer'].append(np.concatenate(neighbours) if neighbours
+                                else np.array([], dtype=np.int64))
+    closest = pd.DataFrame({column: np.concatenate(values) if values else []
+                            for column, values in closest.items()})
+
+    data = pd.DataFrame(rec_tables['buyer_statistics']
+                            [closest['buyer'].values.astype(np.int64)],
+                        columns=BUYER_STATISTICS)
+    data[pair_columns] = closest[pair_columns].values
+    sums = data.groupby(pair_columns, observed=True).sum()
 
-    timedelta_avg = \
-        (pd.to_datetime(data[delivery_time], format=date_format) - \
-         pd.to_datetime(data[purchase_time], format=date_format)).mean()
+    expected_values = pd.DataFrame(index=sums.index)
+    for column, value in estimates:
+        expected_values[column] = \
+            sums[value + '_sum'] / sums[value + '_count'].replace(0, np.nan)
+    expected_values = expected_values.reset_index()
 
-    return timedelta_avg.days
+    # Fall back on the product's averages where the closest customers have no
+    # usable data, per customer location cluster first
+    expected_values = \
+        recommended[['customer_unique_id', 'product_id',
+                     'customer_location_cluster']]\
+        .merge(expected_values, on=pair_columns, how='left')
+    averages = get_product_averages(
+        rec_tables, expected_values['product_id'].values,
+        expected_values['customer_location_cluster'].values)
+    for column, value in estimates:
+        expected_values[column] = expected_values[column].fillna(
+            pd.Series(averages[:, PRODUCT_VALUES.index(value)],
+                      index=expected_values.index))
+    expected_values['estimated_delivery_time'] = \
+        np.floor(expected_values['estimated_delivery_time'])
 
+    return expected_values.drop(columns=['customer_location_cluster'])
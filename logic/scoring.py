@@ -0,0 +1,42 @@
+import numpy as np
+
+# Compiled scorer
+# The classifier and its encoders reduced to numpy arrays and dicts by
+# logic.modelling.export_scorer. A row is scored with its numerical features
+# times their coefficients, plus one gathered coefficient row per categorical
+# feature, so scoring needs neither sklearn nor an encoded feature matrix.
+
+
+def predict_categories(scorer, data):
+    # Predicted category of each row in 'data', a DataFrame or a dict of
+    # column -> values with the model features
+    # Rows with a missing numerical feature get None, as in bulk scoring,
+    # since argmax would take their NaN scores for the first class
+    scores = score_rows(scorer, data)
+    categories = scorer['classes'][scores.argmax(axis=1)].astype(object)
+    categories[np.isnan(scores).any(axis=1)] = None
+    return categories
+
+def score_rows(scorer, data):
+    # Decision function of the classifier, one row of class scores per row
+    # The scores of a row with a missing numerical feature are NaN
+    row_number = len(data[(scorer['numerical'] + scorer['categorical'])[0]])
+    numerical = np.zeros((row_number, len(scorer['numerical'])))
+    for position, column in enumerate(scorer['numerical']):
+        numerical[:, position] = np.asarray(data[column], dtype=float)
+    scores = numerical @ scorer['numerical_weights'] + scorer['intercept']
+
+    # Categories unseen in training gather the last row, which is zeros
+    category_weights = scorer['category_weights']
+    unknown_row = len(category_weights) - 1
+    for column, category_rows in zip(scorer['categorical'],
+                                     scorer['category_rows']):
+        rows = [category_rows.get(_category_key(value), unknown_row)
+                for value in data[column]]
+        scores += category_weights[rows]
+
+    return scores
+
+def _category_key(value):
+    # Missing values are one category, keyed by None
+    return None if value != value else value
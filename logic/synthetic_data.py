@@ -0,0 +1,236 @@
+import os
+import numpy as np
+import pandas as pd
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+FIRST_PURCHASE = pd.Timestamp('2016-09-04')
+LAST_PURCHASE = pd.Timestamp('2018-10-17')
+# Rough centre (lat, lng) of the zip codes by their first digit, following the
+# Brazilian postal regions (0-1 São Paulo, 2 Rio de Janeiro, ... 9 Rio Grande
+# do Sul)
+ZIP_REGION_CENTRES = np.array([(-23.5, -46.6), (-22.5, -47.5), (-22.3, -42.5),
+                               (-19.5, -44.5), (-12.5, -39.5), (-8.3, -36.5),
+                               (-3.5, -45.0), (-15.8, -49.5), (-25.5, -50.0),
+                               (-29.8, -52.5)])
+# Share of zip code popularity per first digit, São Paulo has the most orders
+ZIP_REGION_WEIGHTS = np.array([4, 3, 1.5, 1.5, 1, 1, 0.5, 1, 1.5, 1])
+# Review scores 1 to 5
+REVIEW_SCORE_PROBABILITIES = [0.11, 0.03, 0.08, 0.19, 0.59]
+PAYMENT_TYPES = ['credit_card', 'boleto', 'voucher', 'debit_card']
+PAYMENT_TYPE_PROBABILITIES = [0.74, 0.19, 0.05, 0.02]
+
+
+def generate_olist_data(path, files, scale=1, random_state=None,
+                        n_customers=9600, n_products=3300, n_sellers=310,
+                        n_zip_codes=1900, n_categories=71,
+                        geolocation_rows_per_zip=50,
+                        repeat_purchase_probability=0.03,
+                        popularity_exponent=1.1,
+                        undelivered_share=0.03):
+    # Writes CSV files shaped like the Olist dataset to 'path', named as in
+    # 'files' (the input section of the data preparation config).
+    # Customers, products, sellers and zip codes grow with 'scale', the number
+    # of categories stays the same. Scale 1 is about a tenth of the Olist
+    # dataset.
+    # Orders per customer are geometric, so most customers buy once and a few
+    # come back. Zip codes, categories and products have long-tailed
+    # popularity, zip codes cluster around regional centres.
+    rng = np.random.default_rng(random_state)
+    os.makedirs(path, exist_ok=True)
+
+    zip_codes, zip_weights, geolocation = \
+        _generate_geolocation(rng, min(n_zip_codes * scale, 90000),
+                              geolocation_rows_per_zip, popularity_exponent)
+    categories, category_weights, product_translation = \
+        _generate_categories(rng, n_categories, popularity_exponent)
+    products, product_weights, base_prices = \
+        _generate_products(rng, n_products * scale, categories,
+                           category_weights, popularity_exponent)
+    sellers = _generate_sellers(rng, n_sellers * scale, zip_codes, zip_weights)
+    customers = _generate_customers(rng, n_customers * scale, zip_codes,
+                                    zip_weights, repeat_purchase_probability)
+    orders = _generate_orders(rng, customers['customer_id'].values,
+                              undelivered_share)
+    order_items = _generate_order_items(rng, orders['order_id'].values,
+                                        products['product_id'].values,
+                                        product_weights, base_prices,
+                                        sellers['seller_id'].values)
+    order_payments = _generate_order_payments(rng, order_items)
+    order_reviews = _generate_order_reviews(rng, orders['order_id'].values)
+
+    tables = {'customers': customers, 'geolocation': geolocation,
+              'order_items': order_items, 'order_payments': order_payments,
+              'order_reviews': order_reviews, 'orders': orders,
+              'products': products, 'sellers': sellers,
+              'product_translation': product_translation}
+    for name, file in files.items():
+        tables[name].to_csv(os.path.join(path, file), index=False)
+
+    return {name: len(table) for name, table in tables.items()}
+
+def _generate_ids(rng, n):
+    # 32 character hexadecimal ids, as in the Olist dataset
+    high, low = rng.integers(0, 2**63, size=(2, n), dtype=np.int64)
+    return np.char.add(np.char.mod('%016x', high), np.char.mod('%016x', low))
+
+def _popularity(rng, n, exponent):
+    # Zipf-like weights over a random order of the 'n' items
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    weights = rng.permutation(weights)
+    return weights / weights.sum()
+
+def _generate_geolocation(rng, n_zip_codes, rows_per_zip, exponent):
+    zip_codes = np.sort(rng.choice(np.arange(1000, 100000), size=n_zip_codes,
+                                   replace=False))
+    regions = zip_codes // 10000
+    zip_weights = _popularity(rng, n_zip_codes, exponent) * \
+                  ZIP_REGION_WEIGHTS[regions]
+    zip_weights /= zip_weights.sum()
+    centres = ZIP_REGION_CENTRES[regions] + \
+              rng.normal(0, 1.5, size=(n_zip_codes, 2))
+
+    # A few zip codes have no coordinates, as in the Olist data
+    located = rng.random(n_zip_codes) > 0.005
+    rows = rng.geometric(1 / rows_per_zip, size=located.sum())
+    coordinates = np.repeat(centres[located], rows, axis=0) + \
+                  rng.normal(0, 0.02, size=(rows.sum(), 2))
+    geolocation = pd.DataFrame({
+        'geolocation_zip_code_prefix': np.repeat(zip_codes[located], rows),
+        'geolocation_lat': coordinates[:, 0],
+        'geolocation_lng': coordinates[:, 1],
+        'geolocation_city': 'cidade',
+        'geolocation_state': 'SP'})
+
+    return zip_codes, zip_weights, geolocation
+
+def _generate_categories(rng, n_categories, exponent):
+    categories = np.array([f'categoria_{number:02d}'
+                           for number in range(n_categories)])
+    # Two categories have no English name
+    product_translation = pd.DataFrame({
+        'product_category_name': categories[:-2],
+        'product_category_name_english': [f'category_{number:02d}' for number
+                                          in range(n_categories - 2)]})
+
+    return categories, _popularity(rng, n_categories, exponent), \
+           product_translation
+
+def _generate_products(rng, n_products, categories, category_weights,
+                       exponent):
+    product_categories = rng.choice(categories, size=n_products,
+                                    p=category_weights).astype(object)
+    product_categories[rng.random(n_products) < 0.02] = np.nan
+    base_prices = np.round(rng.lognormal(4.3, 0.9, size=n_products), 2)
+    products = pd.DataFrame({
+        'product_id': _generate_ids(rng, n_products),
+        'product_category_name': product_categories,
+        'product_name_lenght': rng.integers(5, 76, size=n_products),
+        'product_description_lenght': rng.integers(4, 4000, size=n_products),
+        'product_photos_qty': rng.integers(1, 10, size=n_products),
+        'product_weight_g': rng.integers(50, 30000, size=n_products),
+        'product_length_cm': rng.integers(7, 105, size=n_products),
+        'product_height_cm': rng.integers(2, 105, size=n_products),
+        'product_width_cm': rng.integers(6, 118, size=n_products)})
+
+    return products, _popularity(rng, n_products, exponent), base_prices
+
+def _generate_sellers(rng, n_sellers, zip_codes, zip_weights):
+    return pd.DataFrame({
+        'seller_id': _generate_ids(rng, n_sellers),
+        'seller_zip_code_prefix': rng.choice(zip_codes, size=n_sellers,
+                                             p=zip_weights),
+        'seller_city': 'cidade',
+        'seller_state': 'SP'})
+
+def _generate_customers(rng, n_customers, zip_codes, zip_weights,
+                        repeat_purchase_probability):
+    # One row per order, a new customer_id each time and the same
+    # customer_unique_id for the orders of one person
+    orders_per_customer = rng.geometric(1 - repeat_purchase_probability,
+                                        size=n_customers)
+    unique_ids = np.repeat(_generate_ids(rng, n_customers),
+                           orders_per_customer)
+    customer_zip_codes = np.repeat(rng.choice(zip_codes, size=n_customers,
+                                              p=zip_weights),
+                                   orders_per_customer)
+    n_orders = len(unique_ids)
+
+    return pd.DataFrame({'customer_id': _generate_ids(rng, n_orders),
+                         'customer_unique_id': unique_ids,
+                         'customer_zip_code_prefix': customer_zip_codes,
+                         'customer_city': 'cidade',
+                         'customer_state': 'SP'})
+
+def _generate_orders(rng, customer_ids, undelivered_share):
+    n_orders = len(customer_ids)
+    period = (LAST_PURCHASE - FIRST_PURCHASE).total_seconds()
+    purchases = FIRST_PURCHASE + \
+                pd.to_timedelta(rng.uniform(0, period, size=n_orders).round(),
+                                unit='s')
+    delivery_days = rng.lognormal(2.3, 0.5, size=n_orders)
+    approved = purchases + pd.to_timedelta(rng.uniform(0, 1, n_orders),
+                                           unit='D')
+    delivered = purchases + pd.to_timedelta(delivery_days, unit='D')
+    estimated = purchases + pd.to_timedelta(delivery_days + 10, unit='D')
+
+    undelivered = rng.random(n_orders) < undelivered_share
+    delivered_dates = pd.Series(delivered.strftime(DATE_FORMAT))
+    delivered_dates[undelivered] = ''
+
+    return pd.DataFrame({
+        'order_id': _generate_ids(rng, n_orders),
+        'customer_id': customer_ids,
+        'order_status': np.where(undelivered, 'shipped', 'delivered'),
+        'order_purchase_timestamp': purchases.strftime(DATE_FORMAT),
+        'order_approved_at': approved.strftime(DATE_FORMAT),
+        'order_delivered_carrier_date': approved.strftime(DATE_FORMAT),
+        'order_delivered_customer_date': delivered_dates.values,
+        'order_estimated_delivery_date': estimated.strftime(DATE_FORMAT)})
+
+def _generate_order_items(rng, order_ids, product_ids, product_weights,
+                          base_prices, seller_ids):
+    # Most orders have one item, every product is sold by one seller
+    items_per_order = rng.geometric(0.9, size=len(order_ids))
+    n_items = items_per_order.sum()
+    products = rng.choice(len(product_ids), size=n_items, p=product_weights)
+    product_sellers = rng.integers(0, len(seller_ids), size=len(product_ids))
+    item_numbers = np.arange(n_items) - \
+                   np.repeat(np.cumsum(items_per_order) - items_per_order,
+                             items_per_order) + 1
+
+    return pd.DataFrame({
+        'order_id': np.repeat(order_ids, items_per_order),
+        'order_item_id': item_numbers,
+        'product_id': product_ids[products],
+        'seller_id': seller_ids[product_sellers[products]],
+        'shipping_limit_date': '2018-01-01 00:00:00',
+        'price': np.round(base_prices[products] *
+                          rng.normal(1, 0.05, size=n_items).clip(0.5), 2),
+        'freight_value': np.round(rng.lognormal(2.8, 0.5, size=n_items), 2)})
+
+def _generate_order_payments(rng, order_items):
+    totals = (order_items['price'] + order_items['freight_value'])\
+             .groupby(order_items['order_id'], sort=False).sum()
+
+    return pd.DataFrame({
+        'order_id': totals.index.values,
+        'payment_sequential': 1,
+        'payment_type': rng.choice(PAYMENT_TYPES, size=len(totals),
+                                   p=PAYMENT_TYPE_PROBABILITIES),
+        'payment_installments': rng.integers(1, 11, size=len(totals)),
+        'payment_value': totals.round(2).values})
+
+def _generate_order_reviews(rng, order_ids):
+    # One review per order, a few orders are reviewed twice
+    reviews_per_order = 1 + (rng.random(len(order_ids)) < 0.01)
+    n_reviews = reviews_per_order.sum()
+
+    return pd.DataFrame({
+        'review_id': _generate_ids(rng, n_reviews),
+        'order_id': np.repeat(order_ids, reviews_per_order),
+        'review_score': rng.choice(np.arange(1, 6), size=n_reviews,
+                                   p=REVIEW_SCORE_PROBABILITIES),
+        'review_comment_title': '',
+        'review_comment_message': '',
+        'review_creation_date': '2018-01-01 00:00:00',
+        'review_answer_timestamp': '2018-01-01 00:00:00'})
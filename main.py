@@ -4,6 +4,7 @@
 from pipeline import (step1_data_preparation,
                       step2_modelling,
                       step3_prediction)
+from utils import INSTRUMENTATION
 #%%
 data_preparator = \
     step1_data_preparation.DataPreparator(config_path='config/step1_data_preparation.yaml')
@@ -21,4 +22,6 @@ predictor = step3_prediction.Predictor(config_path='config/step3_prediction.yaml
 #%%
 predictor.print_product_recommendation(sample_size=5, verbose=False,
                                        product_number=5)
-
+#%%
+# Time and memory per stage, when instrumentation is enabled in the configs
+INSTRUMENTATION.print_summary()
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import platform
+import multiprocessing
+import numpy as np
+import yaml
+
+from utils import peak_rss_mb, rss_mb
+from logic.synthetic_data import generate_olist_data
+from pipeline.step1_data_preparation import DataPreparator
+from pipeline.step2_modelling import Modeller
+from pipeline.step3_prediction import Predictor
+
+# Pipeline stages in the order they run, each times one call
+STAGES = ['data_preparation', 'modelling', 'prediction']
+# Measurements compared against the baseline
+COMPARED_METRICS = ['wall_time_s', 'peak_rss_mb']
+
+
+class Benchmark():
+    def __init__(self, config_path='config/benchmark.yaml'):
+        # General attributes
+        with open(config_path) as stream:
+            self.config = yaml.safe_load(stream)
+        self.work_path = self.config['output']['work_path']
+        self.results_path = self.config['output']['results_path']
+        self.baseline_path = self.config['input']['baseline_path']
+
+        self.results = None
+        self.comparison = None
+
+    def run(self):
+        # Generates synthetic data for every scale factor, then runs and
+        # measures each pipeline stage on it
+        control = self.config['control']
+        results = []
+        for scale in control['scale_factors']:
+            scale_path = f'{self.work_path}scale_{scale}/'
+            config_paths = self._write_scale_configs(scale_path)
+            data_path = scale_path + 'raw/'
+            print(f'{f" Generating data for scale {scale} ":#^100}')
+            row_counts = \
+                generate_olist_data(data_path,
+                                    self._load_config('data_preparation')['input'],
+                                    scale=scale,
+                                    random_state=control['random_state'],
+                                    **control['generator'])
+
+            for stage in STAGES:
+                print(f'{f" Running {stage} for scale {scale} ":#^100}')
+                measurement = self._measure_stage(stage, config_paths,
+                                                  data_path)
+                results.append({'scale': scale, 'stage': stage,
+                                'orders': row_counts['orders'],
+                                **measurement})
+
+        self.results = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                        'python': platform.python_version(),
+                        'machine': platform.machine(),
+                        'cpu_count': os.cpu_count(),
+                        'results': results}
+        self._save_json(self.results, self.results_path)
+        self._compare_with_baseline()
+
+        return self.results
+
+    def _measure_stage(self, stage, config_paths, data_path):
+        # Runs the stage in a forked process, so its peak memory is measured
+        # on its own and nothing is kept warm between stages. Where processes
+        # cannot be forked (Windows) it is spawned instead.
+        start_method = 'fork' \
+                       if 'fork' in multiprocessing.get_all_start_methods() \
+                       else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run_stage,
+                                  args=(stage, config_paths, data_path,
+                                        self.config['control'], sender))
+        process.start()
+        measurement = receiver.recv()
+        process.join()
+        if 'error' in measurement:
+            raise RuntimeError(f'Stage {stage} failed: {measurement["error"]}')
+
+        return measurement
+
+    def _write_scale_configs(self, scale_path):
+        # Copies of the pipeline configs with their data and model paths moved
+        # under the scale's directory, and caching turned off so every stage
+        # actually runs
+        config_paths = {}
+        for stage in STAGES:
+            config = self._load_config(stage)
+            sections = ['output'] if stage == 'data_preparation' \
+                       else ['input', 'output']
+            for section in sections:
+                for name, path in (config[section] or {}).items():
+                    config[section][name] = scale_path + path
+                    os.makedirs(os.path.dirname(scale_path + path),
+                                exist_ok=True)
+            config['control']['use_cache'] = False
+
+            config_paths[stage] = f'{scale_path}config/{stage}.yaml'
+            os.makedirs(os.path.dirname(config_paths[stage]), exist_ok=True)
+            with open(config_paths[stage], 'w') as stream:
+                yaml.safe_dump(config, stream, sort_keys=False)
+
+        return config_paths
+
+    def _load_config(self, stage):
+        with open(self.config['input'][stage + '_config_path']) as stream:
+            return yaml.safe_load(stream)
+
+    def _compare_with_baseline(self):
+        # Ratio of each measurement to the baseline's, a ratio above
+        # 1 + 'regression_tolerance' is reported as a regression.
+        # The results become the baseline if there is none yet.
+        control = self.config['control']
+        if control['update_baseline'] or not os.path.exists(self.baseline_path):
+            print(f'Saving results as the baseline in {self.baseline_path}')
+            self._save_json(self.results, self.baseline_path)
+
+        with open(self.baseline_path) as file:
+            baseline = json.load(file)
+        baseline_results = {(result['scale'], result['stage']): result
+                            for result in baseline['results']}
+
+        self.comparison = []
+        print(f'{" Comparison with baseline ":#^100}')
+        for result in self.results['results']:
+            baseline_result = baseline_results.get((result['scale'],
+                                                    result['stage']))
+            if baseline_result is None:
+                continue
+            for metric in COMPARED_METRICS:
+                # Peak memory is None where it cannot be read
+                if result[metric] is None or baseline_result[metric] is None:
+                    continue
+                ratio = result[metric] / baseline_result[metric] \
+                        if baseline_result[metric] else np.nan
+                regression = ratio > 1 + control['regression_tolerance']
+                self.comparison.append({'scale': result['scale'],
+                                        'stage': result['stage'],
+                                        'metric': metric,
+                                        'baseline': baseline_result[metric],
+                                        'current': result[metric],
+                                        'ratio': ratio,
+                                        'regression': bool(regression)})
+                scale = f'x{result["scale"]}'
+                print(f'{result["stage"]:<20}{scale:>6}'
+                      f'{metric:>14}{baseline_result[metric]:>12.2f}'
+                      f'{result[metric]:>12.2f}{ratio:>8.2f}'
+                      f'{"  REGRESSION" if regression else ""}')
+
+        self.results['comparison'] = self.comparison
+        self._save_json(self.results, self.results_path)
+
+    def _save_json(self, data, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(data, file, indent=1)
+
+
+def _run_stage(stage, config_paths, data_path, control, sender):
+    # Runs in the stage's process and sends back its measurements
+    try:
+        np.random.seed(control['random_state'])
+        # A forked process starts with the memory the benchmark process holds,
+        # a spawned one with its imports, which are left out of the stage's
+        # peak. A spawned process has already passed its peak RSS while
+        # importing, so the RSS it holds now is taken.
+        start_rss = rss_mb()
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+
+        if stage == 'data_preparation':
+            DataPreparator(data_path=data_path,
+                           config_path=config_paths[stage]).run()
+        elif stage == 'modelling':
+            Modeller(config_path=config_paths[stage]).run()
+        else:
+            predictor = Predictor(config_path=config_paths[stage])
+            predictor.predict_product_random(
+                sample_size=control['prediction_sample_size'])
+
+        peak_rss = peak_rss_mb()
+        sender.send({'wall_time_s': time.perf_counter() - start_time,
+                     'cpu_time_s': time.process_time() - start_cpu,
+                     'start_rss_mb': start_rss,
+                     'peak_rss_mb': None if None in (start_rss, peak_rss)
+                                    else peak_rss - start_rss})
+    except Exception as error:
+        sender.send({'error': repr(error)})
+    finally:
+        sender.close()
@@ -0,0 +1,163 @@
+import os
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import yaml
+
+from utils import (save_data, load_rows, count_rows, LazyBundle, fingerprint,
+                   stage, configure_instrumentation)
+
+# Fingerprint of the run the chunks in the scores directory belong to
+SCORING_INDEX = '_scoring.json'
+# Model and settings of the running job, inherited by forked workers rather
+# than sent to them. Each chunk reads its own rows of the data.
+_job = None
+
+
+class BulkScorer():
+    def __init__(self, config_path='config/bulk_scoring.yaml'):
+        # General attributes
+        with open(config_path) as stream:
+            self.config = yaml.safe_load(stream)
+        configure_instrumentation(self.config['control']['instrumentation'])
+        self.scores_path = self.config['output']['scores_path']
+        self.summary = None
+
+    def run(self):
+        # Predicts the next category of every row of the unlabeled data, in
+        # chunks of 'chunk_size' rows. Each chunk is written to its own
+        # Parquet file with the row's customer, order and product, the 'top_k'
+        # most probable categories and their probabilities.
+        # Chunks are spread over 'workers' processes. A run that was
+        # interrupted is resumed from the chunks it completed.
+        with stage('bulk_scoring') as record:
+            self.summary = self._run()
+            record['rows'] = self.summary['rows']
+        return self.summary
+
+    def _run(self):
+        global _job
+        control = self.config['control']
+        data_path = self.config['input']['data_path']
+        ids_path = self.config['input']['ids_path']
+        bundle = LazyBundle(self.config['input']['serving_bundle_path'])
+        row_number = count_rows(data_path)
+        if count_rows(ids_path) != row_number:
+            raise ValueError(f'The unlabeled data has {row_number} rows but '
+                             f'its ids {count_rows(ids_path)}, prepare the '
+                             f'data again')
+        chunk_number = int(np.ceil(row_number / control['chunk_size']))
+        completed_chunks = self._completed_chunks(bundle, chunk_number)
+        chunks = [chunk for chunk in range(chunk_number)
+                  if chunk not in completed_chunks]
+        print(f'Scoring {len(chunks)} of {chunk_number} chunks, '
+              f'{len(completed_chunks)} were completed before')
+
+        model = bundle['model']
+        label_encoder = bundle['encoders']['label_encoder']
+        _job = {'data_path': data_path, 'ids_path': ids_path, 'model': model,
+                'labels': label_encoder.classes_[model.classes_.astype(int)],
+                'chunk_size': control['chunk_size'],
+                'top_k': control['top_k'],
+                'scores_path': self.scores_path}
+        try:
+            if control['workers'] > 1 and len(chunks) > 1:
+                # Where processes cannot be forked (Windows), the workers are
+                # spawned and each gets the job sent once
+                start_method = \
+                    'fork' if 'fork' in multiprocessing.get_all_start_methods() \
+                    else 'spawn'
+                context = multiprocessing.get_context(start_method)
+                with ProcessPoolExecutor(max_workers=control['workers'],
+                                         mp_context=context,
+                                         initializer=_start_worker,
+                                         initargs=(_job,)) as executor:
+                    futures = [executor.submit(_score_chunk, chunk)
+                               for chunk in chunks]
+                    for future in as_completed(futures):
+                        self._report(*future.result(), chunk_number)
+            else:
+                for chunk in chunks:
+                    self._report(*_score_chunk(chunk), chunk_number)
+        finally:
+            _job = None
+
+        return {'chunks': chunk_number, 'scored_chunks': len(chunks),
+                'rows': row_number}
+
+    def _completed_chunks(self, bundle, chunk_number):
+        # Chunks already written for the same data, model and settings
+        # Otherwise the chunks in the scores directory are removed
+        control = self.config['control']
+        paths = [self.config['input']['data_path'],
+                 self.config['input']['ids_path']] + \
+                [os.path.join(bundle.path, bundle.manifest[name])
+                 for name in ['model', 'encoders']]
+        run_fingerprint = \
+            fingerprint(self.config['output']['cache_path'], paths=paths,
+                        config={key: control[key]
+                                for key in ['chunk_size', 'top_k']})
+
+        index_path = os.path.join(self.scores_path, SCORING_INDEX)
+        if control['resume'] and os.path.exists(index_path):
+            with open(index_path) as file:
+                if json.load(file)['fingerprint'] == run_fingerprint:
+                    return {chunk for chunk in range(chunk_number)
+                            if os.path.exists(_chunk_path(self.scores_path,
+                                                          chunk))}
+
+        os.makedirs(self.scores_path, exist_ok=True)
+        for file in os.listdir(self.scores_path):
+            if file.startswith('part-'):
+                os.remove(os.path.join(self.scores_path, file))
+        with open(index_path, 'w') as file:
+            json.dump({'fingerprint': run_fingerprint,
+                       'chunks': chunk_number}, file, indent=1)
+        return set()
+
+    def _report(self, chunk, rows, chunk_number):
+        print(f'Scored chunk {chunk + 1}/{chunk_number} ({rows} rows)')
+
+
+def _start_worker(job):
+    # A forked worker already has the job, a spawned one gets it here
+    global _job
+    _job = job
+
+def _chunk_path(scores_path, chunk):
+    return os.path.join(scores_path, f'part-{chunk:05d}.parquet')
+
+def _score_chunk(chunk):
+    # Scores one chunk of rows and writes it, rows with missing features get
+    # no categories. The file is written under a hidden name and then renamed,
+    # so an interrupted write does not count as a completed chunk.
+    start = chunk * _job['chunk_size']
+    end = start + _job['chunk_size']
+    features = load_rows(_job['data_path'], start, end)
+    labels = _job['labels']
+
+    scores = load_rows(_job['ids_path'], start, end)
+    scores.insert(0, 'row', np.arange(start, start + features.shape[0]))
+    complete = ~np.isnan(np.asarray(features.sum(axis=1)).ravel())
+    probabilities = np.full((features.shape[0], len(labels)), np.nan)
+    if complete.any():
+        probabilities[complete] = _job['model'].predict_proba(features[complete])
+
+    top_k = min(_job['top_k'], len(labels))
+    ranking = np.argsort(-np.nan_to_num(probabilities), axis=1,
+                         kind='stable')[:, :top_k]
+    for rank in range(top_k):
+        categories = labels[ranking[:, rank]].astype(object)
+        categories[~complete] = None
+        scores[f'category_{rank + 1}'] = categories
+        scores[f'probability_{rank + 1}'] = \
+            np.take_along_axis(probabilities, ranking[:, [rank]], axis=1)\
+              .ravel()
+
+    path = _chunk_path(_job['scores_path'], chunk)
+    temporary_path = os.path.join(_job['scores_path'],
+                                  '.' + os.path.basename(path))
+    save_data(scores, temporary_path)
+    os.replace(temporary_path, path)
+    return chunk, len(scores)
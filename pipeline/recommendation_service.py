@@ -0,0 +1,190 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import yaml
+
+from pipeline.step3_prediction import Predictor
+
+# Columns of recommend_batch returned for each recommended product
+PRODUCT_FIELDS = ['product_id', 'review_score', 'estimated_price',
+                  'shipping_price', 'estimated_delivery_time']
+
+
+class RecommendationService():
+    def __init__(self, config_path='config/recommendation_service.yaml'):
+        # General attributes
+        with open(config_path) as stream:
+            self.config = yaml.safe_load(stream)
+        control = self.config['control']
+
+        # The prediction artifacts are loaded once and reused by every request
+        self.predictor = \
+            Predictor(config_path=self.config['input']['predictor_config_path'])
+        self.product_number = control['product_number']
+        self.estimation_n = control['estimation_n']
+
+        # Micro-batching
+        # Requests are queued and predicted together, a batch is closed when
+        # it is full or 'max_wait_ms' after its first request
+        self.requests = queue.Queue()
+        self.max_batch_size = control['max_batch_size']
+        self.max_wait = control['max_wait_ms'] / 1000
+        self.request_timeout = control['request_timeout_s']
+
+        # Statistics, latencies are kept for the latest requests only
+        self.stats_lock = threading.Lock()
+        self.latencies = deque(maxlen=control['latency_window'])
+        self.request_count = 0
+        self.batch_count = 0
+        self.batched_requests = 0
+
+        self.server = None
+
+    def run(self):
+        # Serves until interrupted
+        # GET /recommendations?customer_unique_id=<id> returns the recommended
+        # products of a customer, GET /stats the request and latency stats
+        host = self.config['control']['host']
+        port = self.config['control']['port']
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        print(f'Serving recommendations on http://{host}:{port}')
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def recommend(self, customer_id):
+        # Queues a customer for the next batch
+        # Returns a Future with the recommendation, None if the customer has
+        # no purchase to predict from
+        future = Future()
+        self.requests.put((customer_id, future))
+        return future
+
+    def record_latency(self, seconds):
+        with self.stats_lock:
+            self.latencies.append(seconds)
+            self.request_count += 1
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {'requests': self.request_count,
+                     'batches': self.batch_count,
+                     'mean_batch_size': self.batched_requests / self.batch_count
+                                        if self.batch_count else None,
+                     'recommendation_cache':
+                         self.predictor.recommendation_cache.stats()}
+
+        stats['latency_ms'] = \
+            {f'p{percentile}': float(np.percentile(latencies, percentile))
+             for percentile in [50, 90, 99]} if len(latencies) else {}
+        if len(latencies):
+            stats['latency_ms']['max'] = float(latencies.max())
+        return stats
+
+    def _batch_loop(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        # One model call and product lookup for all customers in the batch
+        customer_ids = list(dict.fromkeys(customer_id
+                                          for customer_id, _ in batch))
+        try:
+            recommendations = \
+                self.predictor.recommend_batch(customer_ids,
+                                               product_number=self.product_number,
+                                               estimation_n=self.estimation_n)
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+
+        recommendations_by_customer = \
+            dict(list(recommendations.groupby('customer_unique_id',
+                                              observed=True, sort=False)))
+        for customer_id, future in batch:
+            rows = recommendations_by_customer.get(customer_id)
+            future.set_result(None if rows is None
+                              else _to_response(customer_id, rows))
+
+        with self.stats_lock:
+            self.batch_count += 1
+            self.batched_requests += len(batch)
+
+
+def _to_response(customer_id, rows):
+    products = rows[PRODUCT_FIELDS].astype(object)
+    products = products.where(products.notna(), None)
+    return {'customer_unique_id': customer_id,
+            'predicted_category': rows['predicted_category'].iloc[0],
+            'products': products.to_dict('records')}
+
+def _make_handler(service):
+    class RecommendationHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/stats':
+                self._send(200, service.stats())
+                return
+            if url.path != '/recommendations':
+                self._send(404, {'error': f'Unknown path {url.path}'})
+                return
+
+            start = time.perf_counter()
+            customer_id = \
+                parse_qs(url.query).get('customer_unique_id', [None])[0]
+            if customer_id is None:
+                self._send(400, {'error': 'customer_unique_id is required'})
+                return
+
+            try:
+                recommendation = service.recommend(customer_id)\
+                                        .result(timeout=service.request_timeout)
+            except Exception as error:
+                self._send(500, {'error': repr(error)})
+            else:
+                if recommendation is None:
+                    self._send(404, {'error': f'No recommendation for '
+                                              f'customer {customer_id}'})
+                else:
+                    self._send(200, recommendation)
+            service.record_latency(time.perf_counter() - start)
+
+        def _send(self, status, body):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            # Requests are summarized in /stats instead of logged one by one
+            pass
+
+    return RecommendationHandler
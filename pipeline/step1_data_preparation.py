@@ -1,15 +1,73 @@
+import os
+import shutil
 import yaml
+import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
+import scipy.sparse as sp
 
-from logic.data_preparation import (gather_customers_with_n_purchase,
-                                    filter_complete_data_by_customer,
+from logic.data_preparation import (load_raw_data,
+                                    build_customer_index,
+                                    gather_customers_with_n_purchase,
+                                    filter_purchases_by_customer,
                                     build_predictor_table,
                                     prepare_modelling_data,
+                                    prepare_labeled_data,
+                                    add_labels,
                                     prepare_unlabeled_data,
                                     prepare_product_recommendation_tables,
-                                    join_coords)
-from utils import save_data                                    
+                                    update_product_recommendation_tables,
+                                    build_star_schema,
+                                    append_to_star_schema,
+                                    get_affected_keys,
+                                    join_purchases,
+                                    aggregate_geolocation,
+                                    build_zip_code_lookup,
+                                    join_geolocation,
+                                    partition_raw_data,
+                                    get_shard_path,
+                                    summarize_product_purchases,
+                                    merge_product_summaries,
+                                    summarize_product_buyers,
+                                    combine_product_summaries,
+                                    prepare_serving_product_tables,
+                                    PARTITIONED_INPUTS)
+from logic.modelling import train_location_clusters
+from logic.prediction import get_latest_purchases
+from utils import (save_data, load_data, save_tables, load_tables,
+                   concatenate_rows, concatenate_tables, count_rows,
+                   save_bundle, LazyBundle, fingerprint, is_cached,
+                   store_cache_entry, clear_cache_entries, stage,
+                   configure_instrumentation, BUNDLE_MANIFEST)
+
+# Raw inputs that can be appended with DataPreparator.update
+BATCH_INPUTS = ['customers', 'orders', 'order_items', 'order_payments',
+                'order_reviews', 'products', 'sellers']
+GEOLOCATION_COORDINATES = ['geolocation_lat', 'geolocation_lng']
+# Cached steps of the data preparation, the whole run is cached as well
+CACHED_STEPS = ['data_preparation', 'tables', 'classifier_data',
+                'unlabeled_data', 'product_recommendation_tables']
+# Model features of a shard's purchases, encoded once the encoders are fitted
+SHARD_FEATURES_FILE = 'features.parquet'
+# Other outputs of a shard, concatenated over all shards on disk
+SHARD_PREDICTOR_TABLE_FILE = 'predictor_table.parquet'
+SHARD_LATEST_PURCHASES_FILE = 'latest_purchases.parquet'
+SHARD_UNLABELED_DATA_FILE = 'unlabeled_data.csr'
+SHARD_UNLABELED_IDS_FILE = 'unlabeled_ids.parquet'
+PRODUCT_BUYER_TABLES = ['buyer_locations', 'buyer_statistics']
+# Keys of the IDs split by customer into shards, numbered on from shard to
+# shard, with the table and column of the IDs they are counted from
+SHARD_KEYS = {'customer_key': ('customers', 'customer_id'),
+              'order_key': ('orders', 'order_id')}
+# Most parts a shard is split into when its measured footprint exceeds the
+# memory budget
+MAX_SHARD_SPLITS = 16
+# Order item of each row of the unlabeled data, saved next to it in row groups
+# small enough for bulk scoring to read the ids of one chunk at a time
+UNLABELED_ID_COLUMNS = ['customer_unique_id', 'order_id', 'product_id']
+UNLABELED_ID_ROW_GROUP_SIZE = 10000
+# Recommendation tables saved to the serving bundle as they are
+SERVING_RANKINGS = ['avg_score_per_product', 'category_top_products',
+                    'category_cluster_top_products']
 
 
 class DataPreparator():
@@ -19,175 +77,811 @@ class DataPreparator():
         # General attributes
         with open(config_path) as stream:
             self.config = yaml.safe_load(stream)
-        self._load_data(data_path)
-        self.complete_data_path = self.config['output']['complete_data_path']
-        self.complete_data = None
-
-        # Geolocation
-        self._average_geolocation()
-        self._kmeans_geolocation()
+        self.data_path = data_path
+        self.tables_path = self.config['output']['tables_path']
+        self.zip_code_lookup = None
+        self.location_cluster_model_path = \
+            self.config['output']['location_cluster_model_path']
+        self.tables = None
+        self.purchases = None
+        # The purchases sorted by customer, see build_customer_index
+        self.customer_index = None
 
         # Classifier data attributes
         self.classifier_data_path = self.config['output']['classifier_data_path']
+        self.new_pairs_path = self.config['output']['new_pairs_path']
+        self.new_pairs = None
         self.columns_dict = self.config['control']['classifier_columns']
         self.classifier_columns = self._flatten_columns_dict()
         self.columns_path = self.config['output']['classifier_columns_path']
         self.classifier_data = None
         self.classifier_encoders = None
+        self.predictor_table_path = self.config['output']['predictor_table_path']
+        self.n_purchase = self.config['control']['n_purchase']
         self.encoder_path = self.config['output']['encoder_path']
 
         # Prodect recommendation
         self.product_recommendation_tables = None
+        self.product_recommendation_table_path = \
+            self.config['output']['product_recommendation_table_path']
+
+        # Artifacts needed for inference, see _save_serving_bundle
+        self.serving_bundle_path = self.config['output']['serving_bundle_path']
+        self.serving_manifest_path = os.path.join(self.serving_bundle_path,
+                                                  BUNDLE_MANIFEST)
 
         # Other data
         self.unlabeled_data_path = self.config['output']['unlabeled_data_path']
-        
+        self.unlabeled_ids_path = self.config['output']['unlabeled_ids_path']
+        self.unlabeled_data = None
+        self.unlabeled_ids = None
 
-        # Debug
+        # Predictor rows (before encoding) with their customers
         self.predictor_table = None
 
+        # Steps whose inputs have not changed since the last run are skipped
+        self.cache_path = self.config['output']['cache_path']
+        self.use_cache = self.config['control']['use_cache']
+
+        configure_instrumentation(self.config['control']['instrumentation'])
+
     def _load_data(self, data_path):
-        # Load all raw data files
-        self.customers = pd.read_csv(data_path + self.config['input']['customers'])
-        self.orders = pd.read_csv(data_path + self.config['input']['orders'])
-        self.order_items = pd.read_csv(data_path + self.config['input']['order_items'])
-        self.order_payments = pd.read_csv(data_path + self.config['input']['order_payments'])
-        self.order_reviews = pd.read_csv(data_path + self.config['input']['order_reviews'])
-        self.products = pd.read_csv(data_path + self.config['input']['products'])
-        self.geolocation = pd.read_csv(data_path + self.config['input']['geolocation'])
-        self.sellers = pd.read_csv(data_path + self.config['input']['sellers'])
-        self.product_translation = \
-            pd.read_csv(data_path + self.config['input']['product_translation'])
+        # Load all raw data files, with the column types from the schema
+        # Geolocation is streamed separately in _average_geolocation
+        control = self.config['control']
+        files = {name: file for name, file in self.config['input'].items()
+                 if name != 'geolocation'}
+        tables = load_raw_data(data_path, files,
+                               schema=control['schema'],
+                               date_columns=control['date_columns'],
+                               date_format=control['date_format'],
+                               workers=control['load_workers'])
+
+        self.customers = tables['customers']
+        self.orders = tables['orders']
+        self.order_items = tables['order_items']
+        self.order_payments = tables['order_payments']
+        self.order_reviews = tables['order_reviews']
+        self.products = tables['products']
+        self.sellers = tables['sellers']
+        self.product_translation = tables['product_translation']
 
     def run(self):
-        # Join data to create one table with all features for prediction
-        self._join_data()
-        # Translate the Portuguese product categories to English
-        self._translate_product_categories()
-        save_data(self.complete_data, self.complete_data_path)
+        with stage('data_preparation'):
+            self._run()
+
+    def _run(self):
+        control = self.config['control']
+        raw_files = [self.data_path + file
+                     for file in self.config['input'].values()]
+        outputs = [self.tables_path, self.location_cluster_model_path,
+                   self.classifier_data_path,
+                   self.predictor_table_path, self.unlabeled_data_path,
+                   self.unlabeled_ids_path, self.encoder_path, self.columns_path,
+                   self.product_recommendation_table_path,
+                   self.serving_manifest_path]
+        run_fingerprint = fingerprint(self.cache_path, paths=raw_files,
+                                      config=self.config)
+        if self._is_cached('data_preparation', run_fingerprint, outputs):
+            print('Data preparation inputs unchanged, skipping')
+            return
+
+        if control['partitioning']['enabled']:
+            self._run_partitioned()
+            # The cached steps of a full run do not match these outputs
+            clear_cache_entries(self.cache_path, CACHED_STEPS)
+            if self.use_cache:
+                store_cache_entry(self.cache_path, 'data_preparation',
+                                  run_fingerprint)
+            return
+
+        # Normalize the raw data into fact and dimension tables
+        tables_config = {'input': self.config['input'],
+                         'control': {key: control[key] for key in
+                                     ['schema', 'date_columns', 'date_format',
+                                      'geolocation']}}
+        tables_fingerprint = fingerprint(self.cache_path, paths=raw_files,
+                                         config=tables_config)
+        self._run_step('tables', tables_fingerprint,
+                       [self.tables_path, self.location_cluster_model_path],
+                       run_step=self._prepare_tables,
+                       load_step=self._load_tables)
+        # One row per purchased item with the columns used below
+        with stage('join_purchases') as record:
+            self.purchases = join_purchases(self.tables,
+                                            control['purchase_columns'])
+            record['rows'] = len(self.purchases)
+        with stage('customer_index'):
+            self.customer_index = build_customer_index(self.purchases)
 
         # Prepare data for modelling
-        self._prepare_classifier_data()
+        classifier_fingerprint = \
+            fingerprint(self.cache_path,
+                        config={key: control[key] for key in
+                                ['classifier_columns', 'n_purchase',
+                                 'purchase_columns']},
+                        upstream=[tables_fingerprint])
+        self._run_step('classifier_data', classifier_fingerprint,
+                       [self.classifier_data_path, self.predictor_table_path,
+                        self.encoder_path, self.columns_path,
+                        self.serving_manifest_path],
+                       run_step=self._prepare_classifier_step,
+                       load_step=self._load_classifier_step)
         # Run unlabeled data through the same process and save for inference
         # later
-        self._prepare_unlabeled_data()
+        unlabeled_fingerprint = \
+            fingerprint(self.cache_path,
+                        upstream=[tables_fingerprint, classifier_fingerprint])
+        self._run_step('unlabeled_data', unlabeled_fingerprint,
+                       [self.unlabeled_data_path, self.unlabeled_ids_path],
+                       run_step=self._prepare_unlabeled_step,
+                       load_step=lambda: None)
 
         # Prepare processed tables for product recommendation
-        self.product_recommendation_tables = \
-            prepare_product_recommendation_tables(self.complete_data)
+        # and the latest purchases for the serving bundle
+        recommendation_fingerprint = \
+            fingerprint(self.cache_path,
+                        config={key: control[key] for key in
+                                ['purchase_columns', 'serving_columns',
+                                 'classifier_columns']},
+                        upstream=[tables_fingerprint])
+        self._run_step('product_recommendation_tables',
+                       recommendation_fingerprint,
+                       [self.product_recommendation_table_path,
+                        self.serving_manifest_path],
+                       run_step=self._prepare_recommendation_step,
+                       load_step=lambda: None)
+
+        if self.use_cache:
+            store_cache_entry(self.cache_path, 'data_preparation',
+                              run_fingerprint)
+
+    def _is_cached(self, step, step_fingerprint, outputs):
+        return self.use_cache and \
+               is_cached(self.cache_path, step, step_fingerprint, outputs)
+
+    def _run_step(self, step, step_fingerprint, outputs, run_step, load_step):
+        # Loads the outputs of a step if its inputs are unchanged, otherwise
+        # runs it and records its fingerprint
+        with stage(step) as record:
+            if self._is_cached(step, step_fingerprint, outputs):
+                print(f'Reusing cached {step.replace("_", " ")}')
+                record['cached'] = True
+                load_step()
+                return
+
+            run_step()
+            if self.use_cache:
+                store_cache_entry(self.cache_path, step, step_fingerprint)
+
+    def _prepare_tables(self):
+        with stage('load_raw_data') as record:
+            self._load_data(self.data_path)
+            record['rows'] = len(self.order_items)
 
+        # Geolocation
+        with stage('average_geolocation') as record:
+            self._average_geolocation()
+            record['rows'] = len(self.geolocation)
+        with stage('cluster_geolocation'):
+            self._kmeans_geolocation()
+
+        self._build_tables()
+        with stage('save'):
+            save_tables(self.tables, self.tables_path)
+            save_data(self.location_clusters, self.location_cluster_model_path)
+
+    def _load_tables(self):
+        self.tables = load_tables(self.tables_path)
+
+    def _prepare_classifier_step(self):
+        self._prepare_classifier_data()
+        with stage('save'):
+            self._save_classifier_data()
+
+    def _save_classifier_data(self):
         save_data(self.classifier_data, self.classifier_data_path)
-        save_data(self.unlabeled_data, self.unlabeled_data_path)
+        save_data(self.predictor_table, self.predictor_table_path)
         save_data(self.classifier_encoders, self.encoder_path)
         save_data(self.columns_dict, self.columns_path)
-        save_data(self.product_recommendation_tables,
-                  self.config['output']['product_recommendation_table_path'])
+        save_bundle({'encoders': self.classifier_encoders,
+                     'columns_dict': self.columns_dict},
+                    self.serving_bundle_path)
+        # The model is trained again on all of the new classifier data
+        if os.path.exists(self.new_pairs_path):
+            os.remove(self.new_pairs_path)
+
+    def _load_classifier_step(self):
+        # The unlabeled data is encoded with the cached encoders
+        self.classifier_encoders = load_data(self.encoder_path)
+
+    def _prepare_unlabeled_step(self):
+        with stage('encode') as record:
+            self._prepare_unlabeled_data()
+            record['rows'] = self.unlabeled_data.shape[0]
+        with stage('save'):
+            self._save_unlabeled_data()
+
+    def _prepare_recommendation_step(self):
+        self.product_recommendation_tables = \
+            prepare_product_recommendation_tables(self.purchases)
+        with stage('save'):
+            save_data(self.product_recommendation_tables,
+                      self.product_recommendation_table_path)
+            self._save_serving_bundle(self._get_latest_purchases())
+
+    def _save_serving_bundle(self, latest_purchases):
+        # The recommendation tables are stored one file each, so a predictor
+        # only loads the ones it uses. The location index and statistics are
+        # stored as numeric arrays, see prepare_serving_product_tables. Of
+        # the purchases, only the latest one of each customer is needed to
+        # predict their next category.
+        rankings = {name: self.product_recommendation_tables[name]
+                    for name in SERVING_RANKINGS}
+        serving_tables = \
+            prepare_serving_product_tables(self.product_recommendation_tables)
+        save_bundle({**rankings, **serving_tables,
+                     'latest_purchases': latest_purchases},
+                    self.serving_bundle_path,
+                    removed=['customer_location_index',
+                             'product_buyer_statistics'])
+
+    def _get_latest_purchases(self):
+        feature_columns = self.columns_dict['numerical'] + \
+                          self.columns_dict['categorical']
+        latest_purchases = \
+            get_latest_purchases(self.customer_index,
+                                 self.customer_index['customers'],
+                                 feature_columns)
+        serving_columns = self.config['control']['serving_columns']
+        return latest_purchases[serving_columns].reset_index(drop=True)
+
+    def _run_partitioned(self):
+        # Prepares the same outputs as the steps of _run, with the customers
+        # and their purchases split into shards that are prepared one at a
+        # time. The outputs of each shard are written to its directory and
+        # concatenated on disk, only the shard being prepared, the dimension
+        # tables and the per product sums are held in memory.
+        control = self.config['control']
+        partitioning = control['partitioning']
+        shards_path = self.config['output']['shards_path']
+        partitions = partitioning['partitions'] or self._count_partitions()
+        with stage('partition_raw_data') as record:
+            if os.path.exists(shards_path):
+                shutil.rmtree(shards_path)
+            self._partition_raw_data(self.data_path, shards_path, partitions)
+            record['partitions'] = partitions
+
+        # Geolocation, products and sellers are shared by all shards
+        with stage('average_geolocation') as record:
+            self._average_geolocation()
+            record['rows'] = len(self.geolocation)
+        with stage('cluster_geolocation'):
+            self._kmeans_geolocation()
+        self.zip_code_lookup = build_zip_code_lookup(self.geolocation)
+        dimensions = self._load_dimensions()
+
+        # Without a set number of partitions, the shards are split further
+        # before they are prepared when the footprint of the ones prepared so
+        # far, per byte of their raw files, says they exceed the budget
+        footprint_ratio = 0
+        first_keys = {key: 0 for key in SHARD_KEYS}
+        product_summary = None
+        shard_paths = []
+        pending = [(get_shard_path(shards_path, shard), True)
+                   for shard in range(partitions)]
+        while pending:
+            shard_path, splittable = pending.pop(0)
+            sub_partitions = 1
+            if splittable and not partitioning['partitions']:
+                sub_partitions = min(self._count_partitions(shard_path,
+                                                            footprint_ratio),
+                                     MAX_SHARD_SPLITS)
+            if sub_partitions > 1:
+                with stage('partition_shard'):
+                    self._partition_raw_data(shard_path, shard_path,
+                                             sub_partitions, level=1)
+                pending[:0] = [(get_shard_path(shard_path, shard), False)
+                               for shard in range(sub_partitions)]
+                continue
+
+            with stage('prepare_shard') as record:
+                summary = self._prepare_shard(shard_path, dimensions,
+                                              first_keys)
+                product_summary = summary if product_summary is None else \
+                    merge_product_summaries([product_summary, summary])
+                footprint_ratio = max(footprint_ratio,
+                                      self._measure_shard(shard_path,
+                                                          dimensions))
+                record['rows'] = len(self.purchases)
+            shard_paths.append(shard_path)
+        self.purchases = None
+        self.customer_index = None
+
+        # Tables, encoders and recommendation tables over all shards
+        with stage('combine_tables'):
+            concatenate_tables(shard_paths, self.tables_path,
+                               PARTITIONED_INPUTS)
+            # Products and sellers are the same in every shard
+            save_tables({'products': self.tables['products'],
+                         'sellers': self.tables['sellers'],
+                         'geolocation': self.geolocation}, self.tables_path)
+            self.tables = None
+        with stage('classifier_data'):
+            concatenate_rows([shard_path + SHARD_PREDICTOR_TABLE_FILE
+                              for shard_path in shard_paths],
+                             self.predictor_table_path)
+            self._encode_classifier_data(load_data(self.predictor_table_path))
+            save_data(self.location_clusters, self.location_cluster_model_path)
+            self._save_classifier_data()
+            self.predictor_table = None
+            self.classifier_data = None
+        with stage('unlabeled_data') as record:
+            self._combine_unlabeled_data(shard_paths)
+            record['rows'] = count_rows(self.unlabeled_data_path)
+        with stage('product_recommendation_tables'):
+            concatenate_tables(shard_paths, shards_path, PRODUCT_BUYER_TABLES)
+            self.product_recommendation_tables = \
+                combine_product_summaries(
+                    product_summary,
+                    **load_tables(shards_path, PRODUCT_BUYER_TABLES))
+
+        with stage('save'):
+            save_data(self.product_recommendation_tables,
+                      self.product_recommendation_table_path)
+            latest_purchases_path = shards_path + SHARD_LATEST_PURCHASES_FILE
+            concatenate_rows([shard_path + SHARD_LATEST_PURCHASES_FILE
+                              for shard_path in shard_paths],
+                             latest_purchases_path)
+            self._save_serving_bundle(load_data(latest_purchases_path))
+        shutil.rmtree(shards_path)
+
+    def _partition_raw_data(self, data_path, shards_path, partitions, level=0):
+        control = self.config['control']
+        partition_raw_data(data_path, self.config['input'], shards_path,
+                           partitions, schema=control['schema'],
+                           date_columns=control['date_columns'],
+                           chunksize=control['partitioning']['chunksize'],
+                           level=level)
+        # A shard's own files are no longer needed once it is split
+        if data_path == shards_path:
+            for name in PARTITIONED_INPUTS:
+                os.remove(data_path + self.config['input'][name])
+
+    def _count_partitions(self, data_path=None, footprint_ratio=1):
+        # The fewest parts that keep the raw files of PARTITIONED_INPUTS in
+        # 'data_path' within the memory budget, once multiplied by the
+        # footprint they take in memory per raw byte. Before any shard is
+        # measured the shards are cut to the budget in raw bytes.
+        memory_budget = \
+            self.config['control']['partitioning']['memory_budget_mb'] * 2**20
+        return max(1, int(np.ceil(self._raw_size(data_path) *
+                                  footprint_ratio / memory_budget)))
+
+    def _raw_size(self, data_path=None):
+        if data_path is None:
+            data_path = self.data_path
+        return sum(os.path.getsize(data_path + self.config['input'][name])
+                   for name in PARTITIONED_INPUTS)
+
+    def _measure_shard(self, shard_path, dimensions):
+        # Memory of the prepared shard's tables, purchases and customer
+        # index, per byte of its raw files. Categorical columns of the
+        # dimension tables share their categories with every shard, that
+        # fixed cost is left out and only their codes are counted, otherwise
+        # small shards would measure as much larger than they are.
+        shared_columns = {column for table in dimensions.values()
+                          for column, dtype in table.dtypes.items()
+                          if isinstance(dtype, pd.CategoricalDtype)}
+        frames = [self.tables[name] for name in PARTITIONED_INPUTS] + \
+                 [self.purchases, self.customer_index['data']]
+        footprint = 0
+        for frame in frames:
+            usage = frame.memory_usage(deep=True)
+            for column in shared_columns.intersection(frame.columns):
+                if isinstance(frame[column].dtype, pd.CategoricalDtype):
+                    usage[column] = frame[column].cat.codes.nbytes
+            footprint += usage.sum()
+        return footprint / max(1, self._raw_size(shard_path))
+
+    def _load_dimensions(self):
+        # Products and sellers, which every shard is joined with
+        control = self.config['control']
+        files = {name: file for name, file in self.config['input'].items()
+                 if name not in PARTITIONED_INPUTS and name != 'geolocation'}
+        tables = load_raw_data(self.data_path, files,
+                               schema=control['schema'],
+                               date_columns=control['date_columns'],
+                               date_format=control['date_format'],
+                               workers=control['load_workers'])
+        self.product_translation = tables['product_translation']
+        return {'products':
+                    self._translate_product_categories(tables['products']),
+                'sellers': self._join_geolocation(tables['sellers'])}
+
+    def _prepare_shard(self, shard_path, dimensions, first_keys):
+        # Builds the star schema of a shard, joins its purchases and writes
+        # the shard's tables, predictor rows, latest purchases, model
+        # features and buyer tables to its directory. Returns the shard's
+        # product summary.
+        # The shard's IDs get their own categories. Products and sellers keep
+        # the keys of the dimension tables, and the customer and order keys
+        # follow the ones of the previous shards, numbered from 'first_keys',
+        # which is moved past them.
+        control = self.config['control']
+        files = {name: self.config['input'][name]
+                 for name in PARTITIONED_INPUTS}
+        key_categories = {'product_id':
+                              dimensions['products']['product_id']\
+                                  .cat.categories,
+                          'seller_id':
+                              dimensions['sellers']['seller_id']\
+                                  .cat.categories}
+        tables = load_raw_data(shard_path, files,
+                               schema=control['schema'],
+                               date_columns=control['date_columns'],
+                               date_format=control['date_format'],
+                               workers=control['load_workers'],
+                               key_categories=key_categories)
+        customers = self._join_geolocation(tables['customers'])
+        self.tables = build_star_schema(customers=customers,
+                                        orders=tables['orders'],
+                                        order_items=tables['order_items'],
+                                        order_payments=tables['order_payments'],
+                                        order_reviews=tables['order_reviews'],
+                                        first_keys=first_keys,
+                                        **dimensions)
+        for key, (name, column) in SHARD_KEYS.items():
+            first_keys[key] += len(tables[name][column].cat.categories)
+        save_tables({name: self.tables[name] for name in PARTITIONED_INPUTS},
+                    shard_path)
+
+        self.purchases = join_purchases(self.tables,
+                                        control['purchase_columns'])
+        self.customer_index = build_customer_index(self.purchases)
+        feature_columns = self.columns_dict['numerical'] + \
+                          self.columns_dict['categorical']
+        save_data(self.purchases[UNLABELED_ID_COLUMNS + feature_columns]\
+                      .astype({column: object
+                               for column in UNLABELED_ID_COLUMNS}),
+                  shard_path + SHARD_FEATURES_FILE)
+        save_data(self._build_predictor_table(),
+                  shard_path + SHARD_PREDICTOR_TABLE_FILE)
+        save_data(self._get_latest_purchases(),
+                  shard_path + SHARD_LATEST_PURCHASES_FILE)
+        save_tables(summarize_product_buyers(self.purchases), shard_path)
+        return summarize_product_purchases(self.purchases)
+
+    def _combine_unlabeled_data(self, shard_paths):
+        # Encodes the model features of each shard into its own unlabeled
+        # rows and ids, which are then concatenated on disk
+        parts = []
+        for shard_path in shard_paths:
+            features = load_data(shard_path + SHARD_FEATURES_FILE)
+            if len(features) == 0:
+                continue
+            save_data(prepare_unlabeled_data(features, self.columns_dict,
+                                             encoders=self.classifier_encoders),
+                      shard_path + SHARD_UNLABELED_DATA_FILE)
+            save_data(features[UNLABELED_ID_COLUMNS],
+                      shard_path + SHARD_UNLABELED_IDS_FILE)
+            parts.append(shard_path)
+        concatenate_rows([part + SHARD_UNLABELED_DATA_FILE for part in parts],
+                         self.unlabeled_data_path)
+        concatenate_rows([part + SHARD_UNLABELED_IDS_FILE for part in parts],
+                         self.unlabeled_ids_path,
+                         row_group_size=UNLABELED_ID_ROW_GROUP_SIZE)
+
+    def update(self, batch_path):
+        # Appends a batch of new raw data to the prepared data without
+        # rebuilding it. The batch holds CSV files named as in the config input
+        # for any of BATCH_INPUTS, e.g. one day of orders, items, payments and
+        # reviews, and optionally geolocation rows for new zip codes.
+        # Only the customers and products the batch touches are recomputed,
+        # the fitted encoders and geolocation clusters are reused.
+        with stage('data_preparation_update'):
+            self._update(batch_path)
+
+    def _update(self, batch_path):
+        control = self.config['control']
+        files = {name: file for name, file in self.config['input'].items()
+                 if name in BATCH_INPUTS and
+                 os.path.exists(batch_path + file)}
+        with stage('load_batch') as record:
+            batch = load_raw_data(batch_path, files,
+                                  schema=control['schema'],
+                                  date_columns=control['date_columns'],
+                                  date_format=control['date_format'],
+                                  workers=control['load_workers'])
+            record['rows'] = sum(len(table) for table in batch.values())
+
+        self.tables = load_tables(self.tables_path)
+        self.geolocation = self.tables['geolocation']
+        geolocation_file = batch_path + self.config['input']['geolocation']
+        if os.path.exists(geolocation_file):
+            self._add_geolocation(geolocation_file)
+        self.zip_code_lookup = build_zip_code_lookup(self.geolocation)
+        for name in ['customers', 'sellers']:
+            if name in batch:
+                batch[name] = self._join_geolocation(batch[name])
+        if 'products' in batch:
+            translation_file = {'product_translation':
+                                self.config['input']['product_translation']}
+            self.product_translation = \
+                load_raw_data(self.data_path, translation_file,
+                              schema=control['schema'],
+                              date_columns=control['date_columns'],
+                              date_format=control['date_format'],
+                              workers=1)['product_translation']
+            batch['products'] = \
+                self._translate_product_categories(batch['products'])
+
+        with stage('append_to_tables') as record:
+            self.tables, affected_orders = \
+                append_to_star_schema(self.tables, **batch)
+            save_tables(self.tables, self.tables_path)
+            record['rows'] = len(affected_orders)
+        product_keys, customers, customer_orders = \
+            get_affected_keys(self.tables, affected_orders)
+        order_items = self.tables['order_items']
+
+        # Predictor rows of the affected customers are built again
+        with stage('classifier_data') as record:
+            self.classifier_encoders = load_data(self.encoder_path)
+            self.purchases = \
+                join_purchases(self.tables, control['purchase_columns'],
+                               items=order_items['order_key']\
+                                         .isin(customer_orders).values)
+            self.customer_index = build_customer_index(self.purchases)
+            self._update_classifier_data(customers)
+            latest_purchases = self._get_latest_purchases()
+            record['rows'] = len(self.purchases)
+
+        # Unlabeled rows follow the order items, rows of the touched orders
+        # are encoded again and the new ones appended
+        with stage('unlabeled_data') as record:
+            touched_items = \
+                order_items['order_key'].isin(affected_orders).values
+            self.purchases = join_purchases(self.tables,
+                                            control['purchase_columns'],
+                                            items=touched_items)
+            self._update_unlabeled_data(touched_items)
+            record['rows'] = len(self.purchases)
+
+        # Recommendation tables are recomputed for the affected products, from
+        # all of their purchases
+        with stage('product_recommendation_tables') as record:
+            self.purchases = \
+                join_purchases(self.tables, control['purchase_columns'],
+                               items=order_items['product_key']\
+                                         .isin(product_keys).values)
+            self.product_recommendation_tables = \
+                update_product_recommendation_tables(
+                    load_data(self.product_recommendation_table_path),
+                    self.purchases)
+            record['rows'] = len(self.purchases)
+
+        with stage('save'):
+            save_data(self.classifier_data, self.classifier_data_path)
+            save_data(self.predictor_table, self.predictor_table_path)
+            save_data(self.classifier_encoders, self.encoder_path)
+            self._queue_new_pairs()
+            self._save_unlabeled_data()
+            save_data(self.product_recommendation_tables,
+                      self.product_recommendation_table_path)
+            self._save_serving_bundle(
+                self._update_latest_purchases(customers, latest_purchases))
+            save_bundle({'encoders': self.classifier_encoders},
+                        self.serving_bundle_path)
+        # The prepared data no longer follows the raw files, so the next run
+        # prepares it from scratch
+        clear_cache_entries(self.cache_path, CACHED_STEPS)
+
+    def _update_classifier_data(self, customers):
+        # Replaces the predictor rows of the given customers
+        predictor_table = load_data(self.predictor_table_path)
+        classifier_data = load_data(self.classifier_data_path)
+        kept = ~predictor_table['customer_unique_id'].isin(customers).values
+
+        new_rows = self._build_predictor_table()
+        # Categories bought next for the first time become new labels
+        new_labels = add_labels(self.classifier_encoders['label_encoder'],
+                                new_rows[self.columns_dict['target'][0]])
+        if len(new_labels) > 0:
+            print(f'Added {len(new_labels)} new categories to the label '
+                  f'encoder')
+        new_data, known_targets = \
+            prepare_labeled_data(new_rows, self.columns_dict,
+                                 self.classifier_encoders)
+
+        # Rows of customers who had none before are new purchase pairs, the
+        # training rows of an incremental model update
+        new_rows = new_rows[known_targets]
+        new_pairs = ~new_rows['customer_unique_id']\
+                        .isin(predictor_table['customer_unique_id']).values
+        self.new_pairs = new_data[new_pairs]
+
+        self.predictor_table = pd.concat([predictor_table[kept], new_rows],
+                                         ignore_index=True)
+        self.classifier_data = sp.vstack((classifier_data[kept], new_data),
+                                         format='csr')
+
+    def _queue_new_pairs(self):
+        # Adds the new pairs to the ones queued by earlier updates, until
+        # the Modeller trains on them
+        if os.path.exists(self.new_pairs_path):
+            self.new_pairs = sp.vstack((load_data(self.new_pairs_path),
+                                        self.new_pairs), format='csr')
+        save_data(self.new_pairs, self.new_pairs_path)
+
+    def _update_latest_purchases(self, customers, latest_purchases):
+        # Replaces the latest purchases of the given customers in the bundle
+        saved_purchases = \
+            LazyBundle(self.serving_bundle_path)['latest_purchases']
+        kept = ~saved_purchases['customer_unique_id'].isin(customers).values
+        return pd.concat([saved_purchases[kept], latest_purchases],
+                         ignore_index=True)
+
+    def _update_unlabeled_data(self, touched_items):
+        # Encodes the touched order items into their rows of the unlabeled
+        # data, growing it for new items
+        # New items are always touched, so the untouched rows are all in the
+        # saved data. The rows are stacked and then put back in item order.
+        unlabeled_data = load_data(self.unlabeled_data_path)
+        untouched_rows = np.flatnonzero(~touched_items)
+        touched_rows = np.flatnonzero(touched_items)
+        new_data = prepare_unlabeled_data(self.purchases, self.columns_dict,
+                                          encoders=self.classifier_encoders)
+        unlabeled_data = sp.vstack((unlabeled_data[untouched_rows], new_data),
+                                   format='csr')
+        row_order = np.argsort(np.concatenate((untouched_rows, touched_rows)))
+
+        self.unlabeled_data = unlabeled_data[row_order]
+        self.unlabeled_ids = join_purchases(self.tables, UNLABELED_ID_COLUMNS)
     
-    def _join_data(self):
-        # Join all the relevant tables
-        # Geolocation and product category translation is done separately
-        tmp_pd = self.customers.merge(self.orders, on='customer_id', 
-                                      how='outer')
-        tmp_pd = tmp_pd.merge(self.order_items, how='outer')    
-        tmp_pd = tmp_pd.merge(self.order_payments, how='outer')
-        tmp_pd = tmp_pd.merge(self.order_reviews, how='outer')
-        tmp_pd = tmp_pd.merge(self.products, on='product_id', how='outer')
-        tmp_pd = tmp_pd.merge(self.sellers, on='seller_id', how='outer')
-
-
-        tmp_pd = join_coords(tmp_pd, self.geolocation)
-
-        tmp_pd = self._join_location(tmp_pd, join_column='location_cluster', 
-                                     left_on='customer_zip_code_prefix',
-                                     new_column_name='customer_location_cluster')
-        tmp_pd = self._join_location(tmp_pd, join_column='location_cluster',
-                                     left_on='seller_zip_code_prefix',
-                                     new_column_name='seller_location_cluster')
-
-        self.complete_data = tmp_pd
-
-    def _translate_product_categories(self):
-        tmp_pd = self.complete_data.merge(self.product_translation,
-                                          on='product_category_name',
-                                          how='outer')
+    def _build_tables(self):
+        # Geolocation is joined to the customer and seller tables, and the
+        # product categories are translated before normalizing
+        with stage('join_geolocation'):
+            self.zip_code_lookup = build_zip_code_lookup(self.geolocation)
+            customers = self._join_geolocation(self.customers)
+            sellers = self._join_geolocation(self.sellers)
+        with stage('translate_categories'):
+            products = self._translate_product_categories(self.products)
+
+        with stage('build_star_schema'):
+            self.tables = build_star_schema(customers=customers,
+                                            orders=self.orders,
+                                            order_items=self.order_items,
+                                            order_payments=self.order_payments,
+                                            order_reviews=self.order_reviews,
+                                            products=products,
+                                            sellers=sellers)
+        # Kept for placing new customers and sellers in incremental updates
+        self.tables['geolocation'] = self.geolocation
+
+    def _join_geolocation(self, data):
+        # Joins coordinates and location cluster for the zip codes in the data
+        return join_geolocation(data, self.zip_code_lookup)
+
+    def _translate_product_categories(self, products):
+        tmp_pd = products.merge(self.product_translation,
+                                on='product_category_name',
+                                how='left')
         tmp_pd.drop(columns=['product_category_name'], inplace=True)
         tmp_pd.rename(columns={'product_category_name_english':
                                'product_category_name'},
                       inplace=True)
 
-        self.complete_data = tmp_pd                                          
+        return tmp_pd
+
+    def _prepare_classifier_data(self, n_purchase=None):
+        with stage('predictor_table') as record:
+            predictor_table = self._build_predictor_table(n_purchase)
+            record['rows'] = len(predictor_table)
+        self._encode_classifier_data(predictor_table)
 
-    def _prepare_classifier_data(self, n_purchase=2):
+    def _encode_classifier_data(self, predictor_table):
+        with stage('encode'):
+            classifier_data, standard_scaler, oh_encoder, label_encoder = \
+                prepare_modelling_data(predictor_table, self.columns_dict)
+
+        self.classifier_encoders = {'standard_scaler': standard_scaler,
+                                    'one_hot_encoder': oh_encoder,
+                                    'label_encoder': label_encoder}   
+        self.predictor_table = predictor_table
+        self.classifier_data = classifier_data
+
+    def _build_predictor_table(self, n_purchase=None):
         # Get customers with multiple purchases
         # Their initial purchase will be used as a predictor for their 
         # follow-up purchase.
+        if n_purchase is None:
+            n_purchase = self.n_purchase
         relevant_customers = \
-            gather_customers_with_n_purchase(data=self.complete_data,
+            gather_customers_with_n_purchase(self.customer_index,
                                              n=n_purchase)
 
-        # Filter the complete data for these customers
+        # Filter the purchases for these customers
         classifier_data = \
-            filter_complete_data_by_customer(relevant_customers,
-                                             data=self.complete_data,
-                                             n=n_purchase)
+            filter_purchases_by_customer(relevant_customers,
+                                         self.customer_index,
+                                         n=n_purchase)
 
-        self.predictor_table = classifier_data
         # Organize data where each row contains columns as predictors
         # and the next purchase category as the target
-        classifier_data = \
+        predictor_table = \
             build_predictor_table(classifier_data,
                                   columns=self.classifier_columns)
-        classifier_data, standard_scaler, oh_encoder, label_encoder = \
-            prepare_modelling_data(classifier_data, self.columns_dict)
-
-        self.classifier_encoders = {'standard_scaler': standard_scaler,
-                                    'one_hot_encoder': oh_encoder,
-                                    'label_encoder': label_encoder}   
-        self.classifier_data = classifier_data
+        return predictor_table
 
     def _prepare_unlabeled_data(self):
         # Runs unlabeled data through the same processing as the labeled
         # (Except for targets)
         unlabeled_data = \
-            prepare_unlabeled_data(self.complete_data,
+            prepare_unlabeled_data(self.purchases,
                                    self.columns_dict,
                                    encoders=self.classifier_encoders)
 
         self.unlabeled_data = unlabeled_data
+        self.unlabeled_ids = self.purchases[UNLABELED_ID_COLUMNS]
+
+    def _save_unlabeled_data(self):
+        # The ids are saved as plain strings, row by row with the data
+        save_data(self.unlabeled_data, self.unlabeled_data_path)
+        save_data(self.unlabeled_ids.astype(object),
+                  self.unlabeled_ids_path,
+                  row_group_size=UNLABELED_ID_ROW_GROUP_SIZE)
 
-    def _average_geolocation(self):
+    def _average_geolocation(self, path=None):
         # Since zip codes have multiple entries for coordinates, and there is no
         # key showing which customer/seller it is, we have to average the
         # coordinates for each code.
-        self.geolocation = self.geolocation.groupby('geolocation_zip_code_prefix')\
-                                           .agg('mean')
+        # The file is streamed in chunks, see aggregate_geolocation
+        if path is None:
+            path = self.data_path + self.config['input']['geolocation']
+        self.geolocation = \
+            aggregate_geolocation(path,
+                                  schema=self.config['control']['schema']['geolocation'],
+                                  chunksize=self.config['control']['geolocation']['chunksize'])
 
     def _kmeans_geolocation(self):
         # Clusters the geolocation latitudes and longitudes
         # To reduce number of columns when location is later one hot encoded
-        kmeans = \
-            KMeans(n_clusters=self.config['control']['geolocation']['kmeans_clusters'])
-        clusters = kmeans.fit_predict(\
-            self.geolocation[['geolocation_lat', 'geolocation_lng']])
+        geolocation_config = self.config['control']['geolocation']
+        self.location_clusters = \
+            train_location_clusters(self.geolocation[GEOLOCATION_COORDINATES],
+                                    cluster_number=geolocation_config['kmeans_clusters'],
+                                    batch_size=geolocation_config['batch_size'],
+                                    random_state=geolocation_config['random_state'])
+        clusters = self.location_clusters.predict(
+            self.geolocation[GEOLOCATION_COORDINATES])
 
         self.geolocation['location_cluster'] = clusters
         self.geolocation.reset_index(inplace=True)
 
-    def _join_location(self, data, join_column, left_on=None,
-                       right_on='geolocation_zip_code_prefix',
-                       new_column_name=None):
-        # Joins the geolocation clusters to another table based on
-        # zip code prefixes
-        data = data.merge(self.geolocation[[right_on, join_column]], 
-                          left_on=left_on,
-                          right_on=right_on,
-                          how='left')
-
-        if new_column_name is not None:
-            data.rename(columns={join_column: new_column_name},
-                        inplace=True)
-        
-        return data
+    def _add_geolocation(self, path):
+        # Adds the zip codes of a batch that are not known yet, assigned to
+        # the saved location clusters. Known zip codes keep their coordinates
+        # and clusters, since the prepared data was joined with them.
+        known_geolocation = self.geolocation
+        self._average_geolocation(path)
+        new_geolocation = \
+            self.geolocation[~self.geolocation.index.isin(
+                known_geolocation['geolocation_zip_code_prefix'])]
+        self.geolocation = known_geolocation
+        if len(new_geolocation) == 0:
+            return
+
+        location_clusters = load_data(self.location_cluster_model_path)
+        clusters = \
+            location_clusters.predict(new_geolocation[GEOLOCATION_COORDINATES])
+        new_geolocation = new_geolocation.assign(location_cluster=clusters)\
+                                         .reset_index()
+
+        self.geolocation = pd.concat([known_geolocation, new_geolocation],
+                                     ignore_index=True)
+        self.tables['geolocation'] = self.geolocation
 
     def _flatten_columns_dict(self):
         flat_columns = []
@@ -1,9 +1,14 @@
-import numpy as np
+import os
 import yaml
 
 from logic.modelling import (evaluate_model_with_cv,
-                             train_model)
-from utils import save_data, load_data
+                             select_penalty,
+                             train_model,
+                             to_incremental_model,
+                             export_scorer)
+from utils import (save_data, load_data, save_bundle, LazyBundle,
+                   fingerprint, is_cached, store_cache_entry, stage,
+                   configure_instrumentation)
 
 
 class Modeller():
@@ -12,19 +17,93 @@ class Modeller():
         with open(config_path) as stream:
             self.config = yaml.safe_load(stream)
         
-        self.classifier_data = \
-            load_data(self.config['input']['classifier_data_path'])
+        # Loaded only when training in full
+        self.classifier_data = None
+        self.new_pairs_path = self.config['input']['new_pairs_path']
+        configure_instrumentation(self.config['control']['instrumentation'])
         self.classifier_cv_score = None
+        self.classifier_penalty = None
         self.classifier_model = None
 
     def run(self):
+        with stage('modelling'):
+            self._run()
+
+    def _run(self):
+        # Training is skipped while the classifier data and config are
+        # unchanged since the model was last trained
+        cache_path = self.config['output']['cache_path']
+        model_path = self.config['output']['model_path']
+        use_cache = self.config['control']['use_cache']
+        run_fingerprint = \
+            fingerprint(cache_path,
+                        paths=[self.config['input']['classifier_data_path']],
+                        config=self.config)
+        if use_cache and is_cached(cache_path, 'modelling', run_fingerprint,
+                                   [model_path]):
+            print('Modelling inputs unchanged, reusing the trained model')
+            self.classifier_model = load_data(model_path)
+            self._save_serving_bundle()
+            return
+
+        if self.config['control']['training_mode'] == 'incremental' and \
+           os.path.exists(self.new_pairs_path) and os.path.exists(model_path):
+            self._update_model(model_path)
+        else:
+            self._train_model(model_path)
+        self._save_serving_bundle()
+        # Queued pairs are in the classifier data the model now follows
+        if os.path.exists(self.new_pairs_path):
+            os.remove(self.new_pairs_path)
+        if use_cache:
+            store_cache_entry(cache_path, 'modelling', run_fingerprint)
+
+    def _train_model(self, model_path):
         # Split data into predictors and targets
-        X, y = self._split_data()
-        self.classifier_cv_score = evaluate_model_with_cv(X, y, self.config)
-        self.classifier_model = train_model(X, y)
-        save_data(self.classifier_model, self.config['output']['model_path'])
-
-    def _split_data(self):
-        X = np.asarray(self.classifier_data[:,:-1])
-        y = np.asarray(self.classifier_data[:,-1])
+        self.classifier_data = \
+            load_data(self.config['input']['classifier_data_path'])
+        X, y = self._split_data(self.classifier_data)
+        with stage('cross_validation') as record:
+            self.classifier_cv_score = evaluate_model_with_cv(X, y,
+                                                              self.config)
+            record['rows'] = X.shape[0]
+        # The final model is trained with the best penalty found by the CV
+        self.classifier_penalty = select_penalty(self.classifier_cv_score)
+        print(f'Training with l2 penalty = {self.classifier_penalty}')
+        with stage('training'):
+            self.classifier_model = train_model(X, y,
+                                                penalty=self.classifier_penalty)
+        save_data(self.classifier_model, model_path)
+
+    def _update_model(self, model_path):
+        # Trains the saved model further on the pairs queued since it was
+        # trained, rather than on all of the classifier data. Categories new
+        # to the model are added as classes.
+        X, y = self._split_data(load_data(self.new_pairs_path))
+        print(f'Updating the model with {X.shape[0]} new pairs')
+        with stage('incremental_training') as record:
+            self.classifier_model = \
+                to_incremental_model(load_data(model_path),
+                                     **self.config['control']['incremental'])
+            if X.shape[0] > 0:
+                self.classifier_model.partial_fit(X, y)
+            record['rows'] = X.shape[0]
+        save_data(self.classifier_model, model_path)
+
+    def _save_serving_bundle(self):
+        # Also written when the model is reused, the bundle may have been
+        # prepared again since
+        # The compiled scorer is the model with the encoders of the bundle,
+        # for predicting without sklearn
+        bundle_path = self.config['output']['serving_bundle_path']
+        bundle = LazyBundle(bundle_path)
+        scorer = export_scorer(self.classifier_model, bundle['encoders'],
+                               bundle['columns_dict'])
+        save_bundle({'model': self.classifier_model, 'scorer': scorer},
+                    bundle_path)
+
+    def _split_data(self, data):
+        # The features stay sparse, the targets are the last column
+        X = data[:,:-1]
+        y = data[:,-1].toarray().ravel()
         return X, y
\ No newline at end of file
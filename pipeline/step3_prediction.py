@@ -1,7 +1,25 @@
+import os
+import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 import yaml
-from utils import load_data, trim_id
-from logic.data_preparation import prepare_unlabeled_data
-from logic.prediction import get_recommended_product 
+from utils import (load_data, save_data, load_tables, trim_id,
+                   fingerprint, is_cached, store_cache_entry, file_signature,
+                   LRUCache, LazyBundle, stage, configure_instrumentation,
+                   BUNDLE_MANIFEST)
+from logic.data_preparation import (prepare_unlabeled_data, join_purchases,
+                                    build_customer_index)
+from logic.scoring import predict_categories
+from logic.prediction import (get_recommended_product,
+                              get_empty_recommendation,
+                              get_latest_purchases,
+                              get_recommended_products_batch)
+
+# Predictor of the running recommend_all call, inherited by the forked workers
+# with its loaded tables rather than sent to them
+_recommendation_job = None
 
 
 class Predictor():
@@ -9,32 +27,111 @@ class Predictor():
         # General attributes
         with open(config_path) as stream:
             self.config = yaml.safe_load(stream)
+        configure_instrumentation(self.config['control']['instrumentation'])
         
-        self.complete_data = \
-            load_data(self.config['input']['complete_data_path'])
-        self.data = load_data(self.config['input']['data_path'])
-        self.model = load_data(self.config['input']['model_path'])
-        self.encoders = load_data(self.config['input']['encoder_path'])
-        self.columns_dict = \
-            load_data(self.config['input']['classifier_columns_path'])
+        # The purchases and unlabeled data are only loaded if used, see the
+        # properties below
+        self._purchases = None
+        self._data = None
+
+        # Model, encoders and recommendation tables come from the serving
+        # bundle, the tables are loaded one by one on first use
+        self.serving_manifest_path = \
+            os.path.join(self.config['input']['serving_bundle_path'],
+                         BUNDLE_MANIFEST)
+        self.serving_bundle = None
+        self.serving_bundle_signature = None
+        self._latest_purchase_index = None
+        self.columns_dict = None
+        self.product_recommendation_tables = None
+        self.use_scorer = self.config['control']['use_scorer']
+        self.use_location_cluster = \
+            self.config['control']['use_location_cluster']
+
+        # Parts of the recommendations shared by customers with the same
+        # predicted category and location cluster
+        cache_config = self.config['control']['recommendation_cache']
+        self.recommendation_cache = LRUCache(max_size=cache_config['max_size'],
+                                             ttl=cache_config['ttl_s'])
+        self._refresh_serving_bundle()
+
+    def _refresh_serving_bundle(self):
+        # Opens the serving bundle again if it was written since it was
+        # opened, the cached recommendations are cleared with it
+        signature = file_signature(self.serving_manifest_path)
+        if signature == self.serving_bundle_signature:
+            return
+
+        self.serving_bundle = \
+            LazyBundle(self.config['input']['serving_bundle_path'])
+        self.serving_bundle_signature = signature
+        self.columns_dict = self.serving_bundle['columns_dict']
+        self.product_recommendation_tables = self.serving_bundle
+        self._latest_purchase_index = None
+        self.recommendation_cache.clear()
+
+    @property
+    def model(self):
+        return self.serving_bundle['model']
+
+    @property
+    def encoders(self):
+        return self.serving_bundle['encoders']
 
-        self.product_recommendation_tables = \
-            load_data(self.config['input']['product_recommendation_table_path'])
+    @property
+    def latest_purchase_index(self):
+        # Latest purchases of the serving bundle by customer, so a batch only
+        # reads the rows of its customers
+        if self._latest_purchase_index is None:
+            self._latest_purchase_index = \
+                build_customer_index(self.serving_bundle['latest_purchases'])
+        return self._latest_purchase_index
+
+    @property
+    def purchases(self):
+        # One row per purchased item, with only the columns used for
+        # prediction joined from the fact and dimension tables
+        if self._purchases is None:
+            self._purchases = self._load_purchases()
+        return self._purchases
+
+    @property
+    def data(self):
+        # Unlabeled data, encoded like the classifier data
+        if self._data is None:
+            self._data = load_data(self.config['input']['data_path'])
+        return self._data
+
+    def _load_purchases(self):
+        # The joined purchases are reused while the tables are unchanged
+        tables_path = self.config['input']['tables_path']
+        purchases_path = self.config['output']['purchases_path']
+        cache_path = self.config['output']['cache_path']
+        purchase_columns = self.config['control']['purchase_columns']
+        use_cache = self.config['control']['use_cache']
+        purchases_fingerprint = fingerprint(cache_path, paths=[tables_path],
+                                            config=purchase_columns)
+        if use_cache and is_cached(cache_path, 'prediction_purchases',
+                                   purchases_fingerprint, [purchases_path]):
+            return load_data(purchases_path)
+
+        purchases = join_purchases(load_tables(tables_path), purchase_columns)
+        if use_cache:
+            save_data(purchases, purchases_path)
+            store_cache_entry(cache_path, 'prediction_purchases',
+                              purchases_fingerprint)
+        return purchases
 
     def predict_category_random(self, sample_size=5, to_print=True):
-        sample = self.complete_data.sample(n=sample_size, random_state=None)
+        sample = self.purchases.sample(n=sample_size, random_state=None)
         # Generates product category prediction for a random sample 
-        # of the complete data
-        prepared_data = prepare_unlabeled_data(sample, self.columns_dict, 
-                                               self.encoders)
-        
+        # of the purchases
         if to_print:
             print(f'Running prediction for sample:\n{sample}')
-        predictions = self.model.predict(prepared_data)
+        with stage('predict_category') as record:
+            predictions_string = self._predict_categories(sample)
+            record['rows'] = len(sample)
         
-        label_encoder = self.encoders['label_encoder']
-        predictions_string = \
-            label_encoder.inverse_transform(predictions.astype(int))
         if to_print:
             print(f'\nPredictions:\n{predictions_string}')
         
@@ -43,20 +140,149 @@ class Predictor():
         return sample
 
     def predict_product_random(self, sample_size=2, product_number=3, estimation_n=5):
+        self._refresh_serving_bundle()
         category_predictions = \
             self.predict_category_random(sample_size=sample_size,
                                          to_print=False)
         recommendations = {}
         for _, row in category_predictions.iterrows():
-            recommendation = get_recommended_product(row, self.complete_data,
+            # Rows with missing features have no predicted category
+            if pd.isna(row['predicted_category']):
+                recommendations[row['customer_unique_id']] = \
+                    get_empty_recommendation()
+                continue
+            recommendation = get_recommended_product(row,
                                              self.product_recommendation_tables,
                                              product_number=product_number,
-                                             estimation_n=estimation_n)
+                                             estimation_n=estimation_n,
+                                             use_location_cluster=self.use_location_cluster,
+                                             cache=self.recommendation_cache)
 
             recommendations[row['customer_unique_id']] = recommendation
 
         return category_predictions, recommendations
 
+    def recommend_batch(self, customer_ids, product_number=3, estimation_n=5,
+                        random_state=None):
+        # Generates product recommendations for many customers at once
+        # The next category is predicted from each customer's latest purchase
+        # in one model call, products and expected values are then resolved
+        # for the whole batch with grouped joins.
+        # Returns one row per customer and recommended product.
+        with stage('recommend_batch') as record:
+            record['rows'] = len(customer_ids)
+            return self._recommend_batch(customer_ids, product_number,
+                                         estimation_n, random_state)
+
+    def recommend_all(self, customer_ids=None, product_number=3,
+                      estimation_n=5, random_state=None):
+        # Generates product recommendations for many customers, every customer
+        # with a latest purchase by default, spread over worker processes
+        # Customers are split into partitions of 'partition_size' in their
+        # given order. Each partition is recommended with its own seed derived
+        # from 'random_state' and the results are concatenated in partition
+        # order, so the output does not depend on the number of workers.
+        # Returns one row per customer and recommended product.
+        with stage('recommend_all') as record:
+            recommendations = self._recommend_all(customer_ids, product_number,
+                                                  estimation_n, random_state)
+            record['rows'] = len(recommendations)
+        return recommendations
+
+    def _recommend_all(self, customer_ids, product_number, estimation_n,
+                       random_state):
+        global _recommendation_job
+        parallel_config = self.config['control']['parallel_recommendation']
+        self._refresh_serving_bundle()
+        if customer_ids is None:
+            customer_ids = self.latest_purchase_index['customers']
+        customer_ids = pd.unique(np.asarray(customer_ids, dtype=object))
+        partition_size = parallel_config['partition_size']
+        partitions = [customer_ids[start:start + partition_size]
+                      for start in range(0, len(customer_ids), partition_size)]
+        seeds = np.random.SeedSequence(random_state)\
+                         .generate_state(len(partitions))
+        jobs = [(partition, product_number, estimation_n, int(seed))
+                for partition, seed in zip(partitions, seeds)]
+
+        # The location index and product statistics are .npy files of the
+        # bundle, memory-mapped read-only, so the workers share them through
+        # the page cache. The other artifacts are loaded before the workers
+        # are forked and start out sharing this process's pages. Freezing the
+        # garbage collector keeps the workers' collections from writing to
+        # them, only the objects a worker uses get copied. Where processes
+        # cannot be forked (Windows), the partitions are recommended in this
+        # process.
+        workers = parallel_config['workers']
+        if workers > 1 and len(jobs) > 1 and \
+           'fork' in multiprocessing.get_all_start_methods():
+            for name in self.serving_bundle:
+                self.serving_bundle[name]
+            _recommendation_job = {'predictor': self}
+            context = multiprocessing.get_context('fork')
+            gc.freeze()
+            try:
+                with ProcessPoolExecutor(max_workers=workers,
+                                         mp_context=context) as executor:
+                    results = list(executor.map(_recommend_partition, jobs))
+            finally:
+                gc.unfreeze()
+                _recommendation_job = None
+        else:
+            results = [self._recommend_batch(*job) for job in jobs]
+
+        if not results:
+            return self._recommend_batch(customer_ids, product_number,
+                                         estimation_n, None)
+        return pd.concat(results, ignore_index=True)
+
+    def _recommend_batch(self, customer_ids, product_number, estimation_n,
+                         random_state):
+        # Only the latest purchase of each customer is loaded for serving
+        self._refresh_serving_bundle()
+        feature_columns = self.columns_dict['numerical'] + \
+                          self.columns_dict['categorical']
+        with stage('latest_purchases'):
+            latest_purchases = \
+                get_latest_purchases(self.latest_purchase_index,
+                                     customer_ids, feature_columns)
+        if len(latest_purchases) == 0:
+            # None of the customers have a purchase to predict from
+            return latest_purchases
+
+        with stage('predict_category'):
+            latest_purchases['predicted_category'] = \
+                self._predict_categories(latest_purchases)
+
+        with stage('recommend_products'):
+            recommendations = \
+                get_recommended_products_batch(latest_purchases,
+                                               self.product_recommendation_tables,
+                                               product_number=product_number,
+                                               estimation_n=estimation_n,
+                                               use_location_cluster=self.use_location_cluster,
+                                               random_state=random_state,
+                                               cache=self.recommendation_cache)
+
+        return recommendations
+
+    def _predict_categories(self, data):
+        # Next product category for each row of the data
+        if self.use_scorer:
+            return predict_categories(self.serving_bundle['scorer'], data)
+
+        # Rows with missing features get None, as with the scorer
+        prepared_data = prepare_unlabeled_data(data, self.columns_dict,
+                                               self.encoders)
+        complete = ~np.isnan(np.asarray(prepared_data.sum(axis=1)).ravel())
+        categories = np.full(len(complete), None, dtype=object)
+        if complete.any():
+            predictions = self.model.predict(prepared_data[complete])
+            label_encoder = self.encoders['label_encoder']
+            categories[complete] = \
+                label_encoder.inverse_transform(predictions.astype(int))
+        return categories
+
     def print_product_recommendation(self, sample_size=2, verbose=False,
                                      product_number=3, estimation_number=5):
         # Prints predictions per customer for a given sample size
@@ -73,6 +299,8 @@ class Predictor():
             customer = row['customer_unique_id']
             previous_category = row['product_category_name']
             predicted_category = row['predicted_category']
+            if pd.isna(predicted_category):
+                predicted_category = 'n/a'
             rec_customer = recommendations[customer]
 
             left_column = 35
@@ -105,3 +333,7 @@ class Predictor():
             
             print(f'{"":#^50}\n\n')
 
+
+def _recommend_partition(job):
+    # Recommendations for one partition of recommend_all, in a worker
+    return _recommendation_job['predictor']._recommend_batch(*job)
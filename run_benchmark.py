@@ -0,0 +1,7 @@
+from pipeline import benchmark
+
+# Stages run in spawned processes where processes cannot be forked, they
+# import this module again
+if __name__ == '__main__':
+    benchmark_runner = benchmark.Benchmark(config_path='config/benchmark.yaml')
+    benchmark_runner.run()
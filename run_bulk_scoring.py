@@ -0,0 +1,7 @@
+from pipeline import bulk_scoring
+
+# Workers are spawned where processes cannot be forked, they import this
+# module again
+if __name__ == '__main__':
+    bulk_scorer = bulk_scoring.BulkScorer(config_path='config/bulk_scoring.yaml')
+    bulk_scorer.run()
@@ -6,5 +6,7 @@ predictor = step3_prediction.Predictor(config_path='config/step3_prediction.yaml
 #%%
 # predictor.predict_product_random()
 #%%
+# predictor.recommend_all(random_state=42)
+#%%
 predictor.print_product_recommendation(sample_size=2, verbose=False,
                                        product_number=3)
@@ -0,0 +1,5 @@
+from pipeline import recommendation_service
+
+service = recommendation_service.RecommendationService(
+    config_path='config/recommendation_service.yaml')
+service.run()
@@ -0,0 +1,244 @@
+import os
+import numpy as np
+import pandas as pd
+import yaml
+
+from logic.synthetic_data import generate_olist_data
+from pipeline.step1_data_preparation import DataPreparator, MAX_SHARD_SPLITS
+from utils import load_data, load_tables
+from logic.data_preparation import (_share_key_categories,
+                                    append_to_star_schema,
+                                    prepare_customer_location_index,
+                                    update_customer_location_index,
+                                    prepare_serving_product_tables,
+                                    summarize_product_purchases,
+                                    merge_product_summaries,
+                                    BUYER_STATISTICS, PRODUCT_VALUES)
+
+SCHEMA = {'orders': {'order_id': 'key', 'customer_id': 'key'},
+          'order_reviews': {'order_id': 'key', 'review_score': 'int8'}}
+
+def test_shared_key_categories_are_sorted_in_every_table():
+    # Large files are read in chunks, which leaves their categories in the
+    # order the values were found, so two tables can hold the same ids in
+    # categories of a different order
+    orders = pd.DataFrame(
+        {'order_id': pd.Categorical(['b', 'a', 'c'],
+                                    categories=['b', 'a', 'c']),
+         'customer_id': pd.Categorical(['x', 'y', 'z'])})
+    reviews = pd.DataFrame(
+        {'order_id': pd.Categorical(['c', 'a', 'b'],
+                                    categories=['c', 'a', 'b']),
+         'review_score': [1, 2, 3]})
+    tables = {'orders': orders, 'order_reviews': reviews}
+
+    _share_key_categories(tables, SCHEMA)
+
+    for table in tables.values():
+        column = table['order_id']
+        assert list(column.cat.categories) == ['a', 'b', 'c']
+        assert list(column.cat.categories[column.cat.codes]) == \
+               list(column.astype(str))
+    assert list(tables['orders']['order_id'].cat.codes) == [1, 0, 2]
+    assert list(tables['order_reviews']['order_id'].cat.codes) == [2, 0, 1]
+
+def _purchases(seed, products, customers, rows):
+    rng = np.random.RandomState(seed)
+    data = pd.DataFrame(
+        {'product_id': rng.choice(products, rows),
+         'customer_unique_id': rng.choice(customers, rows),
+         'customer_geolocation_lat': rng.uniform(-30, 0, rows),
+         'customer_geolocation_lng': rng.uniform(-60, -35, rows)})
+    data.loc[rng.rand(rows) < 0.1, 'customer_geolocation_lat'] = np.nan
+    return data
+
+def _product_slices(location_index):
+    slices = {}
+    for product, (start, located_end, end) in \
+            location_index['offsets'].items():
+        slices[product] = \
+            (located_end - start,
+             sorted(location_index['customers'][start:end]),
+             sorted(map(tuple, location_index['coordinates']
+                                              [start:located_end])))
+    return slices
+
+def test_updated_location_index_has_the_size_of_a_fresh_build():
+    products = ['p{}'.format(i) for i in range(20)]
+    customers = ['c{}'.format(i) for i in range(300)]
+    data = _purchases(0, products, customers, 2000)
+    location_index = prepare_customer_location_index(data)
+
+    for seed in [1, 2]:
+        batch = _purchases(seed, products[:5], customers, 200)
+        data = pd.concat([data, batch], ignore_index=True)
+        affected = data[data['product_id'].isin(batch['product_id'])]
+        location_index = update_customer_location_index(
+            location_index, prepare_customer_location_index(affected))
+
+    fresh_index = prepare_customer_location_index(data)
+    assert len(location_index['customers']) == \
+           len(fresh_index['customers'])
+    assert len(location_index['coordinates']) == \
+           len(fresh_index['coordinates'])
+    assert _product_slices(location_index) == _product_slices(fresh_index)
+    assert location_index['trees'].keys() == fresh_index['trees'].keys()
+
+def test_serving_tables_hold_the_buyers_and_statistics_of_each_product():
+    products = ['p{}'.format(i) for i in range(20)]
+    customers = ['c{}'.format(i) for i in range(300)]
+    data = _purchases(0, products, customers, 2000)
+    data['customer_location_cluster'] = \
+        np.random.RandomState(0).randint(0, 4, len(data)).astype(float)
+    for value in PRODUCT_VALUES:
+        data[value] = np.random.RandomState(1).rand(len(data))
+    buyer_statistics = data.groupby(['product_id', 'customer_unique_id'])\
+                           [PRODUCT_VALUES].agg(['sum', 'count'])
+    buyer_statistics.columns = [value + '_' + statistic for value, statistic
+                                in buyer_statistics.columns]
+    rec_tables = {'customer_location_index':
+                      prepare_customer_location_index(data),
+                  'product_buyer_statistics': buyer_statistics,
+                  'product_statistics':
+                      data.groupby('product_id')[PRODUCT_VALUES].mean(),
+                  'product_cluster_statistics':
+                      data.groupby(['product_id',
+                                    'customer_location_cluster'])\
+                          [PRODUCT_VALUES].mean()}
+
+    tables = prepare_serving_product_tables(rec_tables)
+
+    assert list(tables['product_ids']) == sorted(products)
+    location_slices = _product_slices(rec_tables['customer_location_index'])
+    for code, product in enumerate(tables['product_ids']):
+        start, located_end, end = tables['product_buyer_offsets'][code]
+        buyers = tables['customer_ids'][tables['buyer_customers'][start:end]]
+        assert (located_end - start, sorted(buyers),
+                sorted(map(tuple, tables['buyer_coordinates']
+                                            [start:located_end]))) == \
+               location_slices[product]
+        expected = buyer_statistics.loc[product].loc[buyers, BUYER_STATISTICS]
+        assert np.allclose(tables['buyer_statistics'][start:end],
+                           expected.values)
+        assert np.allclose(tables['product_statistics'][code],
+                           rec_tables['product_statistics'].loc[product])
+        for cluster in range(4):
+            key = cluster * len(products) + code
+            position = np.searchsorted(tables['product_cluster_keys'], key)
+            assert np.allclose(tables['product_cluster_statistics'][position],
+                               rec_tables['product_cluster_statistics']\
+                                   .loc[(product, cluster)])
+
+def test_merged_shard_summaries_match_the_summary_of_all_purchases():
+    # Shards hold disjoint customers, so the sums, counts and distinct buyers
+    # of their summaries add up to those of all the purchases
+    products = ['p{}'.format(i) for i in range(20)]
+    customers = ['c{}'.format(i) for i in range(300)]
+    data = _purchases(0, products, customers, 2000)
+    rng = np.random.RandomState(1)
+    data['product_category_name'] = \
+        data['product_id'].map(lambda product: 'k' + product[-1])
+    data['customer_location_cluster'] = \
+        rng.randint(0, 4, len(data)).astype(float)
+    data['review_score'] = rng.randint(1, 6, len(data))
+    data['price'] = rng.rand(len(data)) * 100
+    data['freight_value'] = rng.rand(len(data)) * 10
+    data['order_purchase_timestamp'] = \
+        pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.rand(len(data)), 'D')
+    data['order_delivered_customer_date'] = \
+        data['order_purchase_timestamp'] + \
+        pd.to_timedelta(rng.rand(len(data)) * 20, 'D')
+    shard = data['customer_unique_id'].str[-1].astype(int) % 3
+
+    summary = summarize_product_purchases(data)
+    merged = merge_product_summaries(
+        [summarize_product_purchases(data[shard == part]) for part in range(3)])
+
+    for name in ['review_sums', 'product_sums', 'cluster_sums']:
+        expected = summary[name].sort_index()
+        pd.testing.assert_index_equal(merged[name].index, expected.index)
+        assert np.allclose(merged[name].values, expected.values)
+    buyer_counts = lambda products: \
+        products.set_index('product_id')['buyer_count'].sort_index()
+    pd.testing.assert_series_equal(buyer_counts(merged['product_buyers']),
+                                   buyer_counts(summary['product_buyers']))
+    cluster_products = lambda products: \
+        set(map(tuple, products.astype(str).values))
+    assert cluster_products(merged['cluster_products']) == \
+           cluster_products(summary['cluster_products'])
+
+def test_appended_orders_do_not_take_the_keys_of_unknown_orders():
+    # Items of an order missing from the orders table keep the key of its
+    # ID, which lies above the keys of the known orders
+    tables = {'customers': pd.DataFrame({'customer_id': pd.Categorical(['x']),
+                                         'customer_key': np.int32([0])}),
+              'orders': pd.DataFrame({'order_key': np.int32([0]),
+                                      'customer_key': np.int32([0]),
+                                      'review_score': [5.0]}),
+              'order_items': pd.DataFrame({'order_key': np.int32([0, 1]),
+                                           'price': [10.0, 11.0]}),
+              'order_payments': pd.DataFrame({'order_key': np.int32([0])}),
+              'order_reviews': pd.DataFrame({'order_key': np.int32([0]),
+                                             'review_score': [5]})}
+    tables['orders'].insert(0, 'order_id', pd.Categorical(['a']))
+    orders = pd.DataFrame({'order_id': ['c'], 'customer_id': ['x']})
+
+    tables, affected_orders = append_to_star_schema(tables, orders=orders)
+
+    assert list(tables['orders']['order_key']) == [0, 2]
+    assert list(affected_orders) == [2]
+
+def _prepare(tmp_path, name, **partitioning):
+    # Runs the data preparation on the raw data in 'tmp_path', with its
+    # outputs under 'tmp_path/name' and the given partitioning settings
+    with open('config/step1_data_preparation.yaml') as stream:
+        config = yaml.safe_load(stream)
+    output_path = str(tmp_path / name) + '/'
+    for output, path in config['output'].items():
+        config['output'][output] = output_path + path
+        os.makedirs(os.path.dirname(output_path + path), exist_ok=True)
+    config['control']['use_cache'] = False
+    config['control']['partitioning'].update(partitioning)
+    config_path = output_path + 'config.yaml'
+    with open(config_path, 'w') as stream:
+        yaml.safe_dump(config, stream)
+    DataPreparator(data_path=str(tmp_path / 'raw') + '/',
+                   config_path=config_path).run()
+    return config['output']
+
+def test_shards_split_by_measured_footprint_give_the_outputs_of_a_full_run(
+        tmp_path, monkeypatch):
+    with open('config/step1_data_preparation.yaml') as stream:
+        files = yaml.safe_load(stream)['input']
+    generate_olist_data(str(tmp_path / 'raw') + '/', files, random_state=0,
+                        n_customers=400, n_products=60, n_sellers=10,
+                        n_zip_codes=40, n_categories=5,
+                        geolocation_rows_per_zip=3)
+    prepared_shards = []
+    prepare_shard = DataPreparator._prepare_shard
+    def count_shard(self, shard_path, *args):
+        prepared_shards.append(shard_path)
+        return prepare_shard(self, shard_path, *args)
+    monkeypatch.setattr(DataPreparator, '_prepare_shard', count_shard)
+
+    outputs = _prepare(tmp_path, 'full', enabled=False)
+    # A budget far below the size of the raw data, so shards are split
+    shard_outputs = _prepare(tmp_path, 'shards', enabled=True,
+                             partitions=None, memory_budget_mb=0.1)
+
+    initial_shards = len({os.path.relpath(path, shard_outputs['shards_path'])
+                              .split(os.sep)[0] for path in prepared_shards})
+    assert initial_shards < len(prepared_shards) <= \
+           initial_shards * MAX_SHARD_SPLITS
+    tables = load_tables(outputs['tables_path'])
+    shard_tables = load_tables(shard_outputs['tables_path'])
+    assert {name: len(table) for name, table in tables.items()} == \
+           {name: len(table) for name, table in shard_tables.items()}
+    rec_tables = load_data(outputs['product_recommendation_table_path'])
+    shard_rec_tables = \
+        load_data(shard_outputs['product_recommendation_table_path'])
+    for name, columns in [('product_statistics', PRODUCT_VALUES),
+                          ('avg_score_per_product', ['review_score'])]:
+        pd.testing.assert_frame_equal(
+            shard_rec_tables[name][columns].sort_index(),
+            rec_tables[name][columns].sort_index(), check_dtype=False)
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from logic.scoring import predict_categories
+from logic.prediction import get_top_n_products_by_score
+from pipeline.step3_prediction import Predictor
+from utils import LRUCache
+
+SCORER = {'numerical': ['price'],
+          'categorical': ['product_category_name'],
+          'numerical_weights': np.array([[-1.0, 1.0]]),
+          'intercept': np.array([0.0, 0.0]),
+          'category_weights': np.array([[0.5, 0.0],
+                                        [0.0, 0.0]]),
+          'category_rows': [{'toys': 0}],
+          'classes': np.array(['category_00', 'category_01'])}
+
+def test_rows_with_missing_numerical_features_get_no_category():
+    data = {'price': [2.0, np.nan, -2.0],
+            'product_category_name': ['toys', 'toys', 'books']}
+
+    categories = predict_categories(SCORER, data)
+
+    assert list(categories) == ['category_01', None, 'category_00']
+
+def _predictor(purchases):
+    # Predictor scoring 'purchases' with SCORER, without a serving bundle
+    predictor = Predictor.__new__(Predictor)
+    predictor._purchases = purchases
+    predictor.serving_bundle = {'scorer': SCORER}
+    predictor.product_recommendation_tables = {}
+    predictor.use_scorer = True
+    predictor.use_location_cluster = False
+    predictor.recommendation_cache = LRUCache(max_size=10, ttl=None)
+    predictor._refresh_serving_bundle = lambda: None
+    return predictor
+
+def test_customers_without_a_predicted_category_get_no_recommendations(
+        capsys):
+    # Orders without a review have no review score, and so no category
+    purchases = pd.DataFrame({'customer_unique_id': ['c0', 'c1'],
+                              'price': [np.nan, np.nan],
+                              'product_category_name': ['toys', 'books'],
+                              'customer_location_cluster': [0.0, 1.0]})
+    predictor = _predictor(purchases)
+
+    predictions, recommendations = \
+        predictor.predict_product_random(sample_size=2)
+
+    assert list(predictions['predicted_category']) == [None, None]
+    for customer in ['c0', 'c1']:
+        assert len(recommendations[customer]['products']) == 0
+        assert recommendations[customer]['expected_values'] == {}
+
+    predictor.print_product_recommendation(sample_size=2)
+    assert capsys.readouterr().out.count('n/a') == 2
+
+def test_categories_with_few_products_recommend_all_of_them():
+    products = pd.DataFrame({'product_id': ['p0', 'p1', 'p2'],
+                             'review_score': [5.0, 4.0, 3.0],
+                             'sole_buyer': [None, 'c0', None]})
+
+    top_n_products = get_top_n_products_by_score(products, 'c0',
+                                                 product_number=3,
+                                                 estimation_n=5)
+
+    assert sorted(top_n_products['product_id']) == ['p0', 'p2']
@@ -0,0 +1,83 @@
+import sys
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from utils import (save_data, load_data, load_rows, count_rows,
+                   concatenate_rows, Instrumentation)
+
+def test_load_rows_reads_a_range_of_rows_of_a_csr_matrix(tmp_path):
+    path = str(tmp_path / 'data.csr')
+    matrix = sp.random(103, 7, density=0.3, format='csr', random_state=0)
+    save_data(matrix, path)
+
+    assert count_rows(path) == 103
+    assert (load_data(path) != matrix).nnz == 0
+    for start, end in [(0, 10), (10, 103), (100, 200), (5, 5)]:
+        rows = load_rows(path, start, end)
+        assert rows.shape == matrix[start:end].shape
+        assert (rows != matrix[start:end]).nnz == 0
+
+def test_load_rows_reads_a_range_of_rows_across_row_groups(tmp_path):
+    path = str(tmp_path / 'ids.parquet')
+    data = pd.DataFrame({'order_id': [str(row) for row in range(103)],
+                         'row': np.arange(103)})
+    save_data(data, path, row_group_size=10)
+
+    assert count_rows(path) == 103
+    for start, end in [(0, 10), (15, 47), (100, 200), (103, 103)]:
+        pd.testing.assert_frame_equal(
+            load_rows(path, start, end),
+            data.iloc[start:end].reset_index(drop=True))
+
+def test_concatenate_rows_writes_the_rows_of_every_part(tmp_path):
+    # Parts of categorical columns each hold their own categories, and a
+    # part can be empty
+    parts = [pd.DataFrame({'order_id': pd.Categorical(ids),
+                           'price': np.arange(len(ids), dtype=float)})
+             for ids in [['b', 'a', 'b'], [], ['c', 'a']]]
+    paths = [str(tmp_path / 'part{}.parquet'.format(part))
+             for part in range(len(parts))]
+    for part, part_path in zip(parts, paths):
+        save_data(part, part_path)
+    path = str(tmp_path / 'data.parquet')
+
+    concatenate_rows(paths, path)
+
+    data = load_data(path)
+    assert list(data['order_id'].astype(str)) == ['b', 'a', 'b', 'c', 'a']
+    assert list(data['price']) == [0, 1, 2, 0, 1]
+
+    matrices = [sp.random(rows, 7, density=0.3, format='csr', random_state=rows)
+                for rows in [13, 0, 30]]
+    paths = [str(tmp_path / 'part{}.csr'.format(part))
+             for part in range(len(matrices))]
+    for matrix, part_path in zip(matrices, paths):
+        save_data(matrix, part_path)
+    path = str(tmp_path / 'data.csr')
+
+    concatenate_rows(paths, path)
+
+    assert count_rows(path) == 43
+    assert (load_data(path) != sp.vstack(matrices, format='csr')).nnz == 0
+
+def test_stages_are_recorded_without_the_resource_module(monkeypatch, capsys):
+    # resource is POSIX only, and psutil is optional
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    monkeypatch.setitem(sys.modules, 'psutil', None)
+    instrumentation = Instrumentation()
+    instrumentation.configure(enabled=True, trace_memory=True)
+    try:
+        with instrumentation.stage('outer'):
+            with instrumentation.stage('inner') as record:
+                record['rows'] = 3
+    finally:
+        tracemalloc.stop()
+
+    summary = instrumentation.summary()
+    assert list(summary) == ['outer.inner', 'outer']
+    assert summary['outer.inner']['peak_rss_mb'] is None
+    assert summary['outer.inner']['rows'] == 3
+    instrumentation.print_summary()
+    assert 'outer.inner' in capsys.readouterr().out
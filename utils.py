@@ -1,16 +1,550 @@
+import os
+import json
+import time
+import hashlib
 import pickle 
+import sys
+import threading
+import tracemalloc
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scipy.sparse as sp
 
-def save_data(data, path):
+# Artifacts are stored by file extension:
+# '.parquet' for DataFrames (columnar, columns can be loaded selectively),
+# '.npy' for dense arrays (can be memory-mapped), '.npz' for sparse matrices,
+# '.csr' for sparse matrices read a range of rows at a time (a directory of
+# the CSR arrays as .npy files) and pickle for anything else
+PARQUET_EXTENSION = '.parquet'
+NUMPY_EXTENSION = '.npy'
+SPARSE_EXTENSION = '.npz'
+SPARSE_ROWS_EXTENSION = '.csr'
+SPARSE_ROWS_ARRAYS = ['data', 'indices', 'indptr', 'shape']
+
+def save_data(data, path, row_group_size=None):
+    # 'row_group_size' sets the rows per row group of a Parquet file, the
+    # smallest part of it load_rows reads
+    extension = os.path.splitext(path)[1]
+    if extension == PARQUET_EXTENSION:
+        data.to_parquet(path, index=False, row_group_size=row_group_size)
+    elif extension == NUMPY_EXTENSION:
+        np.save(path, np.asarray(data), allow_pickle=False)
+    elif extension == SPARSE_EXTENSION:
+        sp.save_npz(path, sp.csr_matrix(data))
+    elif extension == SPARSE_ROWS_EXTENSION:
+        data = sp.csr_matrix(data)
+        os.makedirs(path, exist_ok=True)
+        for name in SPARSE_ROWS_ARRAYS:
+            np.save(os.path.join(path, name + NUMPY_EXTENSION),
+                    np.asarray(getattr(data, name)), allow_pickle=False)
+    else:
         with open(path, 'wb') as file:
             pickle.dump(data, file)
-            file.close()
 
-def load_data(path):
+def load_data(path, columns=None, mmap_mode=None):
+    # 'columns' selects the columns to read from a Parquet file
+    # 'mmap_mode' memory-maps a .npy file instead of reading it, e.g. 'r'
+    extension = os.path.splitext(path)[1]
+    if extension == PARQUET_EXTENSION:
+        return pd.read_parquet(path, columns=columns)
+    if extension == NUMPY_EXTENSION:
+        return np.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+    if extension == SPARSE_EXTENSION:
+        return sp.load_npz(path).tocsr()
+    if extension == SPARSE_ROWS_EXTENSION:
+        return load_rows(path, 0, count_rows(path))
+
     with open(path, 'rb') as file:
         data = pickle.load(file)
     return data
 
+def count_rows(path):
+    # Number of rows of a Parquet file or '.csr' matrix, read from its
+    # metadata
+    if os.path.splitext(path)[1] == PARQUET_EXTENSION:
+        return pq.ParquetFile(path).metadata.num_rows
+    return int(_load_sparse_array(path, 'shape')[0])
+
+def load_rows(path, start, end):
+    # Rows 'start' to 'end' of a Parquet file or '.csr' matrix
+    # Only the row groups of the file, or the parts of the memory-mapped
+    # arrays, that hold these rows are read
+    end = min(end, count_rows(path))
+    start = min(start, end)
+    if os.path.splitext(path)[1] == PARQUET_EXTENSION:
+        parquet_file = pq.ParquetFile(path)
+        group_sizes = [parquet_file.metadata.row_group(group).num_rows
+                       for group in range(parquet_file.num_row_groups)]
+        group_ends = np.cumsum(group_sizes)
+        group_starts = group_ends - group_sizes
+        groups = np.flatnonzero((group_starts < end) & (group_ends > start))
+        if len(groups) == 0:
+            return parquet_file.schema_arrow.empty_table().to_pandas()
+        data = parquet_file.read_row_groups(groups.tolist()).to_pandas()
+        offset = group_starts[groups[0]]
+        return data.iloc[start - offset:end - offset].reset_index(drop=True)
+
+    pointers = np.array(_load_sparse_array(path, 'indptr')[start:end + 1])
+    values = [np.array(_load_sparse_array(path, name)
+                                         [pointers[0]:pointers[-1]])
+              for name in ['data', 'indices']]
+    columns = int(_load_sparse_array(path, 'shape')[1])
+    return sp.csr_matrix((values[0], values[1], pointers - pointers[0]),
+                         shape=(end - start, columns))
+
+def _load_sparse_array(path, name):
+    return np.load(os.path.join(path, name + NUMPY_EXTENSION), mmap_mode='r',
+                   allow_pickle=False)
+
+def concatenate_rows(paths, path, row_group_size=None):
+    # Writes the rows of the Parquet files or '.csr' matrices in 'paths' one
+    # after the other to 'path', reading one of them at a time
+    # Each Parquet part keeps its own dictionaries for categorical columns,
+    # they are read back with the union of the parts' categories
+    if os.path.splitext(path)[1] == PARQUET_EXTENSION:
+        _concatenate_parquet(paths, path, row_group_size)
+    else:
+        _concatenate_sparse_rows(paths, path)
+
+def _concatenate_parquet(paths, path, row_group_size):
+    parts = [pq.ParquetFile(part) for part in paths]
+    # Columns of empty parts can have the null type, so the schema is the one
+    # of the first part with rows. Parts with fewer categories have narrower
+    # dictionary indices, they are all widened to 32 bits.
+    schema = next((part.schema_arrow for part in parts
+                   if part.metadata.num_rows > 0), parts[0].schema_arrow)
+    schema = pa.schema([field.with_type(pa.dictionary(pa.int32(),
+                                                      field.type.value_type))
+                        if pa.types.is_dictionary(field.type) else field
+                        for field in schema], metadata=schema.metadata)
+    with pq.ParquetWriter(path, schema) as writer:
+        for part in parts:
+            if part.metadata.num_rows > 0:
+                writer.write_table(part.read().cast(schema),
+                                   row_group_size=row_group_size)
+
+def _concatenate_sparse_rows(paths, path):
+    # The arrays are written in place with np.lib.format.open_memmap, the
+    # sizes are read from the parts' shapes and row pointers
+    shapes = [_load_sparse_array(part, 'shape') for part in paths]
+    sizes = [int(_load_sparse_array(part, 'indptr')[-1]) for part in paths]
+    rows = sum(int(shape[0]) for shape in shapes)
+    index_dtype = np.int64 if sum(sizes) > np.iinfo(np.int32).max \
+                  else np.int32
+    data_dtype = np.result_type(*[_load_sparse_array(part, 'data').dtype
+                                  for part in paths])
+    os.makedirs(path, exist_ok=True)
+    arrays = {name: np.lib.format.open_memmap(
+                  os.path.join(path, name + NUMPY_EXTENSION), mode='w+',
+                  dtype=dtype, shape=(length,))
+              for name, dtype, length in [('data', data_dtype, sum(sizes)),
+                                          ('indices', index_dtype, sum(sizes)),
+                                          ('indptr', index_dtype, rows + 1)]}
+    arrays['indptr'][0] = 0
+    start = 0
+    row = 0
+    for part, shape, size in zip(paths, shapes, sizes):
+        for name in ['data', 'indices']:
+            arrays[name][start:start + size] = \
+                _load_sparse_array(part, name)[:size]
+        arrays['indptr'][row + 1:row + shape[0] + 1] = \
+            _load_sparse_array(part, 'indptr')[1:] + start
+        start += size
+        row += int(shape[0])
+    for array in arrays.values():
+        array.flush()
+    np.save(os.path.join(path, 'shape' + NUMPY_EXTENSION),
+            np.array([rows, int(shapes[0][1])]), allow_pickle=False)
+
+def save_tables(tables, path):
+    # Saves a dict of DataFrames as one Parquet file per table in 'path'
+    os.makedirs(path, exist_ok=True)
+    for name, table in tables.items():
+        save_data(table, os.path.join(path, name + PARQUET_EXTENSION))
+
+def load_tables(path, names=None):
+    # Loads the tables saved with save_tables, or only the ones in 'names'
+    if names is None:
+        names = [os.path.splitext(file)[0] for file in sorted(os.listdir(path))
+                 if file.endswith(PARQUET_EXTENSION)]
+    return {name: load_data(os.path.join(path, name + PARQUET_EXTENSION))
+            for name in names}
+
+def concatenate_tables(paths, path, names):
+    # Concatenates the tables 'names' saved with save_tables in each of
+    # 'paths' into tables of the same names in 'path', on disk, see
+    # concatenate_rows
+    os.makedirs(path, exist_ok=True)
+    for name in names:
+        concatenate_rows([os.path.join(part, name + PARQUET_EXTENSION)
+                          for part in paths],
+                         os.path.join(path, name + PARQUET_EXTENSION))
+
+# Stage caching
+# A stage is skipped when the fingerprint of its inputs matches the one stored
+# when it last ran and its outputs still exist. File contents are hashed again
+# only when a file's size or modification time changed.
+CACHE_INDEX = 'stages.json'
+FILE_HASH_INDEX = 'file_hashes.json'
+
+def fingerprint(cache_path, paths=(), config=None, upstream=()):
+    # Hashes the contents of the files in 'paths' (directories file by file),
+    # the relevant config and the fingerprints of upstream stages
+    file_hashes = _read_json(os.path.join(cache_path, FILE_HASH_INDEX))
+    digest = hashlib.sha256()
+    for path in paths:
+        for file in _list_files(path):
+            digest.update(file.encode())
+            digest.update(_file_hash(file, file_hashes).encode())
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    for upstream_fingerprint in upstream:
+        digest.update(upstream_fingerprint.encode())
+
+    _write_json(file_hashes, cache_path, FILE_HASH_INDEX)
+    return digest.hexdigest()
+
+def is_cached(cache_path, stage, stage_fingerprint, outputs):
+    stages = _read_json(os.path.join(cache_path, CACHE_INDEX))
+    return stages.get(stage) == stage_fingerprint and \
+           all(os.path.exists(output) for output in outputs)
+
+def store_cache_entry(cache_path, stage, stage_fingerprint):
+    stages = _read_json(os.path.join(cache_path, CACHE_INDEX))
+    stages[stage] = stage_fingerprint
+    _write_json(stages, cache_path, CACHE_INDEX)
+
+def clear_cache_entries(cache_path, stages):
+    cached_stages = _read_json(os.path.join(cache_path, CACHE_INDEX))
+    for stage in stages:
+        cached_stages.pop(stage, None)
+    _write_json(cached_stages, cache_path, CACHE_INDEX)
+
+def _list_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(directory, file)
+                  for directory, _, files in os.walk(path) for file in files)
+
+def _file_hash(path, file_hashes):
+    size, mtime = file_signature(path)
+    key = os.path.abspath(path)
+    entry = file_hashes.get(key)
+    if entry is not None and entry['size'] == size and \
+       entry['mtime'] == mtime:
+        return entry['hash']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    file_hashes[key] = {'size': size, 'mtime': mtime,
+                        'hash': digest.hexdigest()}
+    return file_hashes[key]['hash']
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def _write_json(data, directory, name):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), 'w') as file:
+        json.dump(data, file, indent=1)
+
+class LRUCache():
+    # Bounded cache that evicts the least recently used entries
+    # Entries older than 'ttl' seconds are computed again, if a ttl is given.
+    # Hits and misses are counted.
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        # Returns the cached value for 'key', or computes and caches it
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and \
+               (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries)}
+
+# Serving bundle
+# The artifacts needed for inference, one file per artifact and a manifest of
+# their files, so a predictor loads each of them only when it first uses it
+BUNDLE_MANIFEST = 'manifest.json'
+
+def save_bundle(artifacts, path, removed=()):
+    # Adds a dict of artifacts to the bundle in 'path', replacing artifacts of
+    # the same name. DataFrames with a default index are stored as Parquet,
+    # numeric arrays as .npy (memory-mapped when loaded), the rest pickled.
+    # The artifacts named in 'removed' are taken out of the bundle.
+    manifest = _read_json(os.path.join(path, BUNDLE_MANIFEST))
+    os.makedirs(path, exist_ok=True)
+    for name in removed:
+        if name in manifest:
+            os.remove(os.path.join(path, manifest.pop(name)))
+    for name, artifact in artifacts.items():
+        file = name + _bundle_extension(artifact)
+        save_data(artifact, os.path.join(path, file))
+        manifest[name] = file
+    _write_json(manifest, path, BUNDLE_MANIFEST)
+
+def _bundle_extension(artifact):
+    if isinstance(artifact, pd.DataFrame) and \
+       isinstance(artifact.index, pd.RangeIndex):
+        return PARQUET_EXTENSION
+    if isinstance(artifact, np.ndarray) and artifact.dtype != object:
+        return NUMPY_EXTENSION
+    return '.pkl'
+
+class LazyBundle(Mapping):
+    # Read-only mapping of the artifacts in a serving bundle, each loaded on
+    # first access and then kept
+    def __init__(self, path):
+        self.path = path
+        self.manifest = _read_json(os.path.join(path, BUNDLE_MANIFEST))
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            file = os.path.join(self.path, self.manifest[name])
+            with self.lock:
+                if name not in self.loaded:
+                    self.loaded[name] = load_data(file, mmap_mode='r')
+        return self.loaded[name]
+
+    def __contains__(self, name):
+        # Without loading the artifact
+        return name in self.manifest
+
+    def __iter__(self):
+        return iter(self.manifest)
+
+    def __len__(self):
+        return len(self.manifest)
+
+def file_signature(path):
+    # Size and modification time, to tell when a file was written again
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+# Instrumentation
+# Named stages record their wall time, CPU time, peak memory and row counts
+# when instrumentation is enabled. Otherwise stage() hands out one shared
+# no-op context, so instrumented code costs close to nothing.
+class Instrumentation():
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.output_file = None
+        self.records = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def configure(self, enabled=False, output_path=None, trace_memory=False):
+        # 'output_path' gets one JSON line per finished stage
+        # 'trace_memory' adds the peak Python allocations of each stage, with
+        # tracemalloc, which slows down the instrumented code
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+        if enabled and output_path is not None:
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            self.output_file = open(output_path, 'a')
+
+    def stage(self, name):
+        # Context for a stage, stages started inside it are named
+        # '<name>.<inner name>'. It yields the stage's record, where the
+        # instrumented code can set e.g. 'rows'.
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def summary(self):
+        # One row per stage name with its calls and total, mean and peak values
+        summary = {}
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            row = summary.setdefault(record['name'],
+                                     {'calls': 0, 'wall_time_s': 0.0,
+                                      'cpu_time_s': 0.0, 'peak_rss_mb': None,
+                                      'peak_traced_mb': None, 'rows': None})
+            row['calls'] += 1
+            row['wall_time_s'] += record['wall_time_s']
+            row['cpu_time_s'] += record['cpu_time_s']
+            for column, combine in [('peak_rss_mb', max),
+                                    ('peak_traced_mb', max), ('rows', sum)]:
+                if record.get(column) is not None:
+                    row[column] = record[column] if row[column] is None \
+                                  else combine([row[column], record[column]])
+        return summary
+
+    def print_summary(self):
+        if not self.records:
+            return
+        summary = self.summary()
+        width = max(len(name) for name in summary) + 2
+        print(f'{"stage":<{width}}{"calls":>8}{"wall s":>10}{"mean ms":>10}'
+              f'{"cpu s":>10}{"rss MB":>9}{"traced MB":>11}{"rows":>10}')
+        for name, row in summary.items():
+            rss, traced = ['' if row[column] is None else f'{row[column]:.1f}'
+                           for column in ['peak_rss_mb', 'peak_traced_mb']]
+            rows = '' if row['rows'] is None else row['rows']
+            print(f'{name:<{width}}{row["calls"]:>8}{row["wall_time_s"]:>10.3f}'
+                  f'{1000 * row["wall_time_s"] / row["calls"]:>10.3f}'
+                  f'{row["cpu_time_s"]:>10.3f}{rss:>9}'
+                  f'{traced:>11}{rows:>10}')
+
+    def _active_stages(self):
+        if not hasattr(self.local, 'stages'):
+            self.local.stages = []
+        return self.local.stages
+
+    def _finish(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.output_file is not None:
+                self.output_file.write(json.dumps(record, default=str) + '\n')
+                self.output_file.flush()
+
+class _Stage():
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        stages = self.instrumentation._active_stages()
+        name = self.name if not stages \
+               else stages[-1].record['name'] + '.' + self.name
+        self.record = {'name': name}
+        if self.instrumentation.trace_memory:
+            # The peak so far belongs to the enclosing stage
+            if stages:
+                stages[-1].traced_peak = max(stages[-1].traced_peak,
+                                             tracemalloc.get_traced_memory()[1])
+            _reset_traced_peak()
+            self.traced_peak = 0
+        stages.append(self)
+
+        self.start_time = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self.record
+
+    def __exit__(self, *exception):
+        record = self.record
+        record['wall_time_s'] = time.perf_counter() - self.start_time
+        record['cpu_time_s'] = time.process_time() - self.start_cpu
+        record['peak_rss_mb'] = peak_rss_mb()
+
+        stages = self.instrumentation._active_stages()
+        stages.pop()
+        if self.instrumentation.trace_memory:
+            traced_peak = max(self.traced_peak,
+                              tracemalloc.get_traced_memory()[1])
+            record['peak_traced_mb'] = traced_peak / 2**20
+            if stages:
+                stages[-1].traced_peak = max(stages[-1].traced_peak,
+                                             traced_peak)
+        self.instrumentation._finish(record)
+        return False
+
+def peak_rss_mb():
+    # Peak resident memory of this process so far, in MB. The resource module
+    # is only found on POSIX systems, elsewhere psutil is used if installed,
+    # otherwise the peak is None.
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        # Windows keeps the peak working set, other systems only the current
+        return getattr(memory, 'peak_wset', memory.rss) / 2**20
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+def rss_mb():
+    # Resident memory of this process now, in MB, read from /proc on Linux
+    # and with psutil elsewhere if installed, otherwise None
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, AttributeError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 2**20
+
+def _reset_traced_peak():
+    # tracemalloc.reset_peak is new in Python 3.9, before it tracing is
+    # restarted, which also forgets the allocations traced so far
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+class _NullStage():
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exception):
+        return False
+
+_NULL_STAGE = _NullStage()
+INSTRUMENTATION = Instrumentation()
+
+def stage(name):
+    return INSTRUMENTATION.stage(name)
+
+def configure_instrumentation(config):
+    # Takes the 'instrumentation' settings of a step config
+    INSTRUMENTATION.configure(enabled=config['enabled'],
+                              output_path=config['output_path'],
+                              trace_memory=config['trace_memory'])
+
 def trim_id(string_input, trim_length=5):
     # Trims input to given length
     # Used for making customer and other id's easier to read
-    return string_input[:trim_length]
\ No newline at end of file
+    return string_input[:trim_length]